@@ -31,6 +31,12 @@ from extension_helpers import ExtensionHelper
 _log = logging.getLogger('composer')
 
 
+COMPILE_INPUTS = ('php', 'hhvm', '{WEBDIR}', '{LIBDIR}')
+COMPILE_OUTPUTS = ('php', '{WEBDIR}', '{LIBDIR}',
+                   'composer.json', 'composer.lock',
+                   'COMPOSER_DOWNLOAD_URL', 'COMPOSER_HASH_URL')
+
+
 def find_composer_paths(path):
     json_path = None
     lock_path = None
@@ -161,6 +167,22 @@ class ComposerExtension(ExtensionHelper):
         self.install()
         self.run()
 
+    def _plan(self, plan):
+        plan.modules('PHP').include_module('cli').done()
+        url, hashUrl = self.binary_urls()
+        plan.binary('COMPOSER', url, hashUrl)
+
+    def binary_urls(self):
+        """The URL of composer.phar and of its hash.
+
+        The `latest` version comes from getcomposer.org and can't be
+        verified, its hash is `ignored`.
+        """
+        if self._ctx['COMPOSER_VERSION'] == 'latest':
+            return ('https://getcomposer.org/composer.phar', 'ignored')
+        return (self._ctx['COMPOSER_DOWNLOAD_URL'],
+                self._ctx['COMPOSER_HASH_URL'])
+
     def move_local_vendor_folder(self):
         vendor_path = os.path.join(self._ctx['BUILD_DIR'],
                                    self._ctx['WEBDIR'],
@@ -177,9 +199,8 @@ class ComposerExtension(ExtensionHelper):
     def install(self):
         self._builder.install().modules('PHP').include_module('cli').done()
         if self._ctx['COMPOSER_VERSION'] == 'latest':
-            self._ctx['COMPOSER_DOWNLOAD_URL'] = \
-                'https://getcomposer.org/composer.phar'
-            self._ctx['COMPOSER_HASH_URL'] = 'ignored'
+            (self._ctx['COMPOSER_DOWNLOAD_URL'],
+             self._ctx['COMPOSER_HASH_URL']) = self.binary_urls()
         self._builder.install()._installer.install_binary_direct(
             self._ctx['COMPOSER_DOWNLOAD_URL'],
             self._ctx['COMPOSER_HASH_URL'],
@@ -354,6 +375,11 @@ def service_environment(ctx):
     return composer.service_environment()
 
 
+def plan(plan):
+    composer = ComposerExtension(plan._ctx)
+    return composer.plan(plan)
+
+
 def compile(install):
     composer = ComposerExtension(install.builder._ctx)
     return composer.compile(install)
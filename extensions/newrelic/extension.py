@@ -19,11 +19,16 @@ Downloads, installs and configures the NewRelic agent for PHP
 import os
 import os.path
 import logging
+from build_pack_utils import utils
 
 
 _log = logging.getLogger('newrelic')
 
 
+COMPILE_INPUTS = ('php',)
+COMPILE_OUTPUTS = ('newrelic', 'php/etc')
+
+
 DEFAULTS = {
     'NEWRELIC_HOST': 'download.newrelic.com',
     'NEWRELIC_VERSION': '4.18.0.89',
@@ -150,6 +155,7 @@ class NewRelicInstaller(object):
         lines.append('newrelic.daemon.location=%s\n' % self.daemon_path)
         lines.append('newrelic.daemon.port=%s\n' % self.socket_path)
         lines.append('newrelic.daemon.pidfile=%s\n' % self.pid_path)
+        utils.break_hardlink(self.php_ini_path)
         with open(self.php_ini_path, 'wt') as php_ini:
             for line in lines:
                 php_ini.write(line)
@@ -168,6 +174,23 @@ def service_environment(ctx):
     return {}
 
 
+def plan(plan):
+    # the agent's details come from php.ini, which isn't installed yet,
+    #  so only look for a license key like NewRelicInstaller does
+    ctx = plan._ctx
+    if ctx['PHP_VM'] != 'php':
+        return 0
+    services = ctx.get('VCAP_SERVICES', {}).get('newrelic', [])
+    if ((services and
+            services[0].get('credentials', {}).get('licenseKey')) or
+            'NEWRELIC_LICENSE' in ctx.keys()):
+        for key, val in DEFAULTS.iteritems():
+            if key not in ctx:
+                ctx[key] = val
+        plan.package('NEWRELIC')
+    return 0
+
+
 def compile(install):
     newrelic = NewRelicInstaller(install.builder._ctx)
     if newrelic.should_install():
@@ -4,6 +4,9 @@ from cloudfoundry import *
 from detecter import *
 from downloads import *
 from hashes import *
+from mirrors import *
+from scheduler import *
+from snapshots import *
 from builder import *
 from zips import *
 from process import Process
@@ -12,3 +15,4 @@ from runner import BuildPack
 from runner import check_output
 from runner import stream_output
 import utils
+import timing
@@ -1,8 +1,11 @@
 import os
 import sys
+import json
 import shutil
 import re
 import logging
+import tempfile
+import timing
 from collections import defaultdict
 from StringIO import StringIO
 from subprocess import Popen
@@ -15,9 +18,18 @@ from detecter import StartsWithFileSearch
 from detecter import EndsWithFileSearch
 from detecter import ContainsFileSearch
 from runner import BuildPack
+from scheduler import StepScheduler
+from scheduler import overlaps
+from snapshots import StepSnapshots
 from utils import rewrite_cfgs
+from utils import load_extension
 from utils import process_extension
 from utils import process_extensions
+from utils import run_in_parallel
+from utils import FormattedDict
+from utils import break_hardlink
+from utils import copytree
+from utils import safe_makedirs
 
 
 _log = logging.getLogger('builder')
@@ -156,13 +168,15 @@ class Installer(object):
     def __init__(self, builder):
         self.builder = builder
         self._log = _log
-        self._installer = CloudFoundryInstaller(self.builder._ctx)
+        self._installer = CloudFoundryInstaller(self.builder._ctx,
+                                                self.builder._digests)
 
     def package(self, key):
         if key in self.builder._ctx.keys():
             key = self.builder._ctx[key]
-        self.builder._ctx['%s_INSTALL_PATH' % key] = \
-            self._installer.install_binary(key)
+        with timing.Span('package %s' % key, 'install'):
+            self.builder._ctx['%s_INSTALL_PATH' % key] = \
+                self._installer.install_binary(key)
         self._log.info("Installed [%s] to [%s]", key,
                        self.builder._ctx['%s_INSTALL_PATH' % key])
         return self
@@ -185,17 +199,57 @@ class Installer(object):
         def process(retcode):
             if retcode != 0:
                 raise RuntimeError('Extension Failed with [%s]' % retcode)
+
+        def step(path):
+            return lambda: process_extension(path, ctx, 'compile', process,
+                                             args=[self])
+
+        def snapshot(path, run, inputs, outputs):
+            name = '%s-%s' % (os.path.basename(os.path.dirname(path)),
+                              os.path.basename(path))
+            return lambda: snapshots.run(name, run, inputs, outputs)
+        # extensions that declare what they read and write are installed
+        #  at the same time as the others they don't depend on
+        scheduler = StepScheduler(ctx.get('COMPILE_CONCURRENCY'))
+        snapshots = StepSnapshots(ctx, self._installer)
+        steps = []
         for path in extn_reg._paths:
-            process_extension(path, ctx, 'compile', process, args=[self])
+            extn = load_extension(path)
+            if hasattr(extn, 'compile'):
+                steps.append((path, extn,
+                              self._resources(extn, 'COMPILE_INPUTS'),
+                              self._resources(extn, 'COMPILE_OUTPUTS')))
+        written = [o for p, e, i, outputs in steps for o in outputs or ()]
+        for path, extn, inputs, outputs in steps:
+            run = step(path)
+            if (snapshots.enabled() and
+                    getattr(extn, 'COMPILE_SNAPSHOT', False) and
+                    inputs is not None and outputs is not None):
+                # what other steps write is covered by the context keys
+                #  and binaries the step used, only app files are hashed
+                run = snapshot(path, run,
+                               [i for i in inputs
+                                if not overlaps([i], written)],
+                               outputs)
+            scheduler.add(path, run, inputs, outputs)
+        with timing.Span('extensions', 'step'):
+            scheduler.run()
         ctx['EXTENSIONS'].extend(extn_reg._paths)
         return self
 
+    def _resources(self, extn, name):
+        resources = getattr(extn, name, None)
+        if resources is None:
+            return None
+        return [self.builder._ctx.format(r) for r in resources]
+
     def build_pack_utils(self):
         self._log.info("Installed build pack utils.")
-        (self.builder.copy()
-             .under('{BP_DIR}/lib/build_pack_utils')
-             .into('{BUILD_DIR}/.bp/lib/build_pack_utils')
-             .done())
+        with timing.Span('build_pack_utils', 'step'):
+            (self.builder.copy()
+                 .under('{BP_DIR}/lib/build_pack_utils')
+                 .into('{BUILD_DIR}/.bp/lib/build_pack_utils')
+                 .done())
         return self
 
     def build_pack(self):
@@ -228,7 +282,8 @@ class ModuleInstaller(object):
     def __init__(self, installer, moduleKey):
         self._installer = installer
         self._ctx = installer.builder._ctx
-        self._cf = CloudFoundryInstaller(self._ctx)
+        self._cf = CloudFoundryInstaller(self._ctx,
+                                         installer.builder._digests)
         self._moduleKey = moduleKey
         self._extn = ''
         self._modules = []
@@ -271,7 +326,9 @@ class ModuleInstaller(object):
         return self
 
     def from_application(self, path):
-        fullPath = os.path.join(self._ctx['BUILD_DIR'], path)
+        return self._from_path(os.path.join(self._ctx['BUILD_DIR'], path))
+
+    def _from_path(self, fullPath):
         if os.path.exists(fullPath) and os.path.isdir(fullPath):
             for root, dirs, files in os.walk(fullPath):
                 for f in files:
@@ -286,24 +343,46 @@ class ModuleInstaller(object):
         self._modules = list(set(self._modules))
         return self
 
+    def _module_url(self, module):
+        # resolve against a copy, the context is shared with other threads
+        ctx = FormattedDict(self._ctx)
+        ctx['MODULE_NAME'] = module
+        return ctx['%s_MODULES_PATTERN' % self._moduleKey]
+
+    def _module_urls(self, module):
+        url = self._module_url(module)
+        return url, "%s.%s" % (url, self._ctx['CACHE_HASH_ALGORITHM'])
+
+    def _install_module(self, module):
+        url, hashUrl = self._module_urls(module)
+        return self._cf.install_binary_direct(url, hashUrl, self._toPath,
+                                              strip=self._strip,
+                                              exclude=self._exclude)
+
     def done(self):
-        toPath = os.path.join(self._ctx['BUILD_DIR'],
-                              self._moduleKey.lower())
-        strip = self._ctx.get('%s_MODULES_STRIP' % self._moduleKey, False)
-        for module in set(self._modules):
-            try:
-                self._ctx['MODULE_NAME'] = module
-                url = self._ctx['%s_MODULES_PATTERN' % self._moduleKey]
-                hashUrl = "%s.%s" % (url, self._ctx['CACHE_HASH_ALGORITHM'])
-                self._cf.install_binary_direct(url, hashUrl, toPath,
-                                               strip=strip)
-            except Exception:
-                self._log.warning('Module %s failed to install', module)
-                self._log.debug('Module %s failed to install because',
-                                module, exc_info=True)
-            finally:
-                if 'MODULE_NAME' in self._ctx.keys():
-                    del self._ctx['MODULE_NAME']
+        self._toPath = os.path.join(self._ctx['BUILD_DIR'],
+                                    self._moduleKey.lower())
+        self._strip = self._ctx.get('%s_MODULES_STRIP' % self._moduleKey,
+                                    False)
+        self._exclude = self._ctx.get(
+            '%s_MODULES_EXCLUDE_PATTERNS' % self._moduleKey, [])
+        workers = self._ctx.get('MODULE_INSTALL_CONCURRENCY', 4)
+        modules = sorted(set(self._modules))
+        failed = []
+        with timing.Span('modules %s' % self._moduleKey, 'install',
+                         modules=len(modules)):
+            self._cf.prefetch([self._module_urls(module)
+                               for module in modules])
+            for module, unused_path, exc_info in run_in_parallel(
+                    self._install_module, modules, workers):
+                if exc_info:
+                    self._log.warning('Module %s failed to install', module)
+                    self._log.debug('Module %s failed to install because',
+                                    module, exc_info=exc_info)
+                    failed.append(module)
+        if failed:
+            sys.stdout.write('Failed to install %s modules [%s]\n' % (
+                self._moduleKey, ', '.join(failed)))
         return self._installer
 
 
@@ -366,19 +445,194 @@ class ConfigInstaller(object):
                      self._ctx,
                      delim=self._delimiter)
 
+    def done(self):
+        with timing.Span('config %s' % self._to_path, 'install'):
+            if (self._bp_path or self._app_path) and self._to_path:
+                if self._bp_path:
+                    self._cfInst.install_from_build_pack(self._bp_path,
+                                                         self._to_path)
+                if self._app_path:
+                    self._cfInst.install_from_application(self._app_path,
+                                                          self._to_path)
+            if self._delimiter:
+                self._rewrite_cfgs()
+        return self._installer
+
+
+class ConfigPlanner(ConfigInstaller):
+    """Records where config files would be installed, without copying"""
+
+    def __init__(self, plan):
+        ConfigInstaller.__init__(self, plan)
+        self._ctx = plan._ctx
+
     def done(self):
         if (self._bp_path or self._app_path) and self._to_path:
-            if self._bp_path:
-                self._cfInst.install_from_build_pack(self._bp_path,
-                                                     self._to_path)
-            if self._app_path:
-                self._cfInst.install_from_application(self._app_path,
-                                                      self._to_path)
-        if self._delimiter:
-            self._rewrite_cfgs()
+            self._installer._configs.append((self._to_path, self._app_path,
+                                             self._bp_path, self._delimiter))
         return self._installer
 
 
+class ModulePlanner(ModuleInstaller):
+    """Finds the modules to install, then adds them to the plan.
+
+    Config files the plan would install are read from where they would
+    be copied from, and rewritten the same way first.
+    """
+
+    def __init__(self, plan, moduleKey):
+        ModuleInstaller.__init__(self, plan, moduleKey)
+        self._ctx = plan._ctx
+
+    def from_application(self, path):
+        tmpDir = self._installer._render_configs(path)
+        if tmpDir is None:
+            return ModuleInstaller.from_application(self, path)
+        try:
+            return self._from_path(os.path.join(tmpDir, path))
+        finally:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+
+    def done(self):
+        for module in sorted(set(self._modules)):
+            url, hashUrl = self._module_urls(module)
+            self._installer._add('module', '%s-%s' % (self._moduleKey,
+                                                      module),
+                                 url, hashUrl)
+        return self._installer
+
+
+class BuildPlan(object):
+    """The binaries a build will install, found before any are installed.
+
+    Each extension adds what it needs from its `plan` method, which is
+    passed this object.  It has the same `package`, `config` and
+    `modules` steps as the `Installer`, which only record what would be
+    downloaded.  Modules listed in config files are found by reading the
+    files the plan would install.  Artifacts are listed once, in the
+    order they were added.  Planning works on a copy of the context, so
+    it doesn't change the build.
+    """
+
+    def __init__(self, builder):
+        self.builder = builder
+        self._ctx = FormattedDict(builder._ctx)
+        self._log = _log
+        self._installer = CloudFoundryInstaller(self._ctx, builder._digests)
+        self._configs = []
+        self.artifacts = []
+
+    def _verifiable(self, hashUrl):
+        """True if the hash is a URL or a digest, not a placeholder"""
+        return bool(hashUrl) and (
+            self._installer._is_url(hashUrl) or
+            re.match(r'^\s*[0-9a-fA-F]{32,}(\s|$)', hashUrl) is not None)
+
+    def _add(self, kind, name, url, hashUrl):
+        if url in [a['url'] for a in self.artifacts]:
+            return
+        if not self._verifiable(hashUrl):
+            # fetching it early would fail, leave it to the install
+            self._log.debug('Not planning [%s], it has no hash [%s]',
+                            name, hashUrl)
+            return
+        self._log.debug('Planning to install [%s] from [%s]', name, url)
+        self.artifacts.append({'type': kind,
+                               'name': name,
+                               'url': url,
+                               'hash_url': hashUrl})
+
+    def _render_configs(self, path):
+        """Copy the config files the plan would install under path.
+
+        They are copied, and rewritten, to the same path under a new
+        temporary directory, which is returned.  Returns None if the
+        plan installs no config files there.
+        """
+        for toPath, appPath, bpPath, delimiter in self._configs:
+            if path != toPath and not path.startswith(toPath + '/'):
+                continue
+            rel = path[len(toPath):].strip('/')
+            tmpDir = tempfile.mkdtemp(prefix='plan-',
+                                      dir=self._ctx.get('TMPDIR'))
+            # files from the application replace the build pack's
+            for base, fromPath in ((self._ctx['BP_DIR'], bpPath),
+                                   (self._ctx['BUILD_DIR'], appPath)):
+                if not fromPath:
+                    continue
+                src = os.path.join(base, fromPath, rel)
+                dst = os.path.join(tmpDir, path)
+                if os.path.isdir(src):
+                    copytree(src, dst)
+                elif os.path.isfile(src):
+                    safe_makedirs(os.path.dirname(dst))
+                    shutil.copy(src, dst)
+            if delimiter and os.path.exists(os.path.join(tmpDir, path)):
+                rewrite_cfgs(os.path.join(tmpDir, path), self._ctx,
+                             delim=delimiter)
+            return tmpDir
+
+    def package(self, key):
+        if key in self._ctx.keys():
+            key = self._ctx[key]
+        url, hashUrl = self._installer.binary_urls(key)
+        self._add('package', key, url, hashUrl)
+        return self
+
+    def packages(self, *keys):
+        for key in keys:
+            self.package(key)
+        return self
+
+    def binary(self, name, url, hashUrl):
+        self._add('binary', name, url, hashUrl)
+        return self
+
+    def modules(self, key):
+        return ModulePlanner(self, key)
+
+    def config(self):
+        return ConfigPlanner(self)
+
+    def extensions(self):
+        """Add what each registered extension declares in `plan`"""
+        def process(retcode):
+            pass  # ignore result, don't care
+        for path in self.builder._extn_reg._paths:
+            process_extension(path, self._ctx, 'plan', process,
+                              args=[self], ignore=True)
+        return self
+
+    def fetch(self):
+        """Download everything in the plan into the cache.
+
+        Files are downloaded in bulk when the downloader can, otherwise
+        `MODULE_INSTALL_CONCURRENCY` at a time.  Failures are only
+        logged, installing the binary later reports them.
+        """
+        downloads = [(a['url'], a['hash_url']) for a in self.artifacts]
+        workers = self._ctx.get('MODULE_INSTALL_CONCURRENCY', 4)
+        with timing.Span('fetch', 'step', artifacts=len(downloads)):
+            self._installer.prefetch(downloads)
+            for (url, hashUrl), unused, exc_info in run_in_parallel(
+                    lambda download: self._installer.cache_binary(*download),
+                    downloads, workers):
+                if exc_info:
+                    self._log.info('Could not fetch [%s] [%s]',
+                                   url, exc_info[1])
+        return self
+
+    def write(self, fileOut=None):
+        """Write the plan as JSON, to stdout by default"""
+        json.dump({'artifacts': self.artifacts}, fileOut or sys.stdout,
+                  indent=4, separators=(',', ': '), sort_keys=True)
+        (fileOut or sys.stdout).write('\n')
+        return self
+
+    def done(self):
+        return self.builder
+
+
 class Runner(object):
     def __init__(self, builder):
         self._builder = builder
@@ -393,31 +647,27 @@ class Runner(object):
 
     def done(self):
         if os.path.exists(self._path):
-            cwd = os.getcwd()
-            try:
-                self._log.debug('Running [%s] from [%s] with shell [%s]',
-                                self._cmd, self._path, self._shell)
-                self._log.debug('Running with env [%s]', self._env)
-                os.chdir(self._path)
-                proc = Popen(self._cmd, stdout=PIPE, env=self._env,
-                             stderr=PIPE, shell=self._shell)
-                stdout, stderr = proc.communicate()
-                retcode = proc.poll()
-                self._log.debug("Command completed with [%s]", retcode)
-                if self._on_finish:
-                    self._on_finish(self._cmd, retcode, stdout, stderr)
-                else:
-                    if retcode == 0 and self._on_success:
-                        self._on_success(self._cmd, retcode, stdout)
-                    elif retcode != 0 and self._on_fail:
-                        self._on_fail(self._cmd, retcode, stderr)
-                    elif retcode != 0:
-                        self._log.error(
-                            'Command [%s] failed with [%d], add an '
-                            '"on_fail" or "on_finish" method to debug '
-                            'further', self._cmd, retcode)
-            finally:
-                os.chdir(cwd)
+            self._log.debug('Running [%s] from [%s] with shell [%s]',
+                            self._cmd, self._path, self._shell)
+            self._log.debug('Running with env [%s]', self._env)
+            # cwd, not os.chdir, extensions may run on several threads
+            proc = Popen(self._cmd, stdout=PIPE, env=self._env,
+                         stderr=PIPE, shell=self._shell, cwd=self._path)
+            stdout, stderr = proc.communicate()
+            retcode = proc.poll()
+            self._log.debug("Command completed with [%s]", retcode)
+            if self._on_finish:
+                self._on_finish(self._cmd, retcode, stdout, stderr)
+            else:
+                if retcode == 0 and self._on_success:
+                    self._on_success(self._cmd, retcode, stdout)
+                elif retcode != 0 and self._on_fail:
+                    self._on_fail(self._cmd, retcode, stderr)
+                elif retcode != 0:
+                    self._log.error(
+                        'Command [%s] failed with [%d], add an '
+                        '"on_fail" or "on_finish" method to debug '
+                        'further', self._cmd, retcode)
         return self._builder
 
     def environment_variable(self):
@@ -491,7 +741,8 @@ class Executor(object):
 
     def method(self, execute):
         if hasattr(execute, '__call__'):
-            execute(self.builder._ctx)
+            with timing.Span(getattr(execute, '__name__', 'execute'), 'step'):
+                execute(self.builder._ctx)
         return self.builder
 
 
@@ -500,6 +751,7 @@ class FileUtil(object):
         self._builder = builder
         self._move = move
         self._filters = []
+        self._excludes = []
         self._from_path = None
         self._into_path = None
         self._match = all
@@ -551,6 +803,7 @@ class FileUtil(object):
             pattern = re.compile(pattern)
         self._filters.append(
             lambda path: (pattern.match(path) is None))
+        self._excludes.append(pattern)
         return self
 
     def all_true(self):
@@ -588,8 +841,55 @@ class FileUtil(object):
             shutil.move(src, dest)
         else:
             self._log.debug("Copying [%s] to [%s]", src, dest)
+            break_hardlink(dest)
             shutil.copy(src, dest)
 
+    def _matcher(self):
+        """All of the filters as one function of a path"""
+        filters = tuple(self._filters)
+        match = self._match
+        return lambda path: match(f(path) for f in filters)
+
+    def _excluded(self, dirPath):
+        """True if no file under the directory can match the filters.
+
+        That's the case when every filter must match and a pattern given
+        to `where_name_does_not_match` ending in `.*$`, like
+        `^/app/lib/.*$`, matches the directory itself.
+        """
+        if self._match is not all:
+            return False
+        for pattern in self._excludes:
+            if (pattern.pattern.endswith('.*$') and
+                    pattern.match(dirPath + '/') is not None):
+                return True
+        return False
+
+    def _walk(self, top):
+        """Yield the files under `top` that match, as they're found.
+
+        Excluded directories are not walked.  When moving, the empty
+        directories left behind, and any excluded directory that is empty,
+        are removed once the walk is done.
+        """
+        match = self._matcher()
+        walked = []
+        for root, dirs, files in os.walk(top):
+            walked.extend(os.path.join(root, d) for d in dirs)
+            dirs[:] = [d for d in dirs
+                       if not self._excluded(os.path.join(root, d))]
+            for f in files:
+                fromPath = os.path.join(root, f)
+                if match(fromPath):
+                    yield fromPath
+        if self._move:
+            # children were walked after their parents
+            for dirPath in reversed(walked):
+                if os.path.isdir(dirPath) and len(os.listdir(dirPath)) == 0:
+                    self._log.debug("Cleaning up empty directory [%s]",
+                                    dirPath)
+                    os.rmdir(dirPath)
+
     def done(self):
         if self._from_path and self._into_path:
             self._log.debug('Copying files from [%s] to [%s]',
@@ -600,21 +900,9 @@ class FileUtil(object):
             if not os.path.exists(self._from_path):
                 raise ValueError("Source path [%s] does not exist"
                                  % self._from_path)
-            for root, dirs, files in os.walk(self._from_path.decode('utf-8'),
-                                             topdown=False):
-                for f in files:
-                    fromPath = os.path.join(root, f)
-                    toPath = fromPath.replace(self._from_path, self._into_path)
-                    if self._match([f(fromPath) for f in self._filters]):
-                        self._copy_or_move(fromPath, toPath)
-                if self._move:
-                    for d in dirs:
-                        dirPath = os.path.join(root, d)
-                        if len(os.listdir(dirPath)) == 0:
-                            self._log.debug(
-                                "Cleaning up empty directory [%s]",
-                                dirPath)
-                            os.rmdir(os.path.join(root, d))
+            for fromPath in self._walk(self._from_path.decode('utf-8')):
+                toPath = fromPath.replace(self._from_path, self._into_path)
+                self._copy_or_move(fromPath, toPath)
         return self._builder
 
 
@@ -921,6 +1209,8 @@ class Builder(object):
     def __init__(self):
         self._installer = None
         self._ctx = None
+        # digests from hash URLs, the plan fetches them for the install
+        self._digests = {}
 
     def configure(self):
         self._ctx = CloudFoundryUtil.initialize()
@@ -932,6 +1222,9 @@ class Builder(object):
     def register(self):
         return Register(self)
 
+    def plan(self):
+        return BuildPlan(self)
+
     def run(self):
         return Runner(self)
 
@@ -1,10 +1,119 @@
 import os
+import re
+import json
+import fcntl
+import urllib2
+import hashlib
+import time
+import errno
 import shutil
 import logging
+import tempfile
+import threading
 from hashes import HashUtil
 from hashes import ShaHashUtil
 
 
+_lock = threading.Lock()
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'tree_hits': 0,
+    'tree_misses': 0,
+    'remote_hits': 0,
+    'remote_misses': 0,
+    'bytes_saved': 0,
+    'bytes_stored': 0,
+    'evicted': 0,
+    'bytes_evicted': 0
+}
+
+
+def _count(**kwargs):
+    with _lock:
+        for key, val in kwargs.iteritems():
+            _stats[key] += val
+
+
+def _parse_size(val):
+    """Convert a size like 1024, '500M' or '2G' to bytes"""
+    if isinstance(val, (int, long)):
+        return val
+    val = str(val).strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    if val and val[-1] in units:
+        return int(float(val[:-1]) * units[val[-1]])
+    return int(val)
+
+
+def tree_name(digest, strip, exclude=()):
+    """Name of an extracted archive in the cache.
+
+    It's `<digest>-<n>`, where `n` is 1 if the leading directory was
+    stripped, followed by a hash of the exclude patterns if there are any.
+    """
+    name = '%s-%d' % (digest.split()[0], strip and 1 or 0)
+    if exclude:
+        name += '-%s' % hashlib.sha1(
+            '\n'.join(sorted(exclude))).hexdigest()[:12]
+    return name
+
+
+class FileLock(object):
+    """An advisory lock on a file, shared by processes and threads.
+
+    Use it in a `with` statement.  If the lock can't be had within
+    `timeout` seconds, a warning is logged and the block runs without it,
+    so a stuck process can slow other stages down but not stop them.
+    """
+
+    def __init__(self, path, timeout=600):
+        self._path = path
+        self._timeout = timeout
+        self._fd = None
+        self._log = logging.getLogger('cache')
+
+    def acquire(self):
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0644)
+        start = time.time()
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._fd = fd
+                return True
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    raise
+            if time.time() - start > self._timeout:
+                self._log.warning('Gave up waiting for lock [%s]',
+                                  self._path)
+                os.close(fd)
+                return False
+            time.sleep(0.1)
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+
+class _NoLock(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
 class BaseCacheManager(object):
 
     def __init__(self, ctx):
@@ -19,7 +128,7 @@ class BaseCacheManager(object):
     def get(self, key, digest):
         return None
 
-    def put(self, key, fileToCache):
+    def put(self, key, fileToCache, digest, move=False):
         pass
 
     def delete(self, key):
@@ -28,43 +137,547 @@ class BaseCacheManager(object):
     def exists(self, key, digest):
         return False
 
+    def get_tree(self, digest, strip, exclude=()):
+        return None
+
+    def put_tree(self, digest, strip, extract, exclude=()):
+        return None
+
+    def lock(self, key):
+        return _NoLock()
+
 
 class DirectoryCacheManager(BaseCacheManager):
+    """Content addressed cache of files, stored in a directory.
+
+    Files are stored by digest, under
+
+        objects/<algorithm>/<first two digits>/<digest>/<key>
+
+    so files with the same name but different contents, from different
+    stacks or mirrors, no longer overwrite each other.  When the same
+    contents are stored under more than one key, the files are hard
+    linked so they are only stored once.  The file `names/<key>` holds
+    the digest last stored for a key.
+
+    Next to each file, `.<key>.digest` records its digest along with the
+    size, modification time and inode of the file when it was hashed.
+    While those still match, the file is not hashed again on a cache hit.
+    Use `verify` to re-hash every file regardless.  The record also
+    tracks when the file was last used and how many times, which `evict`
+    uses to keep the cache under `FILE_CACHE_MAX_SIZE`.
+
+    Extracted archives are kept too, under `trees/<algorithm>/<name>`,
+    see `tree_name`, so an archive is only extracted once for each way
+    it's extracted.  See `get_tree` and `put_tree`.
+
+    Files are written to a temporary file and renamed into place, so a
+    cached file is never seen half written.  Stages that share the cache
+    directory can use `lock` so only one of them downloads or extracts a
+    file while the others wait for it.  Files cached by older
+    versions, directly under the base directory, are moved into the
+    store the first time they are found with the right digest.
+    """
 
     def __init__(self, ctx):
         BaseCacheManager.__init__(self, ctx)
+        self._ctx = ctx
         self._baseDir = ctx.get('FILE_CACHE_BASE_DIRECTORY',
                                 ctx['CACHE_DIR'])
+        self._algorithm = ctx.get('CACHE_HASH_ALGORITHM', 'sha1')
         self._log.info("Using [%s] as cache directory.", self._baseDir)
         if not os.path.exists(self._baseDir):
             os.makedirs(self._baseDir)
 
+    def _normalize(self, digest):
+        # hash files may hold "<digest>  <file name>"
+        parts = digest and digest.split() or []
+        return parts and parts[0].lower() or ''
+
+    def _object_dir(self, digest):
+        return os.path.join(self._baseDir, 'objects', self._algorithm,
+                            digest[:2], digest)
+
+    def _name_path(self, key):
+        return os.path.join(self._baseDir, 'names', key)
+
+    def _makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _sidecar_path(self, path):
+        return os.path.join(os.path.dirname(path),
+                            '.%s.digest' % os.path.basename(path))
+
+    def _stat_key(self, path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime, st.st_ino]
+
+    def _load_record(self, path):
+        try:
+            with open(self._sidecar_path(path), 'rt') as f:
+                record = json.load(f)
+            if hasattr(record, 'keys'):
+                return record
+        except (IOError, ValueError):
+            pass
+        return {}
+
+    def _save_record(self, path, record):
+        try:
+            self._write_atomic(self._sidecar_path(path), json.dumps(record))
+        except (IOError, OSError), e:
+            self._log.debug('Could not record digest of [%s]. %s', path, e)
+
+    def _remember(self, path, digest):
+        """Record that path, as it is now, has this digest"""
+        record = self._load_record(path)
+        record['digest'] = digest
+        record['stat'] = self._stat_key(path)
+        record.setdefault('accessed', time.time())
+        record.setdefault('hits', 0)
+        self._save_record(path, record)
+
+    def _record_access(self, path, **counts):
+        record = self._load_record(path)
+        record['accessed'] = time.time()
+        record['hits'] = record.get('hits', 0) + 1
+        self._save_record(path, record)
+        if not counts:
+            counts = {'hits': 1, 'bytes_saved': os.path.getsize(path)}
+        _count(**counts)
+
+    def _does_hash_match(self, digest, path):
+        """Check the digest, without hashing if the file is unchanged"""
+        record = self._load_record(path)
+        try:
+            if (record.get('digest') == digest and
+                    record.get('stat') == self._stat_key(path)):
+                return True
+        except OSError:
+            pass
+        if self._hashUtil.does_hash_match(digest, path):
+            self._remember(path, digest)
+            return True
+        return False
+
+    def _write_atomic(self, path, data):
+        self._makedirs(os.path.dirname(path))
+        fd, tmpPath = tempfile.mkstemp(prefix='.tmp-',
+                                       dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wt') as f:
+                f.write(data)
+            os.rename(tmpPath, path)
+        except:
+            os.remove(tmpPath)
+            raise
+
+    def _store_atomic(self, fileToCache, path, move):
+        """Put the file at path, it's complete or not there at all"""
+        if move:
+            try:
+                os.rename(fileToCache, path)
+                return
+            except OSError, e:
+                if e.errno != errno.EXDEV:
+                    raise
+        fd, tmpPath = tempfile.mkstemp(prefix='.tmp-',
+                                       dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            shutil.copy(fileToCache, tmpPath)
+            os.rename(tmpPath, path)
+        except:
+            os.remove(tmpPath)
+            raise
+        if move:
+            os.remove(fileToCache)
+
+    def _link_atomic(self, src, path):
+        tmpPath = os.path.join(os.path.dirname(path),
+                               '.tmp-%d-%s' % (os.getpid(),
+                                               os.path.basename(path)))
+        try:
+            os.link(src, tmpPath)
+        except OSError:
+            return False
+        os.rename(tmpPath, path)
+        return True
+
+    def _others(self, objDir, key):
+        if not os.path.isdir(objDir):
+            return []
+        return [os.path.join(objDir, name) for name in os.listdir(objDir)
+                if name != key and not name.startswith('.')]
+
+    def _migrate(self, key, digest):
+        """Move a file cached by the old, name keyed, layout"""
+        legacy = os.path.join(self._baseDir, key)
+        if (not os.path.isfile(legacy) or
+                not self._hashUtil.does_hash_match(digest, legacy)):
+            return None
+        self._log.debug('Moving [%s] into the cache store', legacy)
+        return self.put(key, legacy, digest, move=True)
+
     def get(self, key, digest):
-        path = os.path.join(self._baseDir, key)
+        digest = self._normalize(digest)
+        if not digest:
+            return None
+        objDir = self._object_dir(digest)
+        path = os.path.join(objDir, key)
         if self.exists(key, digest):
             self._log.debug('Cache hit (%s, %s)', key, digest)
+            self._record_access(path)
             return path
+        for other in self._others(objDir, key):
+            if (self._does_hash_match(digest, other) and
+                    self._link_atomic(other, path)):
+                self._log.debug('Cache hit (%s, %s) as [%s]',
+                                key, digest, os.path.basename(other))
+                self._write_atomic(self._name_path(key), digest)
+                self._remember(path, digest)
+                self._record_access(path)
+                return path
+        path = self._migrate(key, digest)
+        if path:
+            self._record_access(path)
+        else:
+            _count(misses=1)
+        return path
+
+    def put(self, key, fileToCache, digest, move=False):
+        """Store the file under key and digest, return its cached path.
 
-    def put(self, key, fileToCache, digest):
-        path = os.path.join(self._baseDir, key)
-        if (os.path.exists(path) and
-                not self._hashUtil.does_hash_match(digest, path)):
-            self._log.warning(
-                "File [%s] already exists in the cache, but the digest "
-                "[%s] does not match.  Will update the cache if the "
-                "underlying file system supports it.", key, digest)
-        shutil.copy(fileToCache, path)
+        With `move` the file is moved into the cache, which avoids a copy
+        when it's on the same file system.
+        """
+        digest = self._normalize(digest)
+        objDir = self._object_dir(digest)
+        path = os.path.join(objDir, key)
+        self._makedirs(objDir)
+        linked = False
+        for other in self._others(objDir, key):
+            if self._link_atomic(other, path):
+                self._log.debug('Linked [%s] to identical [%s]',
+                                key, os.path.basename(other))
+                linked = True
+                break
+        if linked:
+            if move:
+                os.remove(fileToCache)
+        else:
+            self._store_atomic(fileToCache, path, move)
+            _count(bytes_stored=os.path.getsize(path))
+        self._remember(path, digest)
+        self._write_atomic(self._name_path(key), digest)
         return path
 
     def delete(self, key):
-        path = os.path.join(self._baseDir, key)
-        if os.path.exists(path):
-            self._log.warning(
-                "You are trying to delete a file from the cache "
-                "this is not supported for all file systems.")
-            os.remove(path)
+        namePath = self._name_path(key)
+        if os.path.exists(namePath):
+            with open(namePath, 'rt') as f:
+                digest = f.read().strip()
+            path = os.path.join(self._object_dir(digest), key)
+            for p in (path, self._sidecar_path(path)):
+                if os.path.exists(p):
+                    os.remove(p)
+            os.remove(namePath)
+        legacy = os.path.join(self._baseDir, key)
+        if os.path.isfile(legacy):
+            os.remove(legacy)
 
     def exists(self, key, digest):
-        path = os.path.join(self._baseDir, key)
-        return (os.path.exists(path) and
-                self._hashUtil.does_hash_match(digest, path))
+        digest = self._normalize(digest)
+        path = os.path.join(self._object_dir(digest), key)
+        return (bool(digest) and os.path.exists(path) and
+                self._does_hash_match(digest, path))
+
+    def verify(self):
+        """Re-hash every cached file, removing any that are corrupt.
+
+        Digest records are refreshed for good files.  Returns a tuple of
+        the number of files checked and a list of the corrupt files.
+        """
+        objects = os.path.join(self._baseDir, 'objects', self._algorithm)
+        paths = []
+        for root, dirs, files in os.walk(objects):
+            paths.extend([os.path.join(root, name) for name in files
+                          if not name.startswith('.')])
+        digests = self._hashUtil.calculate_hashes(paths)
+        corrupt = []
+        for path in paths:
+            digest = os.path.basename(os.path.dirname(path))
+            if digests.get(path) == digest:
+                self._remember(path, digest)
+                continue
+            self._log.warning('Removing corrupt cache file [%s]', path)
+            corrupt.append(path)
+            for p in (path, self._sidecar_path(path)):
+                if os.path.exists(p):
+                    os.remove(p)
+        self._log.info('Verified [%d] cached files, [%d] corrupt',
+                       len(paths), len(corrupt))
+        return len(paths), corrupt
+
+    def lock(self, key):
+        """A lock for the key, shared by every stage using this cache.
+
+        Waits at most `FILE_CACHE_LOCK_TIMEOUT` seconds, 600 by default.
+        """
+        locks = os.path.join(self._baseDir, 'locks')
+        self._makedirs(locks)
+        return FileLock(os.path.join(locks, '%s.lock' % key),
+                        float(self._ctx.get('FILE_CACHE_LOCK_TIMEOUT', 600)))
+
+    def _tree_dir(self, digest, strip, exclude=()):
+        return os.path.join(self._baseDir, 'trees', self._algorithm,
+                            tree_name(digest, strip, exclude))
+
+    def get_tree(self, digest, strip, exclude=()):
+        """The directory holding the extracted archive, or None"""
+        digest = self._normalize(digest)
+        path = self._tree_dir(digest, strip, exclude)
+        if digest and os.path.isdir(path):
+            self._log.debug('Cache hit, extracted (%s, %s)', digest, strip)
+            self._record_access(path, tree_hits=1)
+            return path
+        _count(tree_misses=1)
+
+    def put_tree(self, digest, strip, extract, exclude=()):
+        """Store an extracted archive, return the directory holding it.
+
+        `extract` is called with a temporary directory to fill, which is
+        renamed into place once it's complete.
+        """
+        digest = self._normalize(digest)
+        path = self._tree_dir(digest, strip, exclude)
+        self._makedirs(os.path.dirname(path))
+        tmpPath = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(path))
+        try:
+            extract(tmpPath)
+            os.rename(tmpPath, path)
+        except OSError:
+            shutil.rmtree(tmpPath, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+            # extracted by someone else at the same time
+        except:
+            shutil.rmtree(tmpPath, ignore_errors=True)
+            raise
+        record = self._load_record(path)
+        record.setdefault('accessed', time.time())
+        record.setdefault('hits', 0)
+        self._save_record(path, record)
+        return path
+
+    def _tree_entries(self):
+        trees = os.path.join(self._baseDir, 'trees')
+        entries = []
+        if not os.path.isdir(trees):
+            return entries
+        for algorithm in os.listdir(trees):
+            algoDir = os.path.join(trees, algorithm)
+            for name in os.listdir(algoDir):
+                path = os.path.join(algoDir, name)
+                if name.startswith('.') or not os.path.isdir(path):
+                    continue
+                size = 0
+                for root, dirs, files in os.walk(path):
+                    for f in files:
+                        if not os.path.islink(os.path.join(root, f)):
+                            size += os.path.getsize(os.path.join(root, f))
+                record = self._load_record(path)
+                entries.append({'path': path, 'digest': None, 'size': size,
+                                'locks': ['%s.tree' % name],
+                                'accessed': record.get(
+                                    'accessed', os.path.getmtime(path)),
+                                'hits': record.get('hits', 0)})
+        return entries
+
+    def _entries(self):
+        """Describe each digest in the store, for eviction"""
+        objects = os.path.join(self._baseDir, 'objects')
+        entries = []
+        for root, dirs, files in os.walk(objects):
+            if os.path.dirname(os.path.dirname(os.path.dirname(root))) \
+                    != objects:
+                continue
+            dirs[:] = []
+            size, accessed, hits, inodes = 0, 0, 0, []
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                if st.st_ino not in inodes:
+                    inodes.append(st.st_ino)
+                    size += st.st_size
+                record = self._load_record(path)
+                accessed = max(accessed, record.get('accessed', st.st_mtime))
+                hits += record.get('hits', 0)
+            entries.append({'path': root, 'digest': os.path.basename(root),
+                            'size': size, 'accessed': accessed,
+                            'hits': hits,
+                            'locks': sorted([f for f in files
+                                             if not f.startswith('.')])})
+        return entries + self._tree_entries()
+
+    def _forget_names(self, digests):
+        namesDir = os.path.join(self._baseDir, 'names')
+        if not os.path.isdir(namesDir):
+            return
+        for name in os.listdir(namesDir):
+            path = os.path.join(namesDir, name)
+            try:
+                with open(path, 'rt') as f:
+                    if f.read().strip() in digests:
+                        os.remove(path)
+            except (IOError, OSError):
+                pass
+
+    def evict(self):
+        """Remove files until the cache fits in `FILE_CACHE_MAX_SIZE`.
+
+        The size may be given in bytes or with a K, M, G or T suffix.  By
+        default the least recently used files go first, set
+        `FILE_CACHE_EVICTION` to `lfu` to remove the least frequently
+        used instead.  Nothing is removed if no size is set.
+        """
+        maxSize = self._ctx.get('FILE_CACHE_MAX_SIZE')
+        if not maxSize:
+            return []
+        maxSize = _parse_size(maxSize)
+        entries = self._entries()
+        total = sum([e['size'] for e in entries])
+        if self._ctx.get('FILE_CACHE_EVICTION', 'lru').lower() == 'lfu':
+            entries.sort(key=lambda e: (e['hits'], e['accessed']))
+        else:
+            entries.sort(key=lambda e: e['accessed'])
+        evicted = []
+        for entry in entries:
+            if total <= maxSize:
+                break
+            self._log.info('Evicting [%s] from the cache, [%d] bytes',
+                           entry['path'], entry['size'])
+            # don't pull files out from under a stage that's using them
+            locks = [self.lock(key) for key in entry['locks']]
+            for lock in locks:
+                lock.acquire()
+            try:
+                shutil.rmtree(entry['path'], ignore_errors=True)
+                if os.path.exists(self._sidecar_path(entry['path'])):
+                    os.remove(self._sidecar_path(entry['path']))
+            finally:
+                for lock in locks:
+                    lock.release()
+            total -= entry['size']
+            if entry['digest']:
+                evicted.append(entry['digest'])
+            _count(evicted=1, bytes_evicted=entry['size'])
+        self._forget_names(evicted)
+        return evicted
+
+    def stats(self):
+        """Counters for this process, plus the current size of the cache"""
+        entries = self._entries()
+        with _lock:
+            stats = dict(_stats)
+        stats['entries'] = len(entries)
+        stats['size'] = sum([e['size'] for e in entries])
+        stats['max_size'] = _parse_size(
+            self._ctx.get('FILE_CACHE_MAX_SIZE') or 0)
+        return stats
+
+
+class HttpCacheManager(DirectoryCacheManager):
+    """A local directory cache, backed by a cache shared over HTTP.
+
+    Files are looked up in the local cache first.  On a miss they are
+    fetched from `FILE_CACHE_URL/<algorithm>/<digest>`, checked and added
+    to the local cache.  Files that are put in the cache are also sent to
+    the shared cache with a PUT, unless `FILE_CACHE_WRITE_BACK` is false.
+
+    Problems with the shared cache are logged and otherwise ignored, the
+    build pack then downloads the file as it would without it.  See
+    `bin/cache-server` for a simple server.
+    """
+
+    def __init__(self, ctx):
+        DirectoryCacheManager.__init__(self, ctx)
+        self._url = ctx['FILE_CACHE_URL'].rstrip('/')
+        self._timeout = float(ctx.get('FILE_CACHE_TIMEOUT', 10))
+        self._log.info("Using [%s] as shared cache.", self._url)
+
+    def _remote_url(self, digest):
+        return '%s/%s/%s' % (self._url, self._algorithm, digest)
+
+    def _request(self, url, data=None, headers=None):
+        req = urllib2.Request(url, data, headers or {})
+        if self._ctx.get('FILE_CACHE_AUTH'):
+            req.add_header('Authorization', self._ctx['FILE_CACHE_AUTH'])
+        return req
+
+    def _fetch_remote(self, key, digest):
+        tmpDir = os.path.join(self._baseDir, 'objects', self._algorithm)
+        self._makedirs(tmpDir)
+        fd, tmpPath = tempfile.mkstemp(prefix='.tmp-', dir=tmpDir)
+        try:
+            hsh = hashlib.new(self._algorithm)
+            with os.fdopen(fd, 'wb') as out:
+                res = urllib2.urlopen(
+                    self._request(self._remote_url(digest)),
+                    timeout=self._timeout)
+                for buf in iter(lambda: res.read(65536), ''):
+                    hsh.update(buf)
+                    out.write(buf)
+                res.close()
+            if hsh.hexdigest() != digest:
+                raise IOError('digest of shared cache file is [%s]' %
+                              hsh.hexdigest())
+            path = DirectoryCacheManager.put(self, key, tmpPath, digest,
+                                             move=True)
+            self._log.info('Shared cache hit (%s, %s)', key, digest)
+            _count(remote_hits=1)
+            return path
+        except urllib2.HTTPError, e:
+            if e.code != 404:
+                self._log.warning('Shared cache get of [%s] failed [%s]',
+                                  key, e)
+        except Exception, e:
+            self._log.warning('Shared cache get of [%s] failed [%s]',
+                              key, e)
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+        _count(remote_misses=1)
+
+    def _send_remote(self, key, path, digest):
+        try:
+            with open(path, 'rb') as data:
+                req = self._request(self._remote_url(digest), data, {
+                    'Content-Type': 'application/octet-stream',
+                    'Content-Length': str(os.path.getsize(path))})
+                req.get_method = lambda: 'PUT'
+                urllib2.urlopen(req, timeout=self._timeout).close()
+            self._log.info('Sent (%s, %s) to shared cache', key, digest)
+        except Exception, e:
+            self._log.warning('Shared cache put of [%s] failed [%s]',
+                              key, e)
+
+    def get(self, key, digest):
+        path = DirectoryCacheManager.get(self, key, digest)
+        digest = self._normalize(digest)
+        if path is None and re.match(r'^[0-9a-f]+$', digest):
+            path = self._fetch_remote(key, digest)
+        return path
+
+    def put(self, key, fileToCache, digest, move=False):
+        path = DirectoryCacheManager.put(self, key, fileToCache, digest,
+                                         move)
+        if self._ctx.get('FILE_CACHE_WRITE_BACK', True):
+            self._send_remote(key, path, self._normalize(digest))
+        return path
@@ -4,14 +4,21 @@ import json
 import tempfile
 import shutil
 import utils
+import timing
 import logging
+from urllib import url2pathname
 from urlparse import urlparse
 from zips import UnzipUtil
 from hashes import HashUtil
 from cache import DirectoryCacheManager
+from cache import HttpCacheManager
+from cache import tree_name
 from downloads import Downloader
 from downloads import CurlDownloader
+from mirrors import MirrorList
 from utils import safe_makedirs
+from utils import link_or_copy
+from utils import link_tree
 from utils import find_git_url
 from utils import wrap
 
@@ -94,14 +101,55 @@ class CloudFoundryUtil(object):
         return {}
 
 
+class _PipelineFailed(Exception):
+    pass
+
+
 class CloudFoundryInstaller(object):
-    def __init__(self, ctx):
+    def __init__(self, ctx, digests=None):
         self._log = _log
         self._ctx = ctx
         self._unzipUtil = UnzipUtil(ctx)
         self._hashUtil = HashUtil(ctx)
-        self._dcm = DirectoryCacheManager(ctx)
+        self._dcm = self._get_cache_manager(ctx)(ctx)
         self._dwn = self._get_downloader(ctx)(ctx)
+        self._mirrors = MirrorList(ctx)
+        # hash URL -> its contents, installers can share one to fetch
+        #  each hash file once
+        if digests is None:
+            digests = {}
+        self._digests = digests
+
+    def cache_manager(self):
+        """The cache binaries are kept in, see `FILE_CACHE_METHOD`"""
+        return self._dcm
+
+    def _get_cache_manager(self, ctx):
+        method = ctx.get('FILE_CACHE_METHOD', 'directory')
+        if method == 'directory':
+            self._log.debug('Using directory cache.')
+            return DirectoryCacheManager
+        elif method == 'http':
+            self._log.debug('Using directory cache, shared over HTTP.')
+            return HttpCacheManager
+        elif method == 'custom':
+            fullClsName = ctx['FILE_CACHE_CLASS']
+            self._log.debug('Using custom cache [%s].', fullClsName)
+            dotLoc = fullClsName.rfind('.')
+            if dotLoc >= 0:
+                clsName = fullClsName[dotLoc + 1: len(fullClsName)]
+                modName = fullClsName[0:dotLoc]
+                m = __import__(modName, globals(), locals(), [clsName])
+                try:
+                    return getattr(m, clsName)
+                except AttributeError:
+                    self._log.exception(
+                        'WARNING: FILE_CACHE_CLASS not found!')
+            else:
+                self._log.error(
+                    'WARNING: FILE_CACHE_CLASS invalid, must include '
+                    'package name!')
+        return DirectoryCacheManager
 
     def _get_downloader(self, ctx):
         method = ctx.get('DOWNLOAD_METHOD', 'python')
@@ -133,48 +181,292 @@ class CloudFoundryInstaller(object):
     def _is_url(self, val):
         return urlparse(val).scheme != ''
 
+    def _is_local(self, url):
+        return urlparse(url).scheme == 'file'
+
+    def _digest(self, hsh):
+        if hsh in self._digests:
+            return self._digests[hsh]
+        elif self._is_url(hsh):
+            digest = self._dwn.download_direct(hsh)
+            if digest:
+                self._digests[hsh] = digest
+            return digest
+        return hsh
+
+    def digest(self, hsh):
+        """The digest that a hash URL, or a digest, says a binary has"""
+        return self._digest(hsh).split()[0].lower()
+
+    def _fetch_local(self, url, hsh):
+        """Return the path of a file:// artifact, after checking its hash.
+
+        Local artifacts, like those in an offline build pack, are used
+        where they are and never go through TMPDIR or the cache.
+        """
+        path = url2pathname(urlparse(url).path)
+        if not os.path.isfile(path):
+            raise IOError(2, 'No such file', path)
+        digest = self._digest(hsh)
+        if not self._hashUtil.does_hash_match(digest, path):
+            raise RuntimeError('Digest of [%s] does not match [%s]' %
+                               (path, digest.strip()))
+        self._log.debug('Using local file [%s]', path)
+        return path, digest
+
+    def _tree_lock(self, digest, strip, exclude=()):
+        return self._dcm.lock('%s.tree' % tree_name(digest, strip, exclude))
+
+    def _can_pipeline(self, toFile, expected):
+        return (self._ctx.get('DOWNLOAD_PIPELINE', False) and
+                self._ctx.get('FILE_CACHE_UNPACKED', True) and
+                isinstance(self._dwn, (Downloader, CurlDownloader)) and
+                not self._is_url(expected) and
+                # a resumed download would skip the start of the archive
+                not os.path.exists('%s.part' % toFile))
+
+    def _download_pipelined(self, url, toFile, expected, strip, exclude):
+        """Download an archive and extract it into the cache at once.
+
+        The bytes are fed to the extractor as they arrive, so the network
+        and the decompressor work at the same time.  The extracted tree
+        is only kept if the extractor saw the whole download and its
+        digest matches, otherwise it's removed and the archive is
+        extracted from the downloaded file as usual.  Returns the digest
+        of the download, or None if nothing was downloaded.
+        """
+        result = {}
+
+        def extract(toDir):
+            stream = self._unzipUtil.stream(toFile, toDir, strip, exclude)
+            if stream is None:
+                raise _PipelineFailed('[%s] cannot be streamed' % toFile)
+            try:
+                result['digest'] = self._dwn.download(url, toFile,
+                                                      [stream.write])
+            except:
+                stream.abort()
+                raise
+            if not stream.close():
+                raise _PipelineFailed('extracting [%s] failed' % url)
+            if stream.length != os.path.getsize(toFile):
+                raise _PipelineFailed('the download of [%s] was restarted'
+                                      % url)
+            if result['digest'] != expected.split()[0].lower():
+                raise _PipelineFailed('digest of [%s] does not match' % url)
+            timing.count(bytes_extracted=stream.length)
+
+        with self._tree_lock(expected, strip, exclude):
+            try:
+                self._dcm.put_tree(expected, strip, extract, exclude)
+            except _PipelineFailed, e:
+                self._log.info('Extracting [%s] from the download, %s',
+                               toFile, e)
+        return result.get('digest')
+
+    def _fetch(self, url, hsh, fileName, verify=False, strip=None,
+               exclude=()):
+        """Return the path to the artifact and its digest.
+
+        The artifact is downloaded if it's not cached.  With `verify`, a
+        download that doesn't match the expected digest is an error.
+        With `DOWNLOAD_PIPELINE` and `strip` set, the archive is also
+        extracted into the cache while it downloads.
+        """
+        if self._is_local(url):
+            return self._fetch_local(url, hsh)
+        digest = self._digest(hsh)
+        self._log.debug("Fetching [%s] with digest [%s] as [%s]",
+                        url, digest, fileName)
+        # one stage downloads, others sharing the cache wait and reuse it
+        with self._dcm.lock(fileName):
+            fileToInstall = self._dcm.get(fileName, digest)
+            if fileToInstall is not None:
+                timing.count(cache_hits=1)
+            else:
+                self._log.debug('File [%s] not in cache.', fileName)
+                fileToInstall = os.path.join(self._ctx['TMPDIR'], fileName)
+                expected = digest
+                digest = None
+                if (strip is not None and
+                        self._can_pipeline(fileToInstall, expected)):
+                    digest = self._download_pipelined(url, fileToInstall,
+                                                      expected, strip,
+                                                      exclude)
+                if digest is None:
+                    digest = self._dwn.download(url, fileToInstall)
+                if not digest:
+                    # custom downloaders may not hash the file as it arrives
+                    digest = self._hashUtil.calculate_hash(fileToInstall)
+                timing.count(cache_misses=1,
+                             bytes_downloaded=os.path.getsize(fileToInstall))
+                if verify and digest != expected.split()[0].lower():
+                    os.remove(fileToInstall)
+                    raise RuntimeError('Digest of [%s] is [%s], expected '
+                                       '[%s]' % (url, digest,
+                                                 expected.strip()))
+                fileToInstall = self._dcm.put(fileName, fileToInstall,
+                                              digest, move=True)
+        return fileToInstall, digest
+
+    def prefetch(self, downloads):
+        """Fetch a list of (url, hashUrl) in bulk, if the downloader can.
+
+        Hash files are downloaded first and remembered.  Files that are
+        not already in the cache are then downloaded together and added
+        to the cache.  Failures are ignored, installing the file later
+        on will retry it and report the error.
+        """
+        if not hasattr(self._dwn, 'download_many'):
+            return
+        with timing.Span('prefetch', 'download', files=len(downloads)):
+            self._prefetch(downloads)
+
+    def _prefetch(self, downloads):
+        # the best mirror is the one install_binary_direct tries first
+        downloads = [self._mirrors.alternatives(url, hsh)[0]
+                     for url, hsh in downloads]
+        downloads = [(url, hsh) for url, hsh in downloads
+                     if not self._is_local(url)]
+        tmpDir = tempfile.mkdtemp(prefix='prefetch-',
+                                  dir=self._ctx['TMPDIR'])
+        try:
+            hashes = [(hsh, os.path.join(tmpDir, '%d.hash' % i))
+                      for i, (url, hsh) in enumerate(downloads)
+                      if self._is_url(hsh) and hsh not in self._digests]
+            codes = self._dwn.download_many(hashes)
+            for hsh, toFile in hashes:
+                if 200 <= codes.get(toFile, 0) < 300:
+                    with open(toFile, 'rt') as f:
+                        self._digests[hsh] = f.read()
+            files = []
+            for url, hsh in downloads:
+                digest = self._digests.get(hsh, hsh)
+                fileName = urlparse(url).path.split('/')[-1]
+                if (self._is_url(digest) or
+                        self._dcm.get(fileName, digest) is not None):
+                    continue
+                files.append((url, os.path.join(tmpDir, fileName), digest))
+            codes = self._dwn.download_many([download[:2]
+                                             for download in files])
+            digests = self._hashUtil.calculate_hashes(
+                [toFile for unused_url, toFile, unused_digest in files
+                 if 200 <= codes.get(toFile, 0) < 300])
+            for url, toFile, digest in files:
+                if toFile in digests:
+                    timing.count(cache_misses=1,
+                                 bytes_downloaded=os.path.getsize(toFile))
+                    if digests[toFile] == digest.split()[0]:
+                        self._dcm.put(os.path.basename(toFile),
+                                      toFile, digest, move=True)
+                    else:
+                        self._log.warning('Digest of [%s] does not match '
+                                          '[%s]', url, digest)
+        finally:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+
+    def _extract(self, fileToInstall, digest, installDir, strip, exclude):
+        """Extract the archive, or link its files from the cache.
+
+        With `FILE_CACHE_UNPACKED` (the default) archives are extracted
+        into the cache once, then their files are hard linked into place.
+        Set `FILE_CACHE_UNPACKED_LINK` to false to copy the files instead.
+        """
+        if not self._ctx.get('FILE_CACHE_UNPACKED', True):
+            return self._unzipUtil.extract(fileToInstall, installDir, strip,
+                                           exclude=exclude)
+        with self._tree_lock(digest, strip, exclude):
+            tree = self._dcm.get_tree(digest, strip, exclude)
+            if tree is None:
+                tree = self._dcm.put_tree(
+                    digest, strip,
+                    lambda toDir: self._unzipUtil.extract(fileToInstall,
+                                                          toDir, strip,
+                                                          exclude=exclude),
+                    exclude)
+        if tree is None:
+            return self._unzipUtil.extract(fileToInstall, installDir, strip,
+                                           exclude=exclude)
+        self._log.info("Linking [%s] into [%s]", tree, installDir)
+        link_tree(tree, installDir,
+                  link=self._ctx.get('FILE_CACHE_UNPACKED_LINK', True))
+        return installDir
+
+    def _fetch_any(self, url, hsh, fileName, verify=False, strip=None,
+                   exclude=()):
+        """Fetch the artifact from the first mirror that has it"""
+        alternatives = self._mirrors.alternatives(url, hsh)
+        for i, (url, hsh) in enumerate(alternatives):
+            try:
+                return self._fetch(url, hsh, fileName, verify, strip,
+                                   exclude)
+            except Exception, e:
+                if i == len(alternatives) - 1:
+                    raise
+                self._log.warning('Download of [%s] failed [%s], trying '
+                                  'the next mirror', url, e)
+
+    def cache_binary(self, url, hsh, fileName=None):
+        """Make sure an artifact is in the cache, return its cached path.
+
+        Unlike installing it, a download that doesn't match the digest
+        is an error.
+        """
+        if not fileName:
+            fileName = urlparse(url).path.split('/')[-1]
+        with timing.Span(fileName, 'binary'):
+            return self._fetch_any(url, hsh, fileName, verify=True)[0]
+
     def install_binary_direct(self, url, hsh, installDir,
                               fileName=None, strip=False,
-                              extract=True):
+                              extract=True, exclude=None):
+        """Install an artifact into installDir, extracting it by default.
+
+        Files in the archive that match one of the `exclude` patterns,
+        relative to installDir, are left out.  See `zips.is_excluded`.
+        """
         self._log.debug("Installing direct [%s]", url)
+        exclude = tuple(exclude or ())
         if not fileName:
             fileName = urlparse(url).path.split('/')[-1]
-        if self._is_url(hsh):
-            digest = self._dwn.download_direct(hsh)
-        else:
-            digest = hsh
         self._log.debug(
-            "Installing [%s] with digest [%s] into [%s] with "
-            "name [%s] stripping [%s]",
-            url, digest, installDir, fileName, strip)
-        fileToInstall = self._dcm.get(fileName, digest)
-        if fileToInstall is None:
-            self._log.debug('File [%s] not in cache.', fileName)
-            fileToInstall = os.path.join(self._ctx['TMPDIR'], fileName)
-            self._dwn.download(url, fileToInstall)
-            digest = self._hashUtil.calculate_hash(fileToInstall)
-            fileToInstall = self._dcm.put(fileName, fileToInstall, digest)
-        if extract:
-            return self._unzipUtil.extract(fileToInstall,
-                                           installDir,
-                                           strip)
-        else:
-            shutil.copy(fileToInstall, installDir)
-            return installDir
+            "Installing [%s] into [%s] with name [%s] stripping [%s]",
+            url, installDir, fileName, strip)
+        with timing.Span(fileName, 'binary'):
+            fileToInstall, digest = self._fetch_any(
+                url, hsh, fileName, strip=(strip if extract else None),
+                exclude=exclude)
+            utils.record_artifact(hsh, digest)
+            if extract:
+                return self._extract(fileToInstall, digest, installDir, strip,
+                                     exclude)
+            else:
+                if os.path.isdir(installDir):
+                    link_or_copy(fileToInstall,
+                                 os.path.join(installDir, fileName))
+                else:
+                    link_or_copy(fileToInstall, installDir)
+                return installDir
 
-    def install_binary(self, installKey):
-        self._log.debug('Installing [%s]', installKey)
+    def binary_urls(self, installKey):
+        """The (url, hashUrl) install_binary would download for a key"""
         url = self._ctx['%s_DOWNLOAD_URL' % installKey]
         hashUrl = self._ctx.get(
             '%s_HASH_DOWNLOAD_URL' % installKey,
             "%s.%s" % (url, self._ctx['CACHE_HASH_ALGORITHM']))
+        return url, hashUrl
+
+    def install_binary(self, installKey):
+        self._log.debug('Installing [%s]', installKey)
+        url, hashUrl = self.binary_urls(installKey)
         installDir = os.path.join(self._ctx['BUILD_DIR'],
                                   self._ctx.get(
                                       '%s_PACKAGE_INSTALL_DIR' % installKey,
                                       installKey.lower()))
         strip = self._ctx.get('%s_STRIP' % installKey, False)
+        exclude = self._ctx.get('%s_EXCLUDE_PATTERNS' % installKey, [])
         return self.install_binary_direct(url, hashUrl, installDir,
-                                          strip=strip)
+                                          strip=strip, exclude=exclude)
 
     def _install_from(self, fromPath, fromLoc, toLocation=None, ignore=None):
         """Copy file or directory from a location to the droplet
@@ -201,6 +493,7 @@ class CloudFoundryInstaller(object):
             safe_makedirs(os.path.dirname(fullPathTo))
             self._log.debug("Copying [%s] to [%s]", fullPathFrom, fullPathTo)
             if os.path.isfile(fullPathFrom):
+                utils.break_hardlink(fullPathTo)
                 shutil.copy(fullPathFrom, fullPathTo)
             else:
                 utils.copytree(fullPathFrom, fullPathTo, ignore=ignore)
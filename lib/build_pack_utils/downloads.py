@@ -1,10 +1,346 @@
+import os
+import sys
+import ssl
+import socket
+import base64
+import httplib
 import urllib2
+import urlparse
 import re
+import json
+import time
+import random
+import tempfile
+import hashlib
 import logging
+import threading
+from functools import partial
 from subprocess import Popen
 from subprocess import PIPE
 
 
+DEFAULT_CHUNK_SIZE = 65536
+
+
+_log = logging.getLogger('downloads')
+_curl_parallel = None
+
+
+class DownloadError(IOError):
+    """A download failed in a way that may work if it is tried again"""
+    pass
+
+
+class SlowDownloadError(IOError):
+    """A download was slower than `DOWNLOAD_MIN_SPEED`.
+
+    This is not retried against the same server, but the installer will
+    try the next mirror if there is one.
+    """
+    pass
+
+
+class ThroughputMonitor(object):
+    """Fails a download that stays below a minimum speed.
+
+    Call with each chunk as it arrives.  Once `window` seconds have passed,
+    the average speed over the window is checked against `minSpeed`
+    (bytes per second) and SlowDownloadError is raised if it is lower.
+    """
+
+    def __init__(self, url, minSpeed, window):
+        self._url = url
+        self._minSpeed = minSpeed
+        self._window = window
+        self._start = time.time()
+        self._bytes = 0
+
+    def __call__(self, buf):
+        self._bytes += len(buf)
+        elapsed = time.time() - self._start
+        if elapsed >= self._window:
+            speed = self._bytes / elapsed
+            if speed < self._minSpeed:
+                raise SlowDownloadError(
+                    'Download of [%s] is too slow [%d bytes/s]'
+                    % (self._url, speed))
+            self._start = time.time()
+            self._bytes = 0
+
+    @staticmethod
+    def from_ctx(ctx, url):
+        """A monitor from `DOWNLOAD_MIN_SPEED`, or None if it's not set"""
+        minSpeed = int(ctx.get('DOWNLOAD_MIN_SPEED', 0))
+        if minSpeed > 0:
+            return ThroughputMonitor(
+                url, minSpeed, float(ctx.get('DOWNLOAD_MIN_SPEED_TIME', 30)))
+
+
+def is_retryable(exc):
+    """Should the download that raised `exc` be tried again?"""
+    if isinstance(exc, urllib2.HTTPError):
+        return exc.code >= 500
+    return isinstance(exc, (DownloadError, urllib2.URLError, socket.error,
+                            httplib.HTTPException))
+
+
+def retry_delay(ctx, attempt):
+    """Seconds to wait before retrying, exponential backoff with jitter.
+
+    The delay is a random value between zero and
+    `DOWNLOAD_RETRY_DELAY * 2 ** attempt`, capped at
+    `DOWNLOAD_RETRY_MAX_DELAY`.
+    """
+    base = float(ctx.get('DOWNLOAD_RETRY_DELAY', 1))
+    cap = float(ctx.get('DOWNLOAD_RETRY_MAX_DELAY', 30))
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def call_with_retries(ctx, url, attempt, onFailure=None):
+    """Call `attempt` until it succeeds or runs out of retries.
+
+    Errors that may go away, like timeouts, dropped connections and 5xx
+    responses, are retried up to `DOWNLOAD_RETRIES` times with a jittered
+    exponential backoff.  Other errors are raised right away.
+    `onFailure` is called with every error.
+    """
+    retries = int(ctx.get('DOWNLOAD_RETRIES', 3))
+    for n in xrange(retries + 1):
+        try:
+            return attempt()
+        except Exception, e:
+            if onFailure:
+                onFailure(e)
+            if n == retries or not is_retryable(e):
+                raise
+            delay = retry_delay(ctx, n)
+            _log.warning('Download of [%s] failed [%s], retrying in '
+                         '%.1f seconds', url, e, delay)
+            time.sleep(delay)
+
+
+class PartialFile(object):
+    """A file being downloaded, which can be resumed after a failure.
+
+    Bytes are written to `path` and fed to the digest as they arrive.
+    When a download fails, the verified length and the response's ETag
+    are recorded in `path + '.part'`, so a later attempt, even from a
+    different process, can continue with a Range request.
+    """
+
+    def __init__(self, path, url, hashAlgorithm):
+        self.path = path
+        self.url = url
+        self.length = 0
+        self.etag = None
+        self._metaPath = '%s.part' % path
+        self._hashAlgorithm = hashAlgorithm
+        self._hsh = hashlib.new(hashAlgorithm)
+
+    def load(self):
+        """Pick up a partial download of the same URL, if there is one"""
+        try:
+            with open(self._metaPath, 'rt') as f:
+                meta = json.load(f)
+            if (meta.get('url') != self.url or
+                    os.path.getsize(self.path) < meta['length']):
+                raise ValueError('partial file does not match')
+        except (IOError, OSError, ValueError, KeyError):
+            self.reset()
+            return self
+        # rebuild the digest from the bytes already verified
+        with open(self.path, 'r+b') as f:
+            f.truncate(meta['length'])
+            for buf in iter(partial(f.read, DEFAULT_CHUNK_SIZE), ''):
+                self._hsh.update(buf)
+        self.length = meta['length']
+        self.etag = meta.get('etag')
+        return self
+
+    def reset(self):
+        """Throw away what has been downloaded and start from zero"""
+        self.length = 0
+        self.etag = None
+        self._hsh = hashlib.new(self._hashAlgorithm)
+        with open(self.path, 'wb'):
+            pass
+        if os.path.exists(self._metaPath):
+            os.remove(self._metaPath)
+
+    def range_headers(self):
+        if self.length == 0:
+            return {}
+        headers = {'Range': 'bytes=%d-' % self.length}
+        if self.etag:
+            headers['If-Range'] = self.etag
+        return headers
+
+    def write_from(self, fileIn, chunkSize=None, listeners=()):
+        """Append the stream to the file, returning the bytes copied.
+
+        Each chunk is passed to the `listeners` before it is written.
+        """
+        size = 0
+        with open(self.path, 'ab') as fileOut:
+            for buf in iter(partial(fileIn.read,
+                                    chunkSize or DEFAULT_CHUNK_SIZE), ''):
+                for listener in listeners:
+                    listener(buf)
+                fileOut.write(buf)
+                self._hsh.update(buf)
+                self.length += len(buf)
+                size += len(buf)
+        return size
+
+    def save(self):
+        """Record the verified length, so the download can be resumed"""
+        with open(self._metaPath, 'wt') as f:
+            json.dump({'url': self.url,
+                       'length': self.length,
+                       'etag': self.etag}, f)
+
+    def discard(self):
+        """Remove the partial file and what was recorded about it"""
+        for path in (self.path, self._metaPath):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def failed(self, exc):
+        """Keep what was downloaded if the error may go away, like a
+        timeout, otherwise there's nothing to resume later.
+        """
+        if is_retryable(exc):
+            self.save()
+        else:
+            self.discard()
+
+    def finish(self):
+        """The download is complete, return its digest"""
+        if os.path.exists(self._metaPath):
+            os.remove(self._metaPath)
+        return self._hsh.hexdigest()
+
+
+class ConnectionPool(object):
+    """Keeps idle HTTP connections open so they can be reused.
+
+    Connections are pooled by (scheme, host, port, proxy), so requests to
+    the same server through the same proxy share a connection.  Host name
+    lookups are cached for the life of the pool.  The pool is thread safe
+    and shared by every Downloader in the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._addrs = {}
+
+    def resolve(self, host, port):
+        """Return the cached list of socket addresses for a host"""
+        with self._lock:
+            addrs = self._addrs.get((host, port))
+        if addrs is None:
+            addrs = [info[4] for info in
+                     socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+            with self._lock:
+                self._addrs[(host, port)] = addrs
+        return addrs
+
+    def get(self, key):
+        """Return an idle connection for the key or None"""
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop()
+
+    def put(self, key, conn, maxIdle):
+        """Return a connection to the pool, closing it if the pool is full"""
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < maxIdle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+            self._addrs.clear()
+
+
+_pool = ConnectionPool()
+
+
+def _create_connection(conn):
+    """Open a socket to conn.host, using the pool's cached addresses"""
+    err = None
+    for addr in _pool.resolve(conn.host, conn.port):
+        try:
+            conn.sock = socket.create_connection(addr, conn.timeout)
+            break
+        except socket.error, e:
+            err = e
+    else:
+        raise err or socket.error('No address for [%s]' % conn.host)
+    # conn.timeout only applies while connecting
+    conn.sock.settimeout(getattr(conn, 'read_timeout', conn.timeout))
+    if getattr(conn, '_tunnel_host', None):
+        conn._tunnel()
+
+
+class _PooledHTTPConnection(httplib.HTTPConnection):
+    def connect(self):
+        _create_connection(self)
+
+
+class _PooledHTTPSConnection(httplib.HTTPSConnection):
+    def connect(self):
+        _create_connection(self)
+        serverName = getattr(self, '_tunnel_host', None) or self.host
+        if hasattr(self, '_context'):
+            self.sock = self._context.wrap_socket(self.sock,
+                                                  server_hostname=serverName)
+        else:
+            self.sock = ssl.wrap_socket(self.sock, self.key_file,
+                                        self.cert_file)
+
+
+class PooledResponse(object):
+    """Response body from a pooled connection.
+
+    Once the body has been read, closing the response returns the
+    connection to the pool.  If it has not been read completely, the
+    connection is closed instead.
+    """
+
+    def __init__(self, key, conn, resp, maxIdle):
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self._maxIdle = maxIdle
+
+    def read(self, amt=None):
+        return self._resp.read(amt)
+
+    def info(self):
+        return self._resp.msg
+
+    def getcode(self):
+        return self._resp.status
+
+    def close(self):
+        if self._conn is None:
+            return
+        if self._resp.isclosed() and not self._resp.will_close:
+            _pool.put(self._key, self._conn, self._maxIdle)
+        else:
+            self._conn.close()
+        self._conn = None
+
+
 class Downloader(object):
 
     def __init__(self, config):
@@ -16,8 +352,9 @@ class Downloader(object):
         handlers = {}
         for key in self._ctx.keys():
             if key.lower().endswith('_proxy'):
-                handlers[key.split('_')[0]] = self._ctx[key]
+                handlers[key.split('_')[0].lower()] = self._ctx[key]
         self._log.debug('Loaded proxy handlers [%s]', handlers)
+        self._proxies = handlers
         openers = []
         if handlers:
             openers.append(urllib2.ProxyHandler(handlers))
@@ -27,54 +364,338 @@ class Downloader(object):
             opener = urllib2.build_opener(*openers)
             urllib2.install_opener(opener)
 
-    def download(self, url, toFile):
-        res = urllib2.urlopen(url)
-        with open(toFile, 'w') as f:
-            f.write(res.read())
-        print 'Downloaded [%s] to [%s]' % (url, toFile)
+    def _split_proxy(self, proxy):
+        if '://' not in proxy:
+            proxy = 'http://%s' % proxy
+        return urlparse.urlsplit(proxy)
+
+    def _new_connection(self, scheme, host, port, proxy):
+        if proxy:
+            proxyUrl = self._split_proxy(proxy)
+            connHost, connPort = proxyUrl.hostname, proxyUrl.port or 80
+        else:
+            connHost, connPort = host, port
+        timeout = float(self._ctx.get('DOWNLOAD_CONNECT_TIMEOUT', 10))
+        if scheme == 'https':
+            conn = _PooledHTTPSConnection(connHost, connPort, timeout=timeout)
+            if proxy:
+                headers = self._proxy_headers(proxy)
+                if hasattr(conn, 'set_tunnel'):
+                    conn.set_tunnel(host, port, headers)
+                else:
+                    conn._set_tunnel(host, port)
+        else:
+            conn = _PooledHTTPConnection(connHost, connPort, timeout=timeout)
+        conn.read_timeout = float(self._ctx.get('DOWNLOAD_READ_TIMEOUT', 60))
+        return conn
+
+    def _proxy_headers(self, proxy):
+        proxyUrl = self._split_proxy(proxy)
+        if proxyUrl.username:
+            creds = '%s:%s' % (urllib2.unquote(proxyUrl.username),
+                               urllib2.unquote(proxyUrl.password or ''))
+            return {'Proxy-Authorization':
+                    'Basic %s' % base64.b64encode(creds)}
+        return {}
+
+    def _open_pooled(self, url, headers=None, redirects=5):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme
+        port = parts.port or (scheme == 'https' and 443 or 80)
+        proxy = self._proxies.get(scheme)
+        key = (scheme, parts.hostname, port, proxy)
+        hdrs = dict(headers or {})
+        if proxy and scheme == 'http':
+            # plain HTTP through a proxy uses the absolute URL
+            path = url
+            hdrs.update(self._proxy_headers(proxy))
+        else:
+            path = urlparse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+        for attempt in (0, 1):
+            # the retry always opens a new connection, other pooled ones
+            #  may be just as stale
+            conn = None
+            if attempt == 0:
+                conn = _pool.get(key)
+            reused = conn is not None
+            if not reused:
+                conn = self._new_connection(scheme, parts.hostname,
+                                            port, proxy)
+            try:
+                conn.request('GET', path, headers=hdrs)
+                resp = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                # the server closed an idle connection, try a new one
+                self._log.debug('Stale connection to [%s], reconnecting',
+                                parts.hostname)
+        res = PooledResponse(key, conn, resp,
+                             int(self._ctx.get('DOWNLOAD_POOL_MAXSIZE', 8)))
+        if resp.status in (301, 302, 303, 307, 308) and redirects > 0:
+            location = urlparse.urljoin(url, resp.getheader('location'))
+            resp.read()
+            res.close()
+            self._log.debug('Following redirect from [%s] to [%s]',
+                            url, location)
+            return self._open(location, headers, redirects - 1)
+        if resp.status >= 400:
+            resp.read()
+            res.close()
+            raise urllib2.HTTPError(url, resp.status, resp.reason,
+                                    resp.msg, None)
+        return res
+
+    def _open(self, url, headers=None, redirects=5):
+        """Open a URL, reusing pooled connections for HTTP and HTTPS.
+
+        Other schemes, like file://, are opened with urllib2.  Pooling can
+        be disabled by setting `DOWNLOAD_KEEP_ALIVE` to false.
+        """
+        if (self._ctx.get('DOWNLOAD_KEEP_ALIVE', True) and
+                urlparse.urlsplit(url).scheme in ('http', 'https')):
+            return self._open_pooled(url, headers, redirects)
+        return urllib2.urlopen(
+            urllib2.Request(url, headers=headers or {}),
+            timeout=float(self._ctx.get('DOWNLOAD_READ_TIMEOUT', 60)))
+
+    def download(self, url, toFile, listeners=()):
+        """Download a file, returning its digest.
+
+        The response is streamed to disk in chunks of `DOWNLOAD_CHUNK_SIZE`
+        bytes, and the digest is calculated with `CACHE_HASH_ALGORITHM` as
+        the bytes arrive.  Each chunk is also passed to the `listeners`.
+        Failed attempts are retried, continuing from the verified length
+        of the partial file with a Range request.
+        """
+        part = PartialFile(toFile, url,
+                           self._ctx['CACHE_HASH_ALGORITHM']).load()
+        chunkSize = int(self._ctx.get('DOWNLOAD_CHUNK_SIZE',
+                                      DEFAULT_CHUNK_SIZE))
+
+        def attempt():
+            if part.length:
+                self._log.info('Resuming [%s] from byte [%d]',
+                               url, part.length)
+            try:
+                res = self._open(url, part.range_headers())
+            except urllib2.HTTPError, e:
+                if e.code != 416:
+                    raise
+                # range not satisfiable, the file changed on the server
+                part.reset()
+                raise DownloadError('Cannot resume [%s]' % url)
+            try:
+                if part.length and res.getcode() != 206:
+                    self._log.debug('Server did not resume [%s]', url)
+                    part.reset()
+                part.etag = res.info().getheader('etag')
+                expected = res.info().getheader('content-length')
+                monitor = ThroughputMonitor.from_ctx(self._ctx, url)
+                size = part.write_from(res, chunkSize,
+                                       (monitor and [monitor] or []) +
+                                       list(listeners))
+            finally:
+                res.close()
+            if expected is not None and size != int(expected):
+                raise DownloadError('Expected [%s] bytes from [%s], got [%d]'
+                                    % (expected, url, size))
+
+        call_with_retries(self._ctx, url, attempt, part.failed)
+        digest = part.finish()
+        # one write per line, downloads may run on several threads
+        sys.stdout.write('Downloaded [%s] to [%s]\n' % (url, toFile))
         self._log.info('Downloaded [%s] to [%s]', url, toFile)
+        self._log.debug('Downloaded [%d] bytes with digest [%s]',
+                        part.length, digest)
+        return digest
 
     def download_direct(self, url):
-        buf = urllib2.urlopen(url).read()
+        def attempt():
+            res = self._open(url)
+            try:
+                return res.read()
+            finally:
+                res.close()
+        buf = call_with_retries(self._ctx, url, attempt)
         self._log.info('Downloaded [%s] to memory', url)
         self._log.debug("Downloaded [%s] [%s]", url, buf)
         return buf
 
 
 class CurlDownloader(object):
+    # could not resolve / connect, timed out, partial file, empty reply,
+    #  send / receive errors
+    RETRYABLE_EXIT_CODES = (6, 7, 18, 28, 52, 55, 56)
 
     def __init__(self, config):
         self._ctx = config
         self._status_pattern = re.compile(r'^(.*)<!-- Status: (\d+) -->$',
                                           re.DOTALL)
+        self._http_error_pattern = re.compile(r'error: (\d{3})')
         self._log = logging.getLogger('downloads')
-
-    def download(self, url, toFile):
-        cmd = ["curl", "-s",
-               "-o", toFile,
-               "-w", '%{http_code}']
+        self._proxy_args = []
         for key in self._ctx.keys():
             if key.lower().endswith('_proxy'):
-                cmd.extend(['-x', self._ctx[key]])
+                self._proxy_args.extend(['-x', self._ctx[key]])
+
+    def _timeout_args(self):
+        # cURL has no read timeout, abort if nothing arrives for that long
+        #  or if the transfer stays below DOWNLOAD_MIN_SPEED
+        minSpeed = int(self._ctx.get('DOWNLOAD_MIN_SPEED', 0))
+        if minSpeed > 0:
+            return ['--connect-timeout',
+                    str(self._ctx.get('DOWNLOAD_CONNECT_TIMEOUT', 10)),
+                    '--speed-limit', str(minSpeed),
+                    '--speed-time',
+                    str(self._ctx.get('DOWNLOAD_MIN_SPEED_TIME', 30))]
+        return ['--connect-timeout',
+                str(self._ctx.get('DOWNLOAD_CONNECT_TIMEOUT', 10)),
+                '--speed-limit', '1',
+                '--speed-time',
+                str(self._ctx.get('DOWNLOAD_READ_TIMEOUT', 60))]
+
+    def _download_once(self, url, part, listeners=()):
+        cmd = ["curl", "-s", "-S", "-f"]
+        cmd.extend(self._timeout_args())
+        if part.length:
+            self._log.info('Resuming [%s] from byte [%d]', url, part.length)
+            cmd.extend(['-C', str(part.length)])
+        cmd.extend(self._proxy_args)
         cmd.append(url)
         self._log.debug("Running [%s]", cmd)
-        proc = Popen(cmd, stdout=PIPE)
-        output, unused_err = proc.communicate()
-        proc.poll()
-        self._log.debug("Curl returned [%s]", output)
-        if output and \
-                (output.startswith('4') or
-                 output.startswith('5')):
-            raise RuntimeError("curl says [%s]" % output)
-        print 'Downloaded [%s] to [%s]' % (url, toFile)
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        try:
+            part.write_from(proc.stdout,
+                            int(self._ctx.get('DOWNLOAD_CHUNK_SIZE',
+                                              DEFAULT_CHUNK_SIZE)),
+                            listeners)
+        except Exception:
+            proc.kill()
+            proc.wait()
+            raise
+        unused_output, err = proc.communicate()
+        retcode = proc.poll()
+        self._log.debug("Curl returned [%s]", retcode)
+        if retcode == 33:
+            # server does not support ranges, start over
+            part.reset()
+            raise DownloadError("curl says [%s] [%s]" % (retcode,
+                                                         err.strip()))
+        elif retcode == 22:
+            m = self._http_error_pattern.search(err)
+            if m and m.group(1).startswith('5'):
+                raise DownloadError("curl says [%s]" % err.strip())
+            raise RuntimeError("curl says [%s] [%s]" % (retcode, err.strip()))
+        elif retcode in self.RETRYABLE_EXIT_CODES:
+            raise DownloadError("curl says [%s] [%s]" % (retcode,
+                                                         err.strip()))
+        elif retcode != 0:
+            raise RuntimeError("curl says [%s] [%s]" % (retcode, err.strip()))
+
+    def download(self, url, toFile, listeners=()):
+        """Download a file, returning its digest.
+
+        cURL writes the response to stdout, which is streamed to disk
+        and hashed in chunks of `DOWNLOAD_CHUNK_SIZE` bytes, and passed
+        to the `listeners`.  With `-f`
+        HTTP errors are reported through cURL's exit code (22).  Failed
+        attempts are retried, resuming the partial file with `-C`.
+        """
+        part = PartialFile(toFile, url,
+                           self._ctx['CACHE_HASH_ALGORITHM']).load()
+        call_with_retries(self._ctx, url,
+                          lambda: self._download_once(url, part, listeners),
+                          part.failed)
+        digest = part.finish()
+        # one write per line, downloads may run on several threads
+        sys.stdout.write('Downloaded [%s] to [%s]\n' % (url, toFile))
         self._log.info('Downloaded [%s] to [%s]', url, toFile)
+        self._log.debug('Downloaded [%d] bytes with digest [%s]',
+                        part.length, digest)
+        return digest
+
+    def _supports_parallel(self):
+        """Does the installed cURL support --parallel (7.66.0+)?"""
+        global _curl_parallel
+        if _curl_parallel is None:
+            try:
+                proc = Popen(['curl', '--version'], stdout=PIPE, stderr=PIPE)
+                output, unused_err = proc.communicate()
+                version = tuple(int(v) for v in
+                                output.split()[1].split('.')[:3])
+                _curl_parallel = version >= (7, 66, 0)
+            except (OSError, IndexError, ValueError):
+                _curl_parallel = False
+            self._log.debug('cURL supports --parallel [%s]', _curl_parallel)
+        return _curl_parallel
+
+    def _quote(self, val):
+        return '"%s"' % val.replace('\\', '\\\\').replace('"', '\\"')
+
+    def download_many(self, downloads):
+        """Download many files with a single cURL process.
+
+        `downloads` is a list of (url, toFile) pairs.  They are written to
+        a cURL config file so connections are reused between transfers.
+        When cURL supports it, up to `DOWNLOAD_BATCH_CONCURRENCY` files (8
+        by default) are transferred in parallel.  Transient errors are
+        retried by cURL itself, up to `DOWNLOAD_RETRIES` times.
+
+        Returns a dictionary of toFile to HTTP status code, where 0 means
+        the transfer failed without a response.  Files for failed
+        transfers are removed.
+        """
+        if not downloads:
+            return {}
+        fd, cfgPath = tempfile.mkstemp(prefix='curl-', suffix='.cfg',
+                                       dir=self._ctx.get('TMPDIR'))
+        with os.fdopen(fd, 'wt') as cfg:
+            for url, toFile in downloads:
+                cfg.write('url = %s\n' % self._quote(url))
+                cfg.write('output = %s\n' % self._quote(toFile))
+        cmd = ["curl", "-s", "-S",
+               "--retry", str(self._ctx.get('DOWNLOAD_RETRIES', 3)),
+               "-w", '%{http_code} %{filename_effective}\\n',
+               "-K", cfgPath]
+        cmd.extend(self._timeout_args())
+        if self._supports_parallel():
+            cmd.extend(['--parallel', '--parallel-max',
+                        str(self._ctx.get('DOWNLOAD_BATCH_CONCURRENCY', 8))])
+        cmd.extend(self._proxy_args)
+        self._log.debug("Running [%s]", cmd)
+        try:
+            proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+            output, err = proc.communicate()
+            self._log.debug("Curl returned [%s] [%s]", proc.poll(), err)
+        finally:
+            os.remove(cfgPath)
+        codes = {}
+        for line in output.splitlines():
+            code, unused_sep, toFile = line.partition(' ')
+            codes[toFile] = code.isdigit() and int(code) or 0
+        results = {}
+        for url, toFile in downloads:
+            code = codes.get(toFile, 0)
+            results[toFile] = code
+            if 200 <= code < 300:
+                sys.stdout.write('Downloaded [%s] to [%s]\n' % (url, toFile))
+                self._log.info('Downloaded [%s] to [%s]', url, toFile)
+            else:
+                self._log.warning('Download of [%s] failed with [%s]',
+                                  url, code)
+                if os.path.exists(toFile):
+                    os.remove(toFile)
+        return results
 
     def download_direct(self, url):
         cmd = ["curl", "-s",
                "-w", '<!-- Status: %{http_code} -->']
-        for key in self._ctx.keys():
-            if key.lower().endswith('_proxy'):
-                cmd.extend(['-x', self._ctx[key]])
+        cmd.extend(self._timeout_args())
+        cmd.extend(self._proxy_args)
         cmd.append(url)
         self._log.debug("Running [%s]", cmd)
         proc = Popen(cmd, stdout=PIPE)
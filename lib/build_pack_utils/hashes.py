@@ -1,8 +1,15 @@
+import os
+import mmap
 import hashlib
 import logging
 from functools import partial
+from multiprocessing import cpu_count
 from subprocess import Popen
 from subprocess import PIPE
+from utils import run_in_parallel
+
+
+HASH_BUFFER_SIZE = 1024 * 1024
 
 
 class HashUtil(object):
@@ -11,22 +18,58 @@ class HashUtil(object):
         self._ctx = config
         self._log = logging.getLogger('hashes')
 
+    def _workers(self):
+        workers = self._ctx.get('HASH_CONCURRENCY')
+        if not workers:
+            try:
+                workers = cpu_count()
+            except NotImplementedError:
+                workers = 1
+        return int(workers)
+
     def calculate_hash(self, checkFile):
         if checkFile is None or checkFile == '':
             return ''
         hsh = hashlib.new(self._ctx['CACHE_HASH_ALGORITHM'])
         with open(checkFile, 'rb') as fileIn:
-            for buf in iter(partial(fileIn.read, 8196), ''):
-                hsh.update(buf)
+            if os.fstat(fileIn.fileno()).st_size > HASH_BUFFER_SIZE:
+                # one call, hashlib releases the GIL while it works
+                data = mmap.mmap(fileIn.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    hsh.update(data)
+                finally:
+                    data.close()
+            else:
+                for buf in iter(partial(fileIn.read, HASH_BUFFER_SIZE), ''):
+                    hsh.update(buf)
         digest = hsh.hexdigest()
         self._log.debug("Hash of [%s] is [%s]", checkFile, digest)
         return digest
 
+    def calculate_hashes(self, checkFiles):
+        """Hash many files at once, returns a dict of file to digest.
+
+        Files are hashed in parallel, up to `HASH_CONCURRENCY` at a time,
+        which defaults to the number of CPUs.  Files that can't be hashed
+        are left out of the result.
+        """
+        digests = {}
+        for checkFile, digest, exc_info in run_in_parallel(
+                self.calculate_hash, checkFiles, self._workers()):
+            if exc_info:
+                self._log.warning("Could not hash [%s] [%s]",
+                                  checkFile, exc_info[1])
+            else:
+                digests[checkFile] = digest
+        return digests
+
     def does_hash_match(self, digest, toFile):
         return (digest.split()[0] == self.calculate_hash(toFile))
 
 
 class ShaHashUtil(HashUtil):
+    # files given to each shasum command
+    BATCH_SIZE = 100
 
     def __init__(self, config):
         HashUtil.__init__(self, config)
@@ -45,3 +88,37 @@ class ShaHashUtil(HashUtil):
             return digest
         elif retcode == 1:
             raise ValueError(err.split('\n')[0])
+
+    def _calculate_batch(self, checkFiles):
+        proc = Popen(["shasum", "-b",
+                      "-a", self._ctx['CACHE_HASH_ALGORITHM'].lstrip('sha')] +
+                     list(checkFiles), stdout=PIPE, stderr=PIPE)
+        output, err = proc.communicate()
+        if err:
+            self._log.warning("shasum said [%s]", err.strip())
+        digests = {}
+        for line in output.splitlines():
+            # <digest> *<file name>
+            digest, sep, checkFile = line.partition(' *')
+            if sep:
+                digests[checkFile] = digest
+        return digests
+
+    def calculate_hashes(self, checkFiles):
+        """Hash many files with a few shasum commands, run in parallel"""
+        checkFiles = [f for f in checkFiles if f]
+        workers = self._workers()
+        # spread the files over the workers, in batches of at most BATCH_SIZE
+        size = max(1, min(self.BATCH_SIZE,
+                          -(-len(checkFiles) // workers)))
+        batches = [checkFiles[i:i + size]
+                   for i in xrange(0, len(checkFiles), size)]
+        digests = {}
+        for batch, batchDigests, exc_info in run_in_parallel(
+                self._calculate_batch, batches, workers):
+            if exc_info:
+                self._log.warning("Could not hash [%d] files [%s]",
+                                  len(batch), exc_info[1])
+            else:
+                digests.update(batchDigests)
+        return digests
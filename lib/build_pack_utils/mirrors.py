@@ -0,0 +1,123 @@
+import os
+import time
+import socket
+import logging
+import threading
+from urlparse import urlsplit
+from utils import run_in_parallel
+
+
+_log = logging.getLogger('mirrors')
+_lock = threading.Lock()
+_rankings = {}
+
+
+class MirrorList(object):
+    """Mirrors of DOWNLOAD_URL, ranked fastest first.
+
+    `DOWNLOAD_MIRRORS` is a list of base URLs that serve the same files
+    as `DOWNLOAD_URL`.  Each entry is either a URL or a dictionary with
+    `url` and an optional `weight`.  `DOWNLOAD_URL` itself is not ranked,
+    it's always kept as the last resort.
+
+    With `DOWNLOAD_MIRROR_SELECTION` set to `fastest` (the default) each
+    mirror is probed once per build by timing a TCP connect, and mirrors
+    are ranked by latency divided by weight.  Set it to `ordered` to use
+    the list as given.  Any URL that starts with `DOWNLOAD_URL` can then
+    be rewritten to each mirror in turn, so every `*_DOWNLOAD_URL` built
+    on `{DOWNLOAD_URL}` fails over without further configuration.
+    """
+
+    def __init__(self, ctx):
+        self._ctx = ctx
+        self._base = ctx.get('DOWNLOAD_URL', '').rstrip('/')
+        self._mirrors = self._load()
+
+    def _load(self):
+        mirrors = []
+        for item in self._ctx.get('DOWNLOAD_MIRRORS', []):
+            if hasattr(item, 'keys'):
+                url, weight = item['url'], float(item.get('weight', 1))
+            else:
+                url, weight = item, 1.0
+            url = self._ctx.format(url).rstrip('/')
+            if (weight > 0 and url != self._base and
+                    url not in [m[0] for m in mirrors]):
+                mirrors.append((url, weight))
+        return mirrors
+
+    def _proxied(self, scheme):
+        for key in self._ctx.keys():
+            if key.lower() == '%s_proxy' % scheme:
+                return True
+        return False
+
+    def _probe(self, mirror):
+        """Seconds to connect to the mirror, None if it's not available"""
+        parts = urlsplit(mirror[0])
+        if parts.scheme == 'file':
+            return os.path.exists(parts.path) and 0.0 or None
+        if self._proxied(parts.scheme):
+            # the proxy is the only thing we could time
+            return 0.0
+        port = parts.port or (parts.scheme == 'https' and 443 or 80)
+        start = time.time()
+        sock = socket.create_connection(
+            (parts.hostname, port),
+            float(self._ctx.get('DOWNLOAD_MIRROR_PROBE_TIMEOUT', 2)))
+        sock.close()
+        return time.time() - start
+
+    def _rank(self):
+        if self._ctx.get('DOWNLOAD_MIRROR_SELECTION', 'fastest') != 'fastest':
+            return [url for url, weight in self._mirrors]
+        scored = []
+        results = run_in_parallel(self._probe, self._mirrors,
+                                  len(self._mirrors))
+        for i, ((url, weight), latency, exc_info) in enumerate(results):
+            if exc_info or latency is None:
+                _log.warning('Mirror [%s] is not reachable', url)
+                score = float('inf')
+            else:
+                _log.debug('Mirror [%s] answered in [%.3f] seconds',
+                           url, latency)
+                score = latency / weight
+            scored.append((score, i, url))
+        scored.sort()
+        return [url for unused, i, url in scored]
+
+    def ranked(self):
+        """The mirror base URLs, best first, then `DOWNLOAD_URL`.
+
+        Mirrors are probed once per process.
+        """
+        ranked = [url for url, weight in self._mirrors]
+        if len(self._mirrors) > 1:
+            key = (tuple(self._mirrors),
+                   self._ctx.get('DOWNLOAD_MIRROR_SELECTION', 'fastest'))
+            with _lock:
+                ranked = _rankings.get(key)
+            if ranked is None:
+                ranked = self._rank()
+                _log.info('Using download mirrors [%s]', ', '.join(ranked))
+                with _lock:
+                    _rankings[key] = ranked
+        if self._base:
+            ranked = ranked + [self._base]
+        return ranked
+
+    def _rewrite(self, url, base):
+        if self._base and url.startswith(self._base + '/'):
+            return base + url[len(self._base):]
+        return url
+
+    def alternatives(self, url, hashUrl):
+        """List of (url, hashUrl) to try for an artifact, best first.
+
+        URLs not under `DOWNLOAD_URL` are returned as they are.
+        """
+        if (not self._base or not self._mirrors or
+                not url.startswith(self._base + '/')):
+            return [(url, hashUrl)]
+        return [(self._rewrite(url, base), self._rewrite(hashUrl, base))
+                for base in self.ranked()]
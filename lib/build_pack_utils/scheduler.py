@@ -0,0 +1,120 @@
+import sys
+import logging
+import timing
+import threading
+from multiprocessing import cpu_count
+
+
+_log = logging.getLogger('scheduler')
+
+
+def overlaps(names, others):
+    """True if a name in `names` and one in `others` are the same, or if
+    one is a path under the other.
+    """
+    for name in names:
+        for other in others:
+            if (name == other or name.startswith(other + '/') or
+                    other.startswith(name + '/')):
+                return True
+    return False
+
+
+class Step(object):
+    """One piece of work for the StepScheduler.
+
+    `inputs` and `outputs` name what the step reads and what it changes,
+    usually paths relative to `BUILD_DIR`, like `php/etc`, or keys of the
+    build pack context.  A path covers everything under it, so `php`
+    overlaps `php/etc`.  Use None for a step that could touch anything.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=()):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs) if inputs is not None else None
+        self.outputs = tuple(outputs) if outputs is not None else None
+        self.waits = set()
+
+    def depends_on(self, other):
+        """True if this step has to run after `other`, added before it"""
+        if (self.inputs is None or self.outputs is None or
+                other.inputs is None or other.outputs is None):
+            return True
+        return (overlaps(other.outputs, self.inputs + self.outputs) or
+                overlaps(other.inputs, self.outputs))
+
+
+class StepScheduler(object):
+    """Runs steps concurrently, in an order that respects their inputs.
+
+    A step waits for the steps added before it that write something it
+    reads or writes, or that read something it writes.  Everything else
+    runs at the same time, up to `workers` steps at once, which defaults
+    to the number of CPUs.  With one worker, steps run in the order they
+    were added.
+    """
+
+    def __init__(self, workers=None):
+        if not workers:
+            try:
+                workers = cpu_count()
+            except NotImplementedError:
+                workers = 1
+        self._workers = max(1, int(workers))
+        self._steps = []
+        self._log = _log
+
+    def add(self, name, func, inputs=(), outputs=()):
+        step = Step(name, func, inputs, outputs)
+        step.waits = set(s for s in self._steps if step.depends_on(s))
+        self._steps.append(step)
+        return self
+
+    def run(self):
+        """Run every step, returns the names in the order they finished.
+
+        When a step fails no more steps are started.  Once the running
+        steps finish, the first error is raised again.
+        """
+        pending = list(self._steps)
+        running = set()
+        done = set()
+        finished = []
+        errors = []
+        cond = threading.Condition()
+
+        def work(step):
+            exc_info = None
+            try:
+                step.func()
+            except Exception:
+                exc_info = sys.exc_info()
+            with cond:
+                running.discard(step)
+                done.add(step)
+                finished.append(step.name)
+                if exc_info:
+                    self._log.error("Step [%s] failed", step.name)
+                    errors.append(exc_info)
+                cond.notify()
+
+        with cond:
+            while pending or running:
+                if not errors:
+                    for step in [s for s in pending if s.waits <= done]:
+                        if len(running) >= self._workers:
+                            break
+                        self._log.debug("Starting step [%s]", step.name)
+                        pending.remove(step)
+                        running.add(step)
+                        thread = threading.Thread(target=timing.bound(work),
+                                                  args=(step,))
+                        thread.daemon = True
+                        thread.start()
+                if not running:
+                    break
+                cond.wait()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return finished
@@ -0,0 +1,222 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import timing
+from utils import ContextRecorder
+from utils import link_tree
+from utils import safe_makedirs
+
+
+_log = logging.getLogger('snapshots')
+
+# the parts of the build pack that decide what a step does
+BP_DIRS = ('bin', 'defaults', 'extensions', 'lib', 'scripts')
+
+
+def _hash_value(val):
+    return hashlib.sha1(json.dumps(val, sort_keys=True,
+                                   default=repr)).hexdigest()
+
+
+def _update(hsh, path):
+    if os.path.islink(path):
+        hsh.update(os.readlink(path))
+    else:
+        with open(path, 'rb') as f:
+            for buf in iter(lambda: f.read(65536), ''):
+                hsh.update(buf)
+
+
+def hash_path(path):
+    """Digest of a file, or of the names and contents of the files under
+    a directory.  None if the path doesn't exist.
+    """
+    if not os.path.lexists(path):
+        return None
+    hsh = hashlib.sha1()
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith('.pyc'):
+                    continue
+                filePath = os.path.join(root, name)
+                hsh.update(os.path.relpath(filePath, path))
+                hsh.update('\0')
+                _update(hsh, filePath)
+    else:
+        _update(hsh, path)
+    return hsh.hexdigest()
+
+
+class StepSnapshots(object):
+    """Saves what build steps produce and restores it on later stages.
+
+    With `INCREMENTAL_RESTAGE` set, running a step records its
+    fingerprint in `CACHE_DIR/snapshots`, along with a snapshot of the
+    paths it wrote.  The fingerprint covers the build pack's own files,
+    the app files the step reads, the value of every context key it
+    reads and the digest of every binary it installs.  When a later
+    stage finds a fingerprint that still matches, the snapshot and the
+    context keys the step set are restored instead of running it.
+    """
+
+    # snapshots kept for each step
+    KEEP = 2
+
+    def __init__(self, ctx, installer):
+        self._ctx = ctx
+        self._installer = installer
+        self._log = _log
+        self._lock = threading.Lock()
+        self._bp = None
+        self._root = None
+        if ctx.get('CACHE_DIR') and ctx.get('INCREMENTAL_RESTAGE', False):
+            self._root = os.path.join(ctx['CACHE_DIR'], 'snapshots')
+
+    def enabled(self):
+        return self._root is not None
+
+    def _bp_hash(self):
+        with self._lock:
+            if self._bp is None:
+                hsh = hashlib.sha1(str(self._ctx.get('STACK')))
+                for name in BP_DIRS:
+                    hsh.update(str(hash_path(
+                        os.path.join(self._ctx['BP_DIR'], name))))
+                self._bp = hsh.hexdigest()
+            return self._bp
+
+    def _hash_inputs(self, inputs):
+        return dict((path, hash_path(os.path.join(self._ctx['BUILD_DIR'],
+                                                  path)))
+                    for path in inputs)
+
+    def _snapshots(self, stepDir):
+        """The step's snapshots, most recently used first"""
+        found = []
+        if os.path.isdir(stepDir):
+            for name in os.listdir(stepDir):
+                record = os.path.join(stepDir, name, 'record.json')
+                if not name.startswith('.') and os.path.isfile(record):
+                    found.append((os.path.getmtime(record),
+                                  os.path.join(stepDir, name)))
+        found.sort(reverse=True)
+        return [snapDir for mtime, snapDir in found]
+
+    def _load(self, snapDir):
+        try:
+            with open(os.path.join(snapDir, 'record.json'), 'rt') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError), e:
+            self._log.debug('Could not read snapshot [%s] [%s]', snapDir, e)
+            return None
+
+    def _matches(self, record, files):
+        if record.get('bp') != self._bp_hash() or record['files'] != files:
+            return False
+        for key, hsh in record['reads'].iteritems():
+            if _hash_value(self._ctx.value(key)) != hsh:
+                self._log.debug('[%s] has changed', key)
+                return False
+        for hashUrl, digest in record['artifacts'].iteritems():
+            try:
+                if self._installer.digest(hashUrl) != digest:
+                    return False
+            except Exception, e:
+                self._log.debug('Could not check [%s] [%s]', hashUrl, e)
+                return False
+        return True
+
+    def _copy(self, src, dst):
+        # never linked, later steps change files like php.ini in place
+        if os.path.isdir(src) and not os.path.islink(src):
+            link_tree(src, dst, link=False)
+        else:
+            safe_makedirs(os.path.dirname(dst))
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+            else:
+                shutil.copy2(src, dst)
+
+    def _restore(self, snapDir, record):
+        for path in record['outputs']:
+            self._copy(os.path.join(snapDir, 'files', path),
+                       os.path.join(self._ctx['BUILD_DIR'], path))
+        for key, val in record['writes'].iteritems():
+            self._ctx[key] = val
+        # mark it as used, for pruning
+        os.utime(os.path.join(snapDir, 'record.json'), None)
+
+    def _save(self, stepDir, recorder, files, outputs):
+        record = {
+            'bp': self._bp_hash(),
+            'files': files,
+            'reads': dict((key, _hash_value(val))
+                          for key, val in recorder.reads.iteritems()),
+            'artifacts': recorder.artifacts,
+            'writes': recorder.writes
+        }
+        try:
+            snapId = _hash_value(json.loads(json.dumps(record)))
+        except (TypeError, ValueError), e:
+            self._log.info('Not saving a snapshot of [%s], it set a value '
+                           'that cannot be saved [%s]',
+                           os.path.basename(stepDir), e)
+            return
+        snapDir = os.path.join(stepDir, snapId)
+        if os.path.isdir(snapDir):
+            return
+        safe_makedirs(stepDir)
+        tmpDir = tempfile.mkdtemp(prefix='.tmp-', dir=stepDir)
+        try:
+            record['outputs'] = []
+            for path in outputs:
+                fullPath = os.path.join(self._ctx['BUILD_DIR'], path)
+                if os.path.lexists(fullPath):
+                    self._copy(fullPath, os.path.join(tmpDir, 'files', path))
+                    record['outputs'].append(path)
+            with open(os.path.join(tmpDir, 'record.json'), 'wt') as f:
+                json.dump(record, f, indent=4, sort_keys=True)
+            os.rename(tmpDir, snapDir)
+            self._log.info('Saved a snapshot of [%s] to [%s]',
+                           os.path.basename(stepDir), snapDir)
+        except OSError, e:
+            # another stage may have saved the same snapshot
+            self._log.info('Could not save a snapshot of [%s] [%s]',
+                           os.path.basename(stepDir), e)
+        finally:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+        for oldDir in self._snapshots(stepDir)[self.KEEP:]:
+            shutil.rmtree(oldDir, ignore_errors=True)
+
+    def run(self, name, func, inputs=(), outputs=()):
+        """Run a step, or restore it from a snapshot if nothing changed.
+
+        `inputs` are the app files the step reads and `outputs` what it
+        writes, both relative to `BUILD_DIR`.  Outputs that aren't files,
+        like context keys, are ignored.
+        """
+        stepDir = os.path.join(self._root, name)
+        files = self._hash_inputs(inputs)
+        for snapDir in self._snapshots(stepDir):
+            record = self._load(snapDir)
+            if record is None or not self._matches(record, files):
+                continue
+            try:
+                with timing.Span('restore %s' % name, 'step'):
+                    self._restore(snapDir, record)
+                print 'Restored %s from an earlier stage' % name
+                return
+            except (IOError, OSError), e:
+                self._log.warning('Could not restore [%s] from [%s], '
+                                  'running it [%s]', name, snapDir, e)
+        with ContextRecorder(self._ctx) as recorder:
+            func()
+        self._save(stepDir, recorder, files, outputs)
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import logging
+import resource
+import threading
+
+
+_log = logging.getLogger('timing')
+_lock = threading.Lock()
+_local = threading.local()
+_start = time.time()
+_spans = []
+_totals = {
+    'bytes_downloaded': 0,
+    'bytes_extracted': 0,
+    'cache_hits': 0,
+    'cache_misses': 0
+}
+
+
+def _peak_rss():
+    """Most memory, in KB, used by this process or a command it ran"""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def count(**kwargs):
+    """Add to the counts of the open spans, like `bytes_downloaded=1024`"""
+    with _lock:
+        for key, val in kwargs.iteritems():
+            _totals[key] = _totals.get(key, 0) + val
+            for span in _stack():
+                span.counts[key] = span.counts.get(key, 0) + val
+
+
+def bound(func):
+    """Wrap `func` so it runs inside the spans open where it was wrapped.
+
+    Use this for work handed to other threads, so the spans they open
+    are nested in the caller's and their counts are added to them.
+    """
+    stack = list(_stack())
+
+    def run(*args, **kwargs):
+        saved = _stack()
+        _local.stack = list(stack)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.stack = saved
+    return run
+
+
+class Span(object):
+    """Times a step of the build, use it with the `with` statement.
+
+    Records the wall time of the step, the counts added with `count`
+    while it's open and how much it raised the peak RSS of the process.
+    The peak only ever grows, so steps that run after the one that set
+    it show no rise.  Spans can be nested, counts are added to every
+    open span.
+    """
+
+    def __init__(self, name, category='step', **args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.counts = {}
+        self.start = None
+        self.seconds = None
+        self.depth = 0
+        self.failed = False
+        self.peak_rss_start = 0
+        self.peak_rss = 0
+        self.peak_rss_rise = 0
+
+    def __enter__(self):
+        stack = _stack()
+        self.thread = threading.current_thread()
+        self.depth = len(stack)
+        stack.append(self)
+        self.peak_rss_start = _peak_rss()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.seconds = time.time() - self.start
+        self.failed = exc_type is not None
+        self.peak_rss = _peak_rss()
+        self.peak_rss_rise = self.peak_rss - self.peak_rss_start
+        stack = _stack()
+        if self in stack:
+            stack.remove(self)
+        with _lock:
+            _spans.append(self)
+        return False
+
+
+def _finished():
+    with _lock:
+        return sorted(_spans, key=lambda s: (s.start, s.depth))
+
+
+def report():
+    """The spans recorded so far and the totals, as a dictionary"""
+    steps = []
+    for span in _finished():
+        step = {
+            'name': span.name,
+            'category': span.category,
+            'thread': span.thread.name,
+            'depth': span.depth,
+            'start': round(span.start - _start, 6),
+            'seconds': round(span.seconds, 6),
+            'process_peak_rss_kb': span.peak_rss,
+            'peak_rss_rise_kb': span.peak_rss_rise,
+            'failed': span.failed
+        }
+        step.update(span.counts)
+        if span.args:
+            step['args'] = span.args
+        steps.append(step)
+    with _lock:
+        totals = dict(_totals)
+    totals['seconds'] = round(time.time() - _start, 6)
+    totals['process_peak_rss_kb'] = _peak_rss()
+    return {'totals': totals, 'steps': steps}
+
+
+def trace():
+    """The spans recorded so far in the Chrome trace event format.
+
+    Load the result in `chrome://tracing` or https://ui.perfetto.dev to
+    see the steps of the build on a time line, one row per thread.
+    """
+    pid = os.getpid()
+    events = []
+    threads = {}
+    for span in _finished():
+        threads[span.thread.ident] = span.thread.name
+        args = dict(span.args)
+        args.update(span.counts)
+        args['process_peak_rss_kb'] = span.peak_rss
+        args['peak_rss_rise_kb'] = span.peak_rss_rise
+        events.append({
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': int((span.start - _start) * 1000000),
+            'dur': int(span.seconds * 1000000),
+            'pid': pid,
+            'tid': span.thread.ident,
+            'args': args
+        })
+    for tid, name in threads.iteritems():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': tid, 'args': {'name': name}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def _size(val):
+    for unit in ('B', 'K', 'M', 'G'):
+        if val < 1024 or unit == 'G':
+            break
+        val /= 1024.0
+    return unit == 'B' and '%d%s' % (val, unit) or '%.1f%s' % (val, unit)
+
+
+def summary(categories=('step', 'extension', 'install'), minimum=0.01):
+    """A table of the spans in the given categories, as a string.
+
+    Spans shorter than `minimum` seconds that didn't download or extract
+    anything are left out.
+    """
+    fmt = '%-44s %9s %10s %10s %8s %9s'
+    lines = [fmt % ('Step', 'Seconds', 'Download', 'Extract',
+                    'Hit/Miss', 'RSS Rise')]
+    for span in _finished():
+        if (span.category not in categories or
+                (span.seconds < minimum and not span.counts)):
+            continue
+        name = '  ' * span.depth + span.name
+        if len(name) > 44:
+            name = name[:41] + '...'
+        lines.append(fmt % (
+            name,
+            '%.3f' % span.seconds,
+            _size(span.counts.get('bytes_downloaded', 0)),
+            _size(span.counts.get('bytes_extracted', 0)),
+            '%d/%d' % (span.counts.get('cache_hits', 0),
+                       span.counts.get('cache_misses', 0)),
+            _size(span.peak_rss_rise * 1024)))
+    totals = report()['totals']
+    lines.append(fmt % (
+        'Total', '%.3f' % totals['seconds'],
+        _size(totals['bytes_downloaded']),
+        _size(totals['bytes_extracted']),
+        '%d/%d' % (totals['cache_hits'], totals['cache_misses']),
+        ''))
+    lines.append('Process peak RSS %s' %
+                 _size(totals['process_peak_rss_kb'] * 1024))
+    return '\n'.join(lines)
+
+
+def write_reports(logDir):
+    """Write `timing.json` and `trace.json` to the directory"""
+    if not os.path.exists(logDir):
+        os.makedirs(logDir)
+    with open(os.path.join(logDir, 'timing.json'), 'wt') as out:
+        json.dump(report(), out, indent=4, sort_keys=True)
+    with open(os.path.join(logDir, 'trace.json'), 'wt') as out:
+        json.dump(trace(), out)
+    _log.info('Wrote timing report to [%s]', logDir)
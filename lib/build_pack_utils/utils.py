@@ -5,11 +5,15 @@ import logging
 import codecs
 import inspect
 import re
+import threading
+import Queue
+import timing
 from string import Template
 from runner import check_output
 
 
 _log = logging.getLogger('utils')
+_recording = threading.local()
 
 
 def safe_makedirs(path):
@@ -21,6 +25,72 @@ def safe_makedirs(path):
             raise e
 
 
+def link_or_copy(src, dst):
+    """Hard link `src` to `dst`, copy it if a link can't be made.
+
+    Like `shutil.copy`, `dst` may be a directory.  Links fail across file
+    systems and on some file systems, in that case the file is copied.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError, e:
+        _log.debug('Could not link [%s] to [%s], copying. %s', src, dst, e)
+        shutil.copy(src, dst)
+    return dst
+
+
+def break_hardlink(path):
+    """Give the file its own copy of its data, if it's hard linked.
+
+    Installed files may be hard linked to the build pack's cache, so they
+    must not be written to in place while the link is shared.
+    """
+    if (os.path.isfile(path) and not os.path.islink(path) and
+            os.stat(path).st_nlink > 1):
+        tmpPath = '%s.%d.tmp' % (path, os.getpid())
+        shutil.copy2(path, tmpPath)
+        os.rename(tmpPath, path)
+
+
+def link_tree(src, dst, link=True):
+    """Recreate the directory tree `src` under `dst`.
+
+    Files are hard linked, or copied if `link` is False or a link can't
+    be made.  Symbolic links are recreated as they are.  Existing files
+    in `dst` are replaced, other files in `dst` are left alone.
+    """
+    for root, dirs, files in os.walk(src):
+        toDir = os.path.normpath(os.path.join(dst,
+                                              os.path.relpath(root, src)))
+        if not os.path.isdir(toDir):
+            safe_makedirs(toDir)
+            shutil.copymode(root, toDir)
+        for name in dirs + files:
+            srcPath = os.path.join(root, name)
+            dstPath = os.path.join(toDir, name)
+            if not os.path.islink(srcPath) and os.path.isdir(srcPath):
+                continue
+            if os.path.lexists(dstPath) and not os.path.isdir(dstPath):
+                os.remove(dstPath)
+            if os.path.islink(srcPath):
+                os.symlink(os.readlink(srcPath), dstPath)
+            elif link:
+                try:
+                    os.link(srcPath, dstPath)
+                except OSError, e:
+                    _log.debug('Could not link [%s], copying. %s',
+                               srcPath, e)
+                    link = False
+                    shutil.copy2(srcPath, dstPath)
+            else:
+                shutil.copy2(srcPath, dstPath)
+    return dst
+
+
 def load_env(path):
     _log.info("Loading environment from [%s]", path)
     env = {}
@@ -66,7 +136,9 @@ def process_extension(path, ctx, to_call, success, args=None, ignore=False):
     extn = load_extension(path)
     try:
         if hasattr(extn, to_call):
-            success(getattr(extn, to_call)(*args))
+            with timing.Span('%s.%s' % (os.path.basename(path), to_call),
+                             'extension'):
+                success(getattr(extn, to_call)(*args))
     except Exception:
         if ignore:
             _log.exception("Error with extension [%s]" % path)
@@ -82,6 +154,7 @@ def process_extensions(ctx, to_call, success, args=None, ignore=False):
 def rewrite_with_template(template, cfgPath, ctx):
     with codecs.open(cfgPath, encoding='utf-8') as fin:
         data = fin.read()
+    break_hardlink(cfgPath)
     with codecs.open(cfgPath, encoding='utf-8', mode='wt') as out:
         out.write(template(data).safe_substitute(ctx))
 
@@ -133,6 +206,70 @@ def wrap(obj):
     return FormattedDictWrapper(obj)
 
 
+def _recorders():
+    if not hasattr(_recording, 'recorders'):
+        _recording.recorders = []
+    return _recording.recorders
+
+
+class ContextRecorder(object):
+    """Records the keys of a context that are read and set.
+
+    Use it with the `with` statement.  While it's open, reads and writes
+    of `ctx` on this thread, and in work handed to `run_in_parallel`, are
+    recorded.  `reads` maps each key read to its value when it was first
+    read, keys the recorded code set itself are left out.  `writes` maps
+    the keys set to their last value and `artifacts` maps the hash URL of
+    each binary installed to its digest.
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.reads = {}
+        self.writes = {}
+        self.artifacts = {}
+
+    def __enter__(self):
+        _recorders().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        recorders = _recorders()
+        if self in recorders:
+            recorders.remove(self)
+        return False
+
+    def read(self, key):
+        if key not in self.reads and key not in self.writes:
+            self.reads[key] = self.ctx.value(key)
+
+    def write(self, key, val):
+        self.writes[key] = val.unwrap() if hasattr(val, 'unwrap') else val
+
+
+def _recorded(ctx):
+    return [r for r in _recorders() if r.ctx is ctx]
+
+
+def record_artifact(hashUrl, digest):
+    """Note that a binary was installed, for the open ContextRecorders"""
+    for recorder in _recorders():
+        recorder.artifacts[hashUrl] = digest
+
+
+def _bind_recorders(func):
+    recorders = list(_recorders())
+
+    def run(*args, **kwargs):
+        saved = _recorders()
+        _recording.recorders = list(recorders)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _recording.recorders = saved
+    return run
+
+
 class FormattedDict(dict):
     def __init__(self, *args, **kwargs):
         dict.__init__(self, *args, **kwargs)
@@ -147,10 +284,28 @@ class FormattedDict(dict):
             return val
         return val.unwrap() if hasattr(val, 'unwrap') else val
 
+    def value(self, key):
+        """The formatted value of a key, None if it's not set.
+
+        Values that can't be formatted on their own, like module URL
+        patterns, are returned as they are.
+        """
+        if not dict.__contains__(self, key):
+            return None
+        val = dict.__getitem__(self, key)
+        try:
+            return self.format(val)
+        except (KeyError, IndexError, ValueError):
+            return val.unwrap() if hasattr(val, 'unwrap') else val
+
     def __getitem__(self, key):
+        for recorder in _recorded(self):
+            recorder.read(key)
         return self.format(dict.__getitem__(self, key))
 
     def get(self, *args, **kwargs):
+        for recorder in _recorded(self):
+            recorder.read(args[0])
         if kwargs.get('format', True):
             return self.format(dict.get(self, *args))
         else:
@@ -164,6 +319,8 @@ class FormattedDict(dict):
             info = caller[1]
             _log.debug('line #%s in %s, "%s" is setting [%s] = [%s]',
                        info[2], info[1], info[3], key, val)
+        for recorder in _recorded(self):
+            recorder.write(key, val)
         dict.__setitem__(self, key, val)
 
 
@@ -201,10 +358,46 @@ class ConfigFileEditor(object):
                 break
 
     def save(self, cfgPath):
+        break_hardlink(cfgPath)
         with open(cfgPath, 'wt') as cfg:
             cfg.writelines(self._lines)
 
 
+def run_in_parallel(func, items, workers=4):
+    """Call `func` on each item using a bounded pool of threads.
+
+    Errors raised by `func` are captured, so one failing item does not
+    stop the others.  Returns a list of (item, result, exc_info) tuples
+    in the same order as `items`, where `exc_info` is None on success.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    # time, count and record the work as part of the caller's step
+    func = timing.bound(_bind_recorders(func))
+    work = Queue.Queue()
+    for i, item in enumerate(items):
+        work.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (item, func(item), None)
+            except Exception:
+                results[i] = (item, None, sys.exc_info())
+    threads = [threading.Thread(target=worker)
+               for n in xrange(max(1, min(int(workers), len(items))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
 def unique(seq):
     """Return only the unique items in the given list, but preserve order"""
     # http://stackoverflow.com/a/480227
@@ -286,6 +479,7 @@ def copytree(src, dst, symlinks=False, ignore=None):
                 copytree(srcname, dstname, symlinks, ignore)
             else:
                 # Will raise a SpecialFileError for unsupported file types
+                break_hardlink(dstname)
                 shutil.copy2(srcname, dstname)
         # catch the Error from the recursive copytree so that we can
         # continue with other files
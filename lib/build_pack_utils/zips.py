@@ -1,13 +1,147 @@
 import os
 import gzip
 import bz2
+import tarfile
 import zipfile
 import shutil
 import logging
-import tempfile
+import timing
+from fnmatch import fnmatch
 from functools import partial
 from subprocess import Popen
 from subprocess import PIPE
+from utils import safe_makedirs
+from utils import run_in_parallel
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Commands that decompress stdin to stdout, by compression.  The parallel
+#  ones come first and are used when they're installed.
+DECOMPRESSORS = {
+    'gz': (('pigz', '-d', '-c'),
+           ('gunzip', '-c')),
+    'bz2': (('lbzip2', '-d', '-c'),
+            ('pbzip2', '-d', '-c'),
+            ('bunzip2', '-c')),
+    'xz': (('pixz', '-d'),
+           ('xz', '-d', '-c', '-T0')),
+    'zst': (('zstd', '-d', '-c', '-q', '-T0'),)
+}
+
+# Tar archives by extension, with their compression
+TAR_EXTENSIONS = (('.tar.gz', 'gz'),
+                  ('.tgz', 'gz'),
+                  ('.tar.bz2', 'bz2'),
+                  ('.tar.xz', 'xz'),
+                  ('.txz', 'xz'),
+                  ('.tar.zst', 'zst'),
+                  ('.tzst', 'zst'),
+                  ('.tar', None))
+
+_commands = {}
+
+
+def is_excluded(path, patterns):
+    """Does one of the patterns match the path, or a directory above it?
+
+    Patterns are shell wildcards, matched a path element at a time, so
+    `*` does not match `/`.  `man` and `man/*` both exclude everything
+    under `man/`, `lib/*.a` excludes static libraries directly in `lib/`.
+    """
+    parts = path.strip('/').split('/')
+    for pattern in patterns:
+        pattern = pattern.strip('/').split('/')
+        if (len(pattern) <= len(parts) and
+                all([fnmatch(part, p) for part, p in zip(parts, pattern)])):
+            return True
+    return False
+
+
+def _tar_exclude_args(patterns, strip):
+    """GNU tar arguments that exclude the same files as is_excluded"""
+    if not patterns:
+        return []
+    args = ['--wildcards', '--anchored', '--no-wildcards-match-slash']
+    for pattern in patterns:
+        # tar matches names before the leading directory is stripped
+        args.append('--exclude=%s%s' % (strip and '*/' or '',
+                                        pattern.strip('/')))
+    return args
+
+
+def _which(cmd):
+    """Full path to the command, or None if it's not on the PATH"""
+    if cmd not in _commands:
+        _commands[cmd] = None
+        for path in os.environ.get('PATH', '').split(os.pathsep):
+            fullPath = os.path.join(path, cmd)
+            if os.path.isfile(fullPath) and os.access(fullPath, os.X_OK):
+                _commands[cmd] = fullPath
+                break
+    return _commands[cmd]
+
+
+class TarStream(object):
+    """Extracts a tar archive from the bytes written to it.
+
+    The bytes are piped through the decompressor and `tar`, which run
+    while the archive is still being written.  Once the pipeline fails,
+    the rest of the bytes are dropped, so the writer is never held up by
+    an error.  Check the result of `close`.
+    """
+
+    def __init__(self, procs, log):
+        self.length = 0
+        self.failed = False
+        self._procs = procs
+        self._stdin = procs[0].stdin
+        self._log = log
+
+    def write(self, buf):
+        if self.failed:
+            return
+        try:
+            self._stdin.write(buf)
+            self.length += len(buf)
+        except IOError, e:
+            self._log.debug('Extraction stopped reading [%s]', e)
+            self.failed = True
+
+    def close(self):
+        """Wait for the extraction to finish, True if it worked"""
+        try:
+            self._stdin.close()
+        except IOError:
+            self.failed = True
+        for proc in self._procs:
+            retcode = proc.wait()
+            if retcode:
+                self._log.debug('Extraction failed with code [%d]', retcode)
+                self.failed = True
+        return not self.failed
+
+    def abort(self):
+        """Stop the extraction, leaving whatever was extracted"""
+        self.failed = True
+        for proc in self._procs:
+            if proc.poll() is None:
+                proc.kill()
+        try:
+            self._stdin.close()
+        except IOError:
+            pass
+        for proc in self._procs:
+            proc.wait()
 
 
 class UnzipUtil(object):
@@ -17,57 +151,95 @@ class UnzipUtil(object):
         self._ctx = config
         self._log = logging.getLogger('zips')
 
-    def _unzip(self, zipFile, intoDir, strip):
+    def _zip_targets(self, members, intoDir, strip, exclude=()):
+        """Map each zip member to where it should be extracted.
+
+        Members that would end up outside of intoDir, or that match one
+        of the exclude patterns, are left out.
+        """
+        names = [m.filename for m in members]
+        firstDir = names and names[0].split('/')[0] or ''
+        if strip:
+            if (all([firstDir == n.split('/')[0] for n in names]) and
+                    any(['/' in n.strip('/') for n in names])):
+                names = ['/'.join(n.split('/')[1:]) for n in names]
+            else:
+                self._log.warn("Zip file does not need stripped")
+        targets = []
+        for member, name in zip(members, names):
+            if not name.strip('/'):
+                continue
+            path = os.path.normpath(name)
+            if os.path.isabs(path) or path.split(os.sep)[0] == '..':
+                self._log.warning('Skipping [%s], it is outside of the '
+                                  'archive', member.filename)
+                continue
+            if is_excluded(name, exclude):
+                continue
+            targets.append((member, os.path.join(intoDir, path),
+                            name.endswith('/')))
+        return targets
+
+    def _unzip_members(self, zipFile, targets):
+        zipIn = zipfile.ZipFile(zipFile, 'r')
+        try:
+            for member, path, unused_isDir in targets:
+                src = zipIn.open(member)
+                try:
+                    with open(path, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+                finally:
+                    src.close()
+        finally:
+            zipIn.close()
+
+    def _unzip(self, zipFile, intoDir, strip, exclude=()):
         """Extract files from a zip archive.
 
         Extract all of the files from the archive into the given
         folder optionally stripping of the first element of the
-        path.
+        path.  Files are written straight to where they belong, a
+        piece at a time, and `ZIP_EXTRACT_CONCURRENCY` files are
+        extracted at the same time (default 1).
 
         Ex: some/file/in/archive.txt -> intoDir/file/in/archive.txt
 
         :param zipFile: full path to zip archive
         :param intoDir: full path to root of extracted files
         :param strip: trim leading element from path in archive
+        :param exclude: patterns of files not to extract, see `is_excluded`
 
         """
-        if strip:
-            tmpDir = tempfile.mkdtemp(prefix='zips-')
-        else:
-            tmpDir = intoDir
-        zipIn = None
+        zipIn = zipfile.ZipFile(zipFile, 'r')
         try:
-            zipIn = zipfile.ZipFile(zipFile, 'r')
-            zipIn.extractall(tmpDir)
-            if strip:
-                members = zipIn.namelist()
-                if len(members) > 0:
-                    firstDir = members[0].split('/')[0]
-                    if all([firstDir == m.split('/')[0] for m in members]):
-                        moveFrom = os.path.join(tmpDir, firstDir)
-                        if os.path.exists(moveFrom) and \
-                           os.path.isdir(moveFrom):
-                            for item in os.listdir(moveFrom):
-                                shutil.move(os.path.join(moveFrom, item),
-                                            intoDir)
-                            return intoDir
-                    self._log.warn("Zip file does not need stripped")
-                    for item in os.listdir(tmpDir):
-                        shutil.move(os.path.join(tmpDir, item), intoDir)
-                    return intoDir
+            targets = self._zip_targets(zipIn.infolist(), intoDir, strip,
+                                        exclude)
         finally:
-            if zipIn:
-                zipIn.close()
-            if intoDir != tmpDir and os.path.exists(tmpDir):
-                shutil.rmtree(tmpDir)
+            zipIn.close()
+        files = []
+        for member, path, isDir in targets:
+            safe_makedirs(isDir and path or os.path.dirname(path))
+            if not isDir:
+                files.append((member, path, isDir))
+        workers = int(self._ctx.get('ZIP_EXTRACT_CONCURRENCY', 1))
+        if workers > 1 and len(files) > 1:
+            # each worker reads the archive with its own ZipFile
+            chunks = [files[i::workers] for i in xrange(workers)]
+            for chunk, unused, exc_info in run_in_parallel(
+                    partial(self._unzip_members, zipFile), chunks, workers):
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+        else:
+            self._unzip_members(zipFile, files)
         return intoDir
 
-    def _gunzip(self, zipFile, intoDir, strip):
+    def _gunzip(self, zipFile, intoDir, strip, exclude=()):
         """Uncompress a gzip'd file.
 
         :param zipFile: full path to gzip'd file
         :param intoDir: full path to directory for uncompressed file
         :param strip: ignored / not applicable
+        :param exclude: ignored / not applicable
 
         """
         path = os.path.join(intoDir, os.path.basename(zipFile)[:-3])
@@ -82,12 +254,13 @@ class UnzipUtil(object):
                 zipIn.close()
         return path
 
-    def _bunzip2(self, zipFile, intoDir, strip):
+    def _bunzip2(self, zipFile, intoDir, strip, exclude=()):
         """Uncompress a bzip2'd file.
 
         :param zipFile: full path to bzip2'd file
         :param intoDir: full path to directory for uncompressed file
         :param strip: ignore / not applicable
+        :param exclude: ignored / not applicable
 
         """
         path = os.path.join(intoDir, os.path.basename(zipFile)[:-4])
@@ -102,7 +275,7 @@ class UnzipUtil(object):
                 zipIn.close()
         return path
 
-    def _tar_bunzip2(self, zipFile, intoDir, strip):
+    def _tar_bunzip2(self, zipFile, intoDir, strip, exclude=()):
         """Extract files from a bzip2'd tar archive.
 
         Extract all of the files from the archive into the given
@@ -114,11 +287,12 @@ class UnzipUtil(object):
         :param zipFile: full path to bzip'd tar archive
         :param intoDir: full path to root of extracted files
         :param strip: set `--strip-components 1` argument to tar
+        :param exclude: patterns of files not to extract, see `is_excluded`
 
         """
-        return self._tar_helper(zipFile, intoDir, 'bz2', strip)
+        return self._tar_helper(zipFile, intoDir, 'bz2', strip, exclude)
 
-    def _tar_gunzip(self, zipFile, intoDir, strip):
+    def _tar_gunzip(self, zipFile, intoDir, strip, exclude=()):
         """Extract files from a gzip'd tar archive.
 
         Extract all of the files from the archive into the given
@@ -130,11 +304,46 @@ class UnzipUtil(object):
         :param zipFile: full path to gzip'd tar archive
         :param intoDir: full path to root of extracted files
         :param strip: set `--strip-components 1` argument to tar
+        :param exclude: patterns of files not to extract, see `is_excluded`
+
+        """
+        return self._tar_helper(zipFile, intoDir, 'gz', strip, exclude)
+
+    def _tar_unxz(self, zipFile, intoDir, strip, exclude=()):
+        """Extract files from an xz'd tar archive.
+
+        Extract all of the files from the archive into the given
+        folder optionally stripping of the first element of the
+        path.
+
+        Ex: some/file/in/archive.txt -> intoDir/file/in/archive.txt
+
+        :param zipFile: full path to xz'd tar archive
+        :param intoDir: full path to root of extracted files
+        :param strip: set `--strip-components 1` argument to tar
+        :param exclude: patterns of files not to extract, see `is_excluded`
+
+        """
+        return self._tar_helper(zipFile, intoDir, 'xz', strip, exclude)
+
+    def _tar_unzstd(self, zipFile, intoDir, strip, exclude=()):
+        """Extract files from a zstd compressed tar archive.
+
+        Extract all of the files from the archive into the given
+        folder optionally stripping of the first element of the
+        path.
+
+        Ex: some/file/in/archive.txt -> intoDir/file/in/archive.txt
+
+        :param zipFile: full path to zstd compressed tar archive
+        :param intoDir: full path to root of extracted files
+        :param strip: set `--strip-components 1` argument to tar
+        :param exclude: patterns of files not to extract, see `is_excluded`
 
         """
-        return self._tar_helper(zipFile, intoDir, 'gz', strip)
+        return self._tar_helper(zipFile, intoDir, 'zst', strip, exclude)
 
-    def _untar(self, zipFile, intoDir, strip):
+    def _untar(self, zipFile, intoDir, strip, exclude=()):
         """Extract files from a tar archive.
 
         Extract all of the files from the archive into the given
@@ -146,57 +355,182 @@ class UnzipUtil(object):
         :param zipFile: full path to tar archive
         :param intoDir: full path to root of extracted files
         :param strip: set `--strip-components 1` argument to tar
+        :param exclude: patterns of files not to extract, see `is_excluded`
 
         """
-        return self._tar_helper(zipFile, intoDir, None, strip)
+        return self._tar_helper(zipFile, intoDir, None, strip, exclude)
+
+    def _decompressor(self, compression):
+        """Pick the command used to decompress, None means use tarfile.
 
-    def _tar_helper(self, zipFile, intoDir, compression, strip):
+        `TAR_DECOMPRESSOR` can be `auto`, the default, which uses the
+        first installed command from `DECOMPRESSORS`, `python` which
+        decompresses in this process, or the name of one of the commands.
+        xz and zstd are only decompressed in this process when the
+        modules for them are installed.
+        """
+        choice = self._ctx.get('TAR_DECOMPRESSOR', 'auto')
+        if choice == 'python':
+            if ((compression == 'xz' and lzma is None) or
+                    (compression == 'zst' and zstandard is None)):
+                return self._decompressor_default(compression)
+            return None
+        for cmd in DECOMPRESSORS.get(compression, ()):
+            if choice in ('auto', cmd[0]) and _which(cmd[0]):
+                return list(cmd)
+        if choice != 'auto':
+            self._log.warning('Decompressor [%s] is not available for '
+                              '[%s], using the default', choice, compression)
+            return self._decompressor_default(compression)
+
+    def _decompressor_default(self, compression):
+        for cmd in DECOMPRESSORS.get(compression, ()):
+            if _which(cmd[0]):
+                return list(cmd)
+
+    def _open_compressed(self, zipFile, compression):
+        """Open an archive that tarfile can't decompress on its own.
+
+        Needs the `lzma` (or `backports.lzma`) module for xz and the
+        `zstandard` module for zstd.
+        """
+        if compression == 'xz' and lzma is not None:
+            return lzma.LZMAFile(zipFile, 'rb')
+        if compression == 'zst' and zstandard is not None:
+            return zstandard.ZstdDecompressor().stream_reader(
+                open(zipFile, 'rb'))
+        cmds = [cmd[0] for cmd in DECOMPRESSORS.get(compression, ())]
+        raise RuntimeError("Cannot decompress [%s], install one of [%s]"
+                           % (zipFile, ', '.join(cmds)))
+
+    def _tar_python(self, zipFile, intoDir, compression, strip, exclude=()):
+        """Extract the archive in this process, streaming it"""
+        self._log.debug('Extracting [%s] with tarfile', zipFile)
+        fileIn = None
+        if compression in ('xz', 'zst'):
+            fileIn = self._open_compressed(zipFile, compression)
+            tar = tarfile.open(fileobj=fileIn, mode='r|')
+        else:
+            tar = tarfile.open(zipFile, 'r|%s' % (compression or ''))
+        try:
+            for member in tar:
+                if strip:
+                    member.name = '/'.join(member.name.split('/')[1:])
+                    if member.islnk():
+                        member.linkname = '/'.join(
+                            member.linkname.split('/')[1:])
+                    if not member.name:
+                        continue
+                name = os.path.normpath(member.name)
+                if os.path.isabs(name) or name.split(os.sep)[0] == '..':
+                    self._log.warning('Skipping [%s], it is outside of the '
+                                      'archive', member.name)
+                    continue
+                if is_excluded(member.name, exclude):
+                    continue
+                tar.extract(member, intoDir)
+        finally:
+            tar.close()
+            if fileIn is not None:
+                fileIn.close()
+        return intoDir
+
+    def _tar_helper(self, zipFile, intoDir, compression, strip, exclude=()):
         """Uncompress and extract files from the archive.
 
         Uncompress and extract all of the files from the archive into
         the given folder, optionally stripping off the first element
-        of the path.
+        of the path.  A parallel decompressor, like `pigz`, is used when
+        one is installed, see `_decompressor`.
 
         :param zipFile: full path to possibly compressed tar archive
         :param intoDir: full path to root of extracted files
-        :param compression: type of compression (None, 'gz' or 'bz2')
+        :param compression: type of compression (None, 'gz', 'bz2', 'xz'
+                            or 'zst')
         :param strip: set `--strip-components 1` argument to tar
+        :param exclude: patterns of files not to extract, see `is_excluded`
 
         """
-        # build command
-        cmd = []
-        if compression == 'gz':
-            cmd.append('gunzip -c %s' % zipFile)
-        elif compression == 'bz2':
-            cmd.append('bunzip2 -c %s' % zipFile)
+        safe_makedirs(intoDir)
+        if not os.path.exists(zipFile):
+            return intoDir
+        unzip = None
+        if compression is not None:
+            unzip = self._decompressor(compression)
+            if unzip is None:
+                return self._tar_python(zipFile, intoDir, compression, strip,
+                                        exclude)
+        tar = ['tar', 'xf', (unzip is None) and zipFile or '-']
         if strip:
-            if compression is None:
-                cmd.append('tar xf %s --strip-components 1' % zipFile)
-            else:
-                cmd.append('tar xf - --strip-components 1')
+            tar.extend(['--strip-components', '1'])
+        tar.extend(_tar_exclude_args(exclude, strip))
+        # run it, from intoDir but without changing this process' cwd so
+        #  that archives can be extracted from multiple threads
+        self._log.debug('Extracting with [%s] [%s]', unzip, tar)
+        if unzip is None:
+            procs = [Popen(tar, stdout=PIPE, cwd=intoDir)]
         else:
-            if compression is None:
-                cmd.append('tar xf %s' % zipFile)
-            else:
-                cmd.append('tar xf -')
-        command = (len(cmd) > 1) and ' | '.join(cmd) or ''.join(cmd)
-        # run it
-        cwd = os.getcwd()
-        try:
-            if not os.path.exists(intoDir):
-                os.makedirs(intoDir)
-            os.chdir(intoDir)
-            if os.path.exists(zipFile):
-                proc = Popen(command, stdout=PIPE, shell=True)
-                output, unused_err = proc.communicate()
-                retcode = proc.poll()
-                if retcode:
-                    raise RuntimeError("Extracting [%s] failed with code [%d]"
-                                       % (zipFile, retcode))
-        finally:
-            os.chdir(cwd)
+            # the archive goes on stdin, given a file name some of the
+            #  decompressors, like pixz, write next to it instead of stdout
+            with open(zipFile, 'rb') as fileIn:
+                unzipProc = Popen(unzip, stdin=fileIn, stdout=PIPE)
+            procs = [unzipProc,
+                     Popen(tar, stdin=unzipProc.stdout, stdout=PIPE,
+                           cwd=intoDir)]
+            # so the decompressor sees a broken pipe if tar quits early
+            unzipProc.stdout.close()
+        procs[-1].communicate()
+        for proc in procs:
+            retcode = proc.wait()
+            if retcode:
+                raise RuntimeError("Extracting [%s] failed with code [%d]"
+                                   % (zipFile, retcode))
         return intoDir
 
+    def stream(self, zipFile, intoDir, strip=False, exclude=()):
+        """Start extracting a tar archive that's yet to be written.
+
+        Returns a `TarStream`, bytes of the archive written to it are
+        extracted into intoDir as they arrive.  Returns None for other
+        archives, or when it would be decompressed with tarfile, those
+        have to be extracted from the complete file.
+
+        :param zipFile: name of the archive, picks the compression
+        :param intoDir: full path to root of extracted files
+        :param strip: set `--strip-components 1` argument to tar
+        :param exclude: patterns of files not to extract, see `is_excluded`
+
+        """
+        for extension, compression in TAR_EXTENSIONS:
+            if zipFile.endswith(extension):
+                break
+        else:
+            return None
+        unzip = None
+        if compression is not None:
+            unzip = self._decompressor(compression)
+            if unzip is None:
+                return None
+        safe_makedirs(intoDir)
+        tar = ['tar', 'xf', '-']
+        if strip:
+            tar.extend(['--strip-components', '1'])
+        tar.extend(_tar_exclude_args(exclude, strip))
+        self._log.debug('Streaming into [%s] with [%s] [%s]',
+                        intoDir, unzip, tar)
+        # failures are expected, the caller falls back to the file
+        with open(os.devnull, 'wb') as devNull:
+            if unzip is None:
+                procs = [Popen(tar, stdin=PIPE, stderr=devNull, cwd=intoDir)]
+            else:
+                unzipProc = Popen(unzip, stdin=PIPE, stdout=PIPE,
+                                  stderr=devNull)
+                procs = [unzipProc,
+                         Popen(tar, stdin=unzipProc.stdout, stderr=devNull,
+                               cwd=intoDir)]
+                unzipProc.stdout.close()
+        return TarStream(procs, self._log)
+
     def _pick_based_on_file_extension(self, zipFile):
         """Pick extraction method based on file extension.
 
@@ -207,6 +541,10 @@ class UnzipUtil(object):
             return self._tar_gunzip
         if zipFile.endswith('.tar.bz2'):
             return self._tar_bunzip2
+        if zipFile.endswith('.tar.xz') or zipFile.endswith('.txz'):
+            return self._tar_unxz
+        if zipFile.endswith('.tar.zst') or zipFile.endswith('.tzst'):
+            return self._tar_unzstd
         if zipFile.endswith('.tar'):
             return self._untar
         if zipFile.endswith('.gz'):
@@ -220,7 +558,8 @@ class UnzipUtil(object):
         if zipFile.endswith('.jar') and zipfile.is_zipfile(zipFile):
             return self._unzip
 
-    def extract(self, zipFile, intoDir, strip=False, method=None):
+    def extract(self, zipFile, intoDir, strip=False, method=None,
+                exclude=None):
         """Extract files from the archive.
 
         Extract all of the files from the given archive.  Files are
@@ -238,6 +577,8 @@ class UnzipUtil(object):
           * _untar
           * _tar_gunzip
           * _tar_bunzip2
+          * _tar_unxz
+          * _tar_unzstd
           * _bunzip2
           * _gunzip
           * _unzip
@@ -252,9 +593,19 @@ class UnzipUtil(object):
                        (Default value = False)
         :param method: method used to extract files from archive
                        (Default value = None)
+        :param exclude: list of patterns, files in the archive that match
+                        one are not extracted, see `is_excluded`.  Passed
+                        to the method as a fourth argument when given.
+                       (Default value = None)
 
         """
         self._log.info("Extracting [%s] into [%s]", zipFile, intoDir)
         if not method:
             method = self._pick_based_on_file_extension(zipFile)
-        return method(zipFile, intoDir, strip)
+        with timing.Span(os.path.basename(zipFile), 'extract'):
+            if os.path.exists(zipFile):
+                timing.count(bytes_extracted=os.path.getsize(zipFile))
+            if exclude:
+                self._log.debug("Excluding [%s]", exclude)
+                return method(zipFile, intoDir, strip, exclude)
+            return method(zipFile, intoDir, strip)
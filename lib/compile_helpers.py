@@ -18,6 +18,9 @@ import json
 import logging
 from collections import defaultdict
 from build_pack_utils import FileUtil
+from build_pack_utils import CloudFoundryInstaller
+from build_pack_utils import timing
+from build_pack_utils.utils import safe_makedirs
 
 
 _log = logging.getLogger('helpers')
@@ -66,6 +69,28 @@ def setup_log_dir(ctx):
     os.makedirs(os.path.join(ctx['BUILD_DIR'], 'logs'))
 
 
+def clean_up_cache(ctx):
+    if not ctx.get('FILE_CACHE_BASE_DIRECTORY', ctx.get('CACHE_DIR')):
+        return
+    # the same cache the binaries were installed from
+    dcm = CloudFoundryInstaller(ctx).cache_manager()
+    if not hasattr(dcm, 'evict') or not hasattr(dcm, 'stats'):
+        _log.info('Cache [%s] has no eviction or stats, leaving it alone',
+                  dcm.__class__.__name__)
+        return
+    dcm.evict()
+    logDir = os.path.join(ctx['BUILD_DIR'], '.bp', 'logs')
+    safe_makedirs(logDir)
+    with open(os.path.join(logDir, 'cache-stats.json'), 'wt') as out:
+        json.dump(dcm.stats(), out, indent=4, sort_keys=True)
+
+
+def write_timing_report(ctx):
+    timing.write_reports(os.path.join(ctx['BUILD_DIR'], '.bp', 'logs'))
+    if ctx.get('TIMING_SUMMARY', False):
+        print timing.summary()
+
+
 def load_binary_index(ctx):
     index_path = os.path.join(ctx['BP_DIR'], 'binaries',
                               ctx['STACK'], 'index-all.json')
@@ -82,7 +107,7 @@ def find_all_php_extensions(index_json):
     exts = defaultdict(list)
     for version, files in index_json['php'].iteritems():
         for f in files:
-            if f.endswith('.tar.gz'):
+            if f.endswith(('.tar.gz', '.tar.xz', '.tar.zst')):
                 tmp = os.path.basename(f).split('-')
                 if len(tmp) == 3 and tmp[1] not in SKIP:
                     exts[version].append(tmp[1])
@@ -21,10 +21,18 @@ class ExtensionHelper(object):
 
     def __init__(self, ctx):
         self._ctx = ctx
-        self._services = self._ctx.get('VCAP_SERVICES', {})
-        self._application = self._ctx.get('VCAP_APPLICATION', {})
         self._merge_defaults()
 
+    @property
+    def _services(self):
+        # read when used, so extensions that don't use them can be
+        #  restored from a snapshot when only the services change
+        return self._ctx.get('VCAP_SERVICES', {})
+
+    @property
+    def _application(self):
+        return self._ctx.get('VCAP_APPLICATION', {})
+
     @classmethod
     def _make_helper(cls, method):
         return lambda ctx: getattr(cls(ctx), method)()
@@ -48,6 +56,12 @@ class ExtensionHelper(object):
             return getattr(inst, 'compile')(install)
         setattr(module, 'compile', extension_helper_wrapper)
 
+        # register 'plan' method, which takes the build plan
+        def extension_helper_plan_wrapper(plan):
+            inst = cls(plan._ctx)
+            return getattr(inst, 'plan')(plan)
+        setattr(module, 'plan', extension_helper_plan_wrapper)
+
     def _merge_defaults(self):
         for key, val in self._defaults().iteritems():
             if key not in self._ctx:
@@ -93,6 +107,16 @@ class ExtensionHelper(object):
         """
         pass
 
+    def _plan(self, plan):
+        """Declare the binaries this extension will install.
+
+        Called when `_should_compile` returns true, before anything is
+        installed.  Add to the plan the packages and modules that
+        `_compile` installs, using the same steps, for example
+        `plan.package('PHP')`.
+        """
+        pass
+
     def _configure(self):
         """Configure the extension.
 
@@ -145,6 +169,15 @@ class ExtensionHelper(object):
         return (self._should_compile() and
                 self._service_environment() or {})
 
+    def plan(self, plan):
+        """Add the binaries this extension installs to the build plan.
+
+        This method maps to the extension's `plan` method.
+        """
+        if self._should_compile():
+            self._plan(plan)
+        return 0
+
     def compile(self, install):
         """Build and install the extension.
 
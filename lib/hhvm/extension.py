@@ -17,6 +17,12 @@ from compile_helpers import find_stand_alone_app_to_run
 from extension_helpers import ExtensionHelper
 
 
+COMPILE_INPUTS = ('.bp-config/hhvm', 'PHP_FPM_LISTEN')
+COMPILE_OUTPUTS = ('hhvm', 'PHP_FPM_LISTEN', 'HHVM_LISTEN_TYPE')
+# restore it from a snapshot on restage, see StepSnapshots
+COMPILE_SNAPSHOT = True
+
+
 class HHVMExtension(ExtensionHelper):
     def _should_compile(self):
         return self._ctx['PHP_VM'] == 'hhvm'
@@ -50,6 +56,9 @@ class HHVMExtension(ExtensionHelper):
             'PATH': "$PATH:$HOME/hhvm/usr/bin"
         }
 
+    def _plan(self, plan):
+        plan.package('HHVM')
+
     def _compile(self, install):
         print 'Installing HHVM'
         print 'HHVM %s' % (self._ctx['HHVM_VERSION'])
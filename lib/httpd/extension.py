@@ -14,6 +14,18 @@
 # limitations under the License.
 
 
+# what compile reads and writes, see StepScheduler
+COMPILE_INPUTS = ('.bp-config/httpd', 'PHP_FPM_LISTEN')
+COMPILE_OUTPUTS = ('httpd',)
+# restore it from a snapshot on restage, see StepSnapshots
+COMPILE_SNAPSHOT = True
+
+
+def configure(ctx):
+    # set here, not in compile, so PHP can be installed at the same time
+    ctx['PHP_FPM_LISTEN'] = '127.0.0.1:9000'
+
+
 def preprocess_commands(ctx):
     return ((
         '$HOME/.bp/bin/rewrite',
@@ -36,10 +48,9 @@ def service_environment(ctx):
     }
 
 
-def compile(install):
-    print 'Installing HTTPD'
-    install.builder._ctx['PHP_FPM_LISTEN'] = '127.0.0.1:9000'
-    (install
+def _install(install):
+    # shared by plan and compile, so the plan matches what's installed
+    return (install
         .package('HTTPD')
         .config()
             .from_application('.bp-config/httpd')  # noqa
@@ -52,4 +63,14 @@ def compile(install):
             .find_modules_with_regex('^LoadModule .* modules/(.*).so$')
             .from_application('httpd/conf')
             .done())
+
+
+def plan(plan):
+    _install(plan)
+    return 0
+
+
+def compile(install):
+    print 'Installing HTTPD'
+    _install(install)
     return 0
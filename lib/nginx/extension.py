@@ -14,6 +14,16 @@
 # limitations under the License.
 
 
+COMPILE_INPUTS = ('.bp-config/nginx', 'PHP_FPM_LISTEN')
+COMPILE_OUTPUTS = ('nginx',)
+# restore it from a snapshot on restage, see StepSnapshots
+COMPILE_SNAPSHOT = True
+
+
+def configure(ctx):
+    ctx['PHP_FPM_LISTEN'] = '{TMPDIR}/php-fpm.socket'
+
+
 def preprocess_commands(ctx):
     return ((
         '$HOME/.bp/bin/rewrite',
@@ -32,9 +42,13 @@ def service_environment(ctx):
     return {}
 
 
+def plan(plan):
+    plan.package('NGINX')
+    return 0
+
+
 def compile(install):
     print 'Installing Nginx'
-    install.builder._ctx['PHP_FPM_LISTEN'] = '{TMPDIR}/php-fpm.socket'
     (install
         .package('NGINX')
         .config()
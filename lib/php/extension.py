@@ -23,6 +23,12 @@ from compile_helpers import validate_php_extensions
 from extension_helpers import ExtensionHelper
 
 
+COMPILE_INPUTS = ('.bp-config/php', 'PHP_FPM_LISTEN')
+COMPILE_OUTPUTS = ('php', 'PHP_VERSION', 'PHP_EXTENSIONS', 'ZEND_EXTENSIONS')
+# restore it from a snapshot on restage, see StepSnapshots
+COMPILE_SNAPSHOT = True
+
+
 class PHPExtension(ExtensionHelper):
     def _should_compile(self):
         return self._ctx['PHP_VM'] == 'php'
@@ -63,14 +69,9 @@ class PHPExtension(ExtensionHelper):
             env['MIBDIRS'] = '$HOME/php/mibs'
         return env
 
-    def _compile(self, install):
-        print 'Installing PHP'
-        ctx = install.builder._ctx
-        validate_php_version(ctx)
-        validate_php_extensions(ctx)
-        convert_php_extensions(ctx)
-        print 'PHP %s' % (ctx['PHP_VERSION'])
-        (install
+    def _install(self, install):
+        """Install PHP with an Installer, or add it to a BuildPlan"""
+        return (install
             .package('PHP')
             .config()
                 .from_application('.bp-config/php')  # noqa
@@ -86,8 +87,22 @@ class PHPExtension(ExtensionHelper):
                 .find_modules_with_regex('^zend_extension="(?:.*/)?(.*).so"$')
                 .from_application('php/etc/php.ini')
                 .include_modules_from('PHP_MODULES')
-                .include_module(is_web_app(ctx) and 'fpm' or 'cli')
+                .include_module(is_web_app(self._ctx) and 'fpm' or 'cli')
                 .done())
+
+    def _plan(self, plan):
+        validate_php_version(self._ctx)
+        validate_php_extensions(self._ctx)
+        convert_php_extensions(self._ctx)
+        self._install(plan)
+
+    def _compile(self, install):
+        print 'Installing PHP'
+        validate_php_version(self._ctx)
+        validate_php_extensions(self._ctx)
+        convert_php_extensions(self._ctx)
+        print 'PHP %s' % (self._ctx['PHP_VERSION'])
+        self._install(install)
         return 0
 
 
@@ -14,28 +14,20 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import sys
 from datetime import datetime
 from build_pack_utils import Builder
 from compile_helpers import setup_webdir_if_it_doesnt_exist
 from compile_helpers import setup_log_dir
 from compile_helpers import log_bp_version
+from compile_helpers import clean_up_cache
+from compile_helpers import write_timing_report
 
 
-if __name__ == '__main__':
-    (Builder()
-        .configure()
-            .default_config()  # noqa
-            .stack_config()
-            .user_config()
-            .done()
-        .execute()
-            .method(log_bp_version)
-        .execute()
-            .method(setup_webdir_if_it_doesnt_exist)
-        .execute()
-            .method(setup_log_dir)
+def register_extensions(builder):
+    return (builder
         .register()
-            .extension()
+            .extension()  # noqa
                 .from_build_pack('lib/{WEB_SERVER}')
             .extension()
                 .from_build_pack('lib/php')
@@ -49,6 +41,38 @@ if __name__ == '__main__':
                 .from_application('.extensions')
             .extension()
                 .from_build_pack('lib/additional_commands')
+            .done())
+
+
+if __name__ == '__main__':
+    # with --plan, print the binaries the build would install and stop
+    planOnly = '--plan' in sys.argv
+    if planOnly:
+        sys.argv.remove('--plan')
+    builder = (Builder()
+        .configure()
+            .default_config()  # noqa
+            .stack_config()
+            .user_config()
+            .done())
+    if planOnly:
+        (register_extensions(builder)
+            .plan()
+                .extensions()  # noqa
+                .write()
+                .done())
+        sys.exit(0)
+    (builder
+        .execute()
+            .method(log_bp_version)  # noqa
+        .execute()
+            .method(setup_webdir_if_it_doesnt_exist)
+        .execute()
+            .method(setup_log_dir))
+    (register_extensions(builder)
+        .plan()
+            .extensions()  # noqa
+            .fetch()
             .done()
         .install()
             .build_pack_utils()
@@ -65,7 +89,11 @@ if __name__ == '__main__':
             .runtime_environment()
             .process_list()
             .done()
+        .execute()
+            .method(clean_up_cache)
         .create_start_script()
             .using_process_manager()
-            .write())
+            .write()
+        .execute()
+            .method(write_timing_report))
     print 'Finished: [%s]' % datetime.now()
@@ -0,0 +1,100 @@
+import re
+import socket
+import threading
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.opened(self.connection)
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body='', headers=()):
+        self.send_response(code)
+        for key, val in headers:
+            self.send_header(key, val)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path,
+                                     dict(self.headers.items())))
+        if self.path in self.server.redirects:
+            return self._reply(302, headers=[
+                ('Location', self.server.redirects[self.path])])
+        body = self.server.files.get(self.path)
+        if body is None:
+            return self._reply(404, 'not found')
+        m = re.match(r'bytes=(\d+)-$', self.headers.get('range', ''))
+        if m and int(m.group(1)) < len(body):
+            start = int(m.group(1))
+            return self._reply(206, body[start:], [
+                ('Content-Range', 'bytes %d-%d/%d' % (start, len(body) - 1,
+                                                      len(body)))])
+        self._reply(200, body)
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        self.server.requests.append((self.command, self.path,
+                                     dict(self.headers.items())))
+        length = int(self.headers.get('content-length', 0))
+        self.server.files[self.path] = self.rfile.read(length)
+        self._reply(201)
+
+
+class FileServer(ThreadingMixIn, HTTPServer):
+    """A local HTTP/1.1 server with keep-alive, for download tests.
+
+    `files` maps request paths to the bodies served, `redirects` maps
+    paths to the Location they are redirected to.  Every request is
+    recorded in `requests` and every connection in `connections`.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.files = {}
+        self.redirects = {}
+        self.requests = []
+        self.connections = []
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        args=(0.05,))
+        self._thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def opened(self, sock):
+        self.connections.append(sock)
+
+    def handle_error(self, request, client_address):
+        # clients closing their connections is expected
+        pass
+
+    def drop_connections(self):
+        """Close the kept alive connections, like an idle timeout"""
+        for sock in self.connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.drop_connections()
+        self.server_close()
@@ -0,0 +1,130 @@
+import os
+import os.path
+import imp
+import json
+import hashlib
+import tempfile
+import shutil
+from nose.tools import eq_
+from common.server import FileServer
+from build_pack_utils import downloads
+
+
+BPDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def load_binaries():
+    # bin/binaries is a script, load it without writing bytecode to bin/
+    module = imp.new_module('binaries')
+    execfile(os.path.join(BPDIR, 'bin', 'binaries'), module.__dict__)
+    module.BPDIR = BPDIR
+    return module
+
+
+binaries = load_binaries()
+
+
+class TestSelectFiles(object):
+    def setUp(self):
+        self.bins = {
+            'php': {
+                '5.5.22': ['u/php-5.5.22.tar.gz',
+                           'u/php-5.5.22.tar.gz.sha1',
+                           'u/php-curl-5.5.22.tar.gz',
+                           'u/php-gd-5.5.22.tar.gz'],
+                '5.6.6': ['u/php-5.6.6.tar.gz',
+                          'u/php-curl-5.6.6.tar.gz']
+            },
+            'httpd': {
+                '2.4.12': ['u/httpd-2.4.12.tar.gz',
+                           'u/httpd-proxy-2.4.12.tar.gz']
+            }
+        }
+
+    def select(self, *args):
+        return [os.path.basename(url)
+                for url in binaries.select_files(self.bins, *args)]
+
+    def test_all_files(self):
+        eq_(['httpd-2.4.12.tar.gz', 'httpd-proxy-2.4.12.tar.gz',
+             'php-5.5.22.tar.gz', 'php-curl-5.5.22.tar.gz',
+             'php-gd-5.5.22.tar.gz', 'php-5.6.6.tar.gz',
+             'php-curl-5.6.6.tar.gz'], self.select())
+
+    def test_package_and_version(self):
+        eq_(['php-5.6.6.tar.gz', 'php-curl-5.6.6.tar.gz'],
+            self.select(['php'], ['5.6']))
+
+    def test_extensions(self):
+        eq_(['httpd-2.4.12.tar.gz', 'php-5.5.22.tar.gz',
+             'php-curl-5.5.22.tar.gz', 'php-5.6.6.tar.gz',
+             'php-curl-5.6.6.tar.gz'], self.select(None, None, ['curl']))
+
+
+class TestWarmCache(object):
+    def setUp(self):
+        downloads._pool.clear()
+        self.tmp_dir = tempfile.mkdtemp(prefix='warm-cache-')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.server = FileServer().start()
+        self.bins = {'php': {'5.6.6': []}}
+        for name in ('php-5.6.6.tar.gz', 'php-curl-5.6.6.tar.gz'):
+            self.add('/php/5.6.6/%s' % name, name)
+        self.index = self.write('index.json', self.bins)
+
+    def tearDown(self):
+        downloads._pool.clear()
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def add(self, path, body, digest=None):
+        self.server.files[path] = body
+        self.server.files[path + '.sha1'] = '%s  %s\n' % (
+            digest or hashlib.sha1(body).hexdigest(), os.path.basename(path))
+        self.bins['php']['5.6.6'].append(self.server.url + path)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wt') as f:
+            json.dump(data, f)
+        return path
+
+    def cached(self):
+        found = []
+        for root, dirs, files in os.walk(os.path.join(self.cache_dir,
+                                                      'objects')):
+            found.extend(f for f in files if not f.startswith('.'))
+        return sorted(found)
+
+    def test_warm_cache(self):
+        eq_([], binaries.warm_cache(self.cache_dir, 'trusty', self.index,
+                                    workers=2))
+        eq_(['php-5.6.6.tar.gz', 'php-curl-5.6.6.tar.gz'], self.cached())
+        # a warm cache downloads nothing again
+        requests = len(self.server.requests)
+        eq_([], binaries.warm_cache(self.cache_dir, 'trusty', self.index))
+        eq_(['/php/5.6.6/php-5.6.6.tar.gz.sha1',
+             '/php/5.6.6/php-curl-5.6.6.tar.gz.sha1'],
+            sorted(path for method, path, headers
+                   in self.server.requests[requests:]))
+
+    def test_filtered(self):
+        eq_([], binaries.warm_cache(self.cache_dir, 'trusty', self.index,
+                                    extensions=['gd']))
+        eq_(['php-5.6.6.tar.gz'], self.cached())
+
+    def test_wrong_digest_fails(self):
+        self.add('/php/5.6.6/php-gd-5.6.6.tar.gz', 'gd',
+                 hashlib.sha1('other').hexdigest())
+        self.index = self.write('index.json', self.bins)
+        eq_([self.server.url + '/php/5.6.6/php-gd-5.6.6.tar.gz'],
+            binaries.warm_cache(self.cache_dir, 'trusty', self.index))
+        eq_(['php-5.6.6.tar.gz', 'php-curl-5.6.6.tar.gz'], self.cached())
+
+    def test_plan(self):
+        url = self.server.url + '/php/5.6.6/php-curl-5.6.6.tar.gz'
+        plan = self.write('plan.json', {'artifacts': [
+            {'url': url, 'hash_url': url + '.sha1'}]})
+        eq_([], binaries.warm_cache(self.cache_dir, 'trusty', self.index,
+                                    plan=plan))
+        eq_(['php-curl-5.6.6.tar.gz'], self.cached())
@@ -0,0 +1,117 @@
+import os
+import os.path
+import hashlib
+import tempfile
+import shutil
+from dingus import Dingus
+from nose.tools import eq_
+from common.server import FileServer
+from build_pack_utils import utils
+from build_pack_utils import downloads
+from build_pack_utils.builder import Builder
+from build_pack_utils.builder import BuildPlan
+from build_pack_utils.builder import FileUtil
+from build_pack_utils.builder import Installer
+
+
+class TestFileUtil(object):
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp(prefix='build-')
+        self.builder = Dingus(_ctx=utils.FormattedDict({
+            'BUILD_DIR': self.build_dir
+        }))
+        for path in ('index.php', 'a/b/page.php', 'lib/test.php'):
+            self.touch(path)
+        for path in ('a/empty', 'lib/vendor/empty'):
+            os.makedirs(os.path.join(self.build_dir, path))
+
+    def tearDown(self):
+        if os.path.exists(self.build_dir):
+            shutil.rmtree(self.build_dir)
+
+    def touch(self, path):
+        fullPath = os.path.join(self.build_dir, path)
+        if not os.path.exists(os.path.dirname(fullPath)):
+            os.makedirs(os.path.dirname(fullPath))
+        open(fullPath, 'wt').close()
+
+    def exists(self, *args):
+        return os.path.exists(os.path.join(self.build_dir, *args))
+
+    def test_move_with_exclude(self):
+        (FileUtil(self.builder, move=True)
+            .under('BUILD_DIR')
+            .into('htdocs')
+            .where_name_does_not_match(
+                '^%s/.*$' % os.path.join(self.build_dir, 'lib'))
+            .done())
+        eq_(True, self.exists('htdocs', 'index.php'))
+        eq_(True, self.exists('htdocs', 'a', 'b', 'page.php'))
+        # directories that were moved out of, or were empty, are removed
+        eq_(False, self.exists('a'))
+        eq_(False, self.exists('index.php'))
+        # the excluded library is left as it is
+        eq_(True, self.exists('lib', 'test.php'))
+        eq_(True, self.exists('lib', 'vendor', 'empty'))
+        eq_(False, self.exists('htdocs', 'lib'))
+
+    def test_copy_with_exclude(self):
+        (FileUtil(self.builder)
+            .under('BUILD_DIR')
+            .into('htdocs')
+            .where_name_does_not_match(
+                '^%s/.*$' % os.path.join(self.build_dir, 'lib'))
+            .done())
+        eq_(True, self.exists('htdocs', 'index.php'))
+        eq_(True, self.exists('htdocs', 'a', 'b', 'page.php'))
+        eq_(True, self.exists('index.php'))
+        eq_(True, self.exists('a', 'empty'))
+        eq_(False, self.exists('htdocs', 'lib'))
+
+    def test_any_true_walks_excluded_directories(self):
+        (FileUtil(self.builder)
+            .under('BUILD_DIR')
+            .into('htdocs')
+            .where_name_does_not_match(
+                '^%s/.*$' % os.path.join(self.build_dir, 'lib'))
+            .where_name_is('test.php')
+            .any_true()
+            .done())
+        eq_(True, self.exists('htdocs', 'index.php'))
+        eq_(True, self.exists('htdocs', 'lib', 'test.php'))
+
+
+class TestBuildPlan(object):
+    def setUp(self):
+        downloads._pool.clear()
+        self.tmp_dir = tempfile.mkdtemp(prefix='plan-')
+        os.makedirs(os.path.join(self.tmp_dir, 'tmp'))
+        self.server = FileServer().start()
+        self.server.files['/php.tar.gz'] = 'php'
+        self.server.files['/php.tar.gz.sha1'] = hashlib.sha1(
+            'php').hexdigest()
+        self.url = self.server.url + '/php.tar.gz'
+        self.builder = Builder()
+        self.builder._ctx = utils.FormattedDict({
+            'BUILD_DIR': os.path.join(self.tmp_dir, 'build'),
+            'CACHE_DIR': os.path.join(self.tmp_dir, 'cache'),
+            'TMPDIR': os.path.join(self.tmp_dir, 'tmp'),
+            'CACHE_HASH_ALGORITHM': 'sha1'
+        })
+
+    def tearDown(self):
+        downloads._pool.clear()
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_install_uses_the_planned_digests(self):
+        (BuildPlan(self.builder)
+            .binary('php', self.url, self.url + '.sha1')
+            .fetch())
+        installDir = os.path.join(self.tmp_dir, 'build', 'php')
+        os.makedirs(installDir)
+        Installer(self.builder)._installer.install_binary_direct(
+            self.url, self.url + '.sha1', installDir, extract=False)
+        eq_('php', open(os.path.join(installDir, 'php.tar.gz')).read())
+        eq_(['/php.tar.gz', '/php.tar.gz.sha1'],
+            sorted(path for method, path, headers in self.server.requests))
@@ -0,0 +1,455 @@
+import os
+import os.path
+import imp
+import time
+import socket
+import urllib2
+import hashlib
+import threading
+import tempfile
+import shutil
+from nose.tools import eq_
+from nose.tools import raises
+from build_pack_utils import utils
+from build_pack_utils import cache
+from build_pack_utils.cache import DirectoryCacheManager
+from build_pack_utils.cache import HttpCacheManager
+from build_pack_utils.cache import _parse_size
+from build_pack_utils.cache import tree_name
+from build_pack_utils.cache import FileLock
+
+
+def load_cache_server():
+    # bin/cache-server is a script, load it without writing bytecode to bin/
+    path = os.path.join(os.path.dirname(__file__), '..', 'bin',
+                        'cache-server')
+    module = imp.new_module('cache_server')
+    execfile(path, module.__dict__)
+    return module
+
+
+cache_server = load_cache_server()
+
+
+class TestDirectoryCacheManager(object):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='cache-')
+        self.tmp_dir = tempfile.mkdtemp(prefix='files-')
+        self.ctx = utils.FormattedDict({
+            'CACHE_DIR': self.cache_dir,
+            'CACHE_HASH_ALGORITHM': 'sha1'
+        })
+        self.dcm = DirectoryCacheManager(self.ctx)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def file(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path, hashlib.sha1(data).hexdigest()
+
+    def test_put_and_get(self):
+        path, digest = self.file('php.tar.gz', 'php')
+        cached = self.dcm.put('php.tar.gz', path, digest)
+        eq_(os.path.join(self.cache_dir, 'objects', 'sha1', digest[:2],
+                         digest, 'php.tar.gz'), cached)
+        eq_(True, os.path.exists(path))
+        eq_(cached, self.dcm.get('php.tar.gz', digest))
+        # hash files may hold the file name after the digest
+        eq_(cached, self.dcm.get('php.tar.gz',
+                                 '%s  php.tar.gz' % digest.upper()))
+        eq_('php', open(cached).read())
+
+    def test_get_miss(self):
+        path, digest = self.file('php.tar.gz', 'php')
+        self.dcm.put('php.tar.gz', path, digest)
+        eq_(None, self.dcm.get('php.tar.gz', hashlib.sha1('x').hexdigest()))
+        eq_(None, self.dcm.get('other.tar.gz', ''))
+
+    def test_put_move(self):
+        path, digest = self.file('php.tar.gz', 'php')
+        cached = self.dcm.put('php.tar.gz', path, digest, move=True)
+        eq_(False, os.path.exists(path))
+        eq_('php', open(cached).read())
+
+    def test_same_contents_are_linked(self):
+        path, digest = self.file('a.tar.gz', 'same')
+        first = self.dcm.put('a.tar.gz', path, digest)
+        second = self.dcm.get('b.tar.gz', digest)
+        eq_(os.stat(first).st_ino, os.stat(second).st_ino)
+
+    def test_migrate(self):
+        legacy = os.path.join(self.cache_dir, 'php.tar.gz')
+        with open(legacy, 'wb') as f:
+            f.write('php')
+        digest = hashlib.sha1('php').hexdigest()
+        cached = self.dcm.get('php.tar.gz', digest)
+        eq_(os.path.join(self.cache_dir, 'objects', 'sha1', digest[:2],
+                         digest, 'php.tar.gz'), cached)
+        eq_(False, os.path.exists(legacy))
+
+    def test_migrate_wrong_digest(self):
+        legacy = os.path.join(self.cache_dir, 'php.tar.gz')
+        with open(legacy, 'wb') as f:
+            f.write('old php')
+        eq_(None, self.dcm.get('php.tar.gz', hashlib.sha1('php').hexdigest()))
+        eq_(True, os.path.exists(legacy))
+
+    def test_same_name_other_contents(self):
+        path, first = self.file('php.tar.gz', 'cflinuxfs2')
+        self.dcm.put('php.tar.gz', path, first)
+        path, second = self.file('php.tar.gz', 'trusty')
+        self.dcm.put('php.tar.gz', path, second)
+        eq_('cflinuxfs2', open(self.dcm.get('php.tar.gz', first)).read())
+        eq_('trusty', open(self.dcm.get('php.tar.gz', second)).read())
+
+    def test_delete(self):
+        path, digest = self.file('php.tar.gz', 'php')
+        self.dcm.put('php.tar.gz', path, digest)
+        self.dcm.delete('php.tar.gz')
+        eq_(False, self.dcm.exists('php.tar.gz', digest))
+        eq_(None, self.dcm.get('php.tar.gz', digest))
+
+    def test_corrupt_file_is_a_miss(self):
+        path, digest = self.file('php.tar.gz', 'php')
+        cached = self.dcm.put('php.tar.gz', path, digest)
+        with open(cached, 'wb') as f:
+            f.write('corrupt')
+        eq_(None, self.dcm.get('php.tar.gz', digest))
+
+    def test_hit_is_not_hashed_again(self):
+        path, digest = self.file('php.tar.gz', 'php')
+        self.dcm.put('php.tar.gz', path, digest)
+        hashed = []
+        calculate_hash = self.dcm._hashUtil.calculate_hash
+
+        def counting(checkFile):
+            hashed.append(checkFile)
+            return calculate_hash(checkFile)
+        self.dcm._hashUtil.calculate_hash = counting
+        cached = self.dcm.get('php.tar.gz', digest)
+        eq_(cached, self.dcm.get('php.tar.gz', digest))
+        eq_([], hashed)
+        # a changed file is hashed again
+        os.utime(cached, (0, 0))
+        eq_(cached, self.dcm.get('php.tar.gz', digest))
+        eq_([cached], hashed)
+        eq_(cached, self.dcm.get('php.tar.gz', digest))
+        eq_([cached], hashed)
+
+    def test_verify(self):
+        path, digest = self.file('a.tar.gz', 'a')
+        good = self.dcm.put('a.tar.gz', path, digest)
+        path, digest = self.file('b.tar.gz', 'b')
+        bad = self.dcm.put('b.tar.gz', path, digest)
+        with open(bad, 'wb') as f:
+            f.write('corrupt')
+        eq_((2, [bad]), self.dcm.verify())
+        eq_(True, os.path.exists(good))
+        eq_(False, os.path.exists(bad))
+
+    def test_evict_least_recently_used(self):
+        path, old = self.file('old.tar.gz', 'o' * 100)
+        self.dcm.put('old.tar.gz', path, old)
+        path, new = self.file('new.tar.gz', 'n' * 100)
+        self.dcm.put('new.tar.gz', path, new)
+        self.dcm.get('new.tar.gz', new)
+        self.ctx['FILE_CACHE_MAX_SIZE'] = 150
+        eq_([old], self.dcm.evict())
+        eq_(None, self.dcm.get('old.tar.gz', old))
+        eq_(False, os.path.exists(
+            os.path.join(self.cache_dir, 'names', 'old.tar.gz')))
+        assert self.dcm.get('new.tar.gz', new) is not None
+
+    def test_evict_least_frequently_used(self):
+        path, rare = self.file('rare.tar.gz', 'r' * 100)
+        self.dcm.put('rare.tar.gz', path, rare)
+        path, often = self.file('often.tar.gz', 'o' * 100)
+        self.dcm.put('often.tar.gz', path, often)
+        self.dcm.get('often.tar.gz', often)
+        self.dcm.get('often.tar.gz', often)
+        # used more often, but not as recently
+        self.dcm.get('rare.tar.gz', rare)
+        self.ctx['FILE_CACHE_MAX_SIZE'] = 150
+        self.ctx['FILE_CACHE_EVICTION'] = 'lfu'
+        eq_([rare], self.dcm.evict())
+
+    def test_evict_without_max_size(self):
+        path, digest = self.file('php.tar.gz', 'php')
+        self.dcm.put('php.tar.gz', path, digest)
+        eq_([], self.dcm.evict())
+        assert self.dcm.get('php.tar.gz', digest) is not None
+
+    def test_stats(self):
+        path, digest = self.file('php.tar.gz', 'php')
+        self.dcm.put('php.tar.gz', path, digest)
+        self.ctx['FILE_CACHE_MAX_SIZE'] = '1K'
+        stats = self.dcm.stats()
+        eq_((1, 3, 1024), (stats['entries'], stats['size'],
+                           stats['max_size']))
+
+    def test_parse_size(self):
+        eq_(1024, _parse_size(1024))
+        eq_(1024, _parse_size('1024'))
+        eq_(500 * 1024 ** 2, _parse_size('500M'))
+        eq_(2 * 1024 ** 3, _parse_size('2gb'))
+        eq_(1536, _parse_size('1.5K'))
+
+    def test_put_and_get_tree(self):
+        digest = hashlib.sha1('php').hexdigest()
+        eq_(None, self.dcm.get_tree(digest, True))
+
+        def extract(toDir):
+            os.makedirs(os.path.join(toDir, 'bin'))
+            open(os.path.join(toDir, 'bin', 'php'), 'wt').close()
+        tree = self.dcm.put_tree(digest, True, extract)
+        eq_(os.path.join(self.cache_dir, 'trees', 'sha1',
+                         tree_name(digest, True)), tree)
+        eq_(True, os.path.exists(os.path.join(tree, 'bin', 'php')))
+        eq_(tree, self.dcm.get_tree(digest, True))
+        # extracted another way, it's another tree
+        eq_(None, self.dcm.get_tree(digest, False))
+        eq_(None, self.dcm.get_tree(digest, True, ('man',)))
+
+    @raises(ValueError)
+    def test_put_tree_failed(self):
+        digest = hashlib.sha1('php').hexdigest()
+
+        def extract(toDir):
+            raise ValueError('broken archive')
+        try:
+            self.dcm.put_tree(digest, False, extract)
+        finally:
+            eq_(None, self.dcm.get_tree(digest, False))
+            eq_([], os.listdir(os.path.join(self.cache_dir, 'trees',
+                                            'sha1')))
+
+    def test_evict_tree(self):
+        digest = hashlib.sha1('php').hexdigest()
+
+        def extract(toDir):
+            with open(os.path.join(toDir, 'php'), 'wt') as f:
+                f.write('p' * 100)
+        tree = self.dcm.put_tree(digest, True, extract)
+        self.ctx['FILE_CACHE_MAX_SIZE'] = 50
+        self.dcm.evict()
+        eq_(False, os.path.exists(tree))
+        eq_(None, self.dcm.get_tree(digest, True))
+
+
+class TestTreeName(object):
+    def test_tree_name(self):
+        eq_('abc-0', tree_name('abc', False))
+        eq_('abc-1', tree_name('abc  file.tar.gz', True))
+        eq_(tree_name('abc', True, ('man', 'doc')),
+            tree_name('abc', True, ('doc', 'man')))
+        assert tree_name('abc', True, ('man',)) != tree_name('abc', True)
+
+
+class TestFileLock(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='locks-')
+        self.path = os.path.join(self.tmp_dir, 'php.tar.gz.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_waits_for_the_holder(self):
+        events = []
+        held = threading.Event()
+
+        def holder():
+            with FileLock(self.path):
+                held.set()
+                time.sleep(0.3)
+                events.append('released')
+        thread = threading.Thread(target=holder)
+        thread.start()
+        held.wait(5)
+        with FileLock(self.path, timeout=5):
+            events.append('acquired')
+        thread.join()
+        eq_(['released', 'acquired'], events)
+
+    def test_gives_up_after_timeout(self):
+        lock = FileLock(self.path)
+        eq_(True, lock.acquire())
+        try:
+            start = time.time()
+            other = FileLock(self.path, timeout=0.2)
+            eq_(False, other.acquire())
+            assert time.time() - start >= 0.2
+            # the block still runs, without the lock
+            with other:
+                pass
+        finally:
+            lock.release()
+        eq_(True, other.acquire())
+        other.release()
+
+    def test_cache_lock(self):
+        dcm = DirectoryCacheManager(utils.FormattedDict({
+            'CACHE_DIR': self.tmp_dir,
+            'FILE_CACHE_LOCK_TIMEOUT': 0.1
+        }))
+        with dcm.lock('php.tar.gz'):
+            eq_(True, os.path.exists(os.path.join(self.tmp_dir, 'locks',
+                                                  'php.tar.gz.lock')))
+            eq_(False, dcm.lock('php.tar.gz').acquire())
+            other = dcm.lock('httpd.tar.gz')
+            eq_(True, other.acquire())
+            other.release()
+
+
+class QuietCacheHandler(cache_server.CacheHandler):
+    def log_message(self, *args):
+        pass
+
+
+class SharedCache(object):
+    def setUp(self):
+        urllib2.install_opener(None)
+        self.tmp_dir = tempfile.mkdtemp(prefix='http-cache-')
+        self.root = os.path.join(self.tmp_dir, 'server')
+        self.server = cache_server.CacheServer(('127.0.0.1', 0), self.root,
+                                               'Basic c2VjcmV0')
+        self.server.RequestHandlerClass = QuietCacheHandler
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.data = 'php' * 1000
+        self.digest = hashlib.sha1(self.data).hexdigest()
+        self.path = os.path.join(self.tmp_dir, 'php.tar.gz')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.stats = dict(cache._stats)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def manager(self, name, **kwargs):
+        ctx = {
+            'CACHE_DIR': os.path.join(self.tmp_dir, name),
+            'CACHE_HASH_ALGORITHM': 'sha1',
+            'FILE_CACHE_URL': 'http://127.0.0.1:%d/' %
+                              self.server.server_address[1],
+            'FILE_CACHE_AUTH': 'Basic c2VjcmV0'
+        }
+        ctx.update(kwargs)
+        return HttpCacheManager(utils.FormattedDict(ctx))
+
+    def stored(self, digest=None):
+        digest = digest or self.digest
+        return os.path.join(self.root, 'sha1', digest[:2], digest)
+
+    def counted(self, key):
+        return cache._stats[key] - self.stats[key]
+
+
+class TestHttpCacheManager(SharedCache):
+    def test_put_sends_to_shared_cache(self):
+        self.manager('one').put('php.tar.gz', self.path, self.digest)
+        eq_(self.data, open(self.stored()).read())
+
+    def test_get_from_shared_cache(self):
+        self.manager('one').put('php.tar.gz', self.path, self.digest)
+        other = self.manager('two')
+        path = other.get('php.tar.gz', self.digest)
+        eq_(os.path.join(self.tmp_dir, 'two', 'objects', 'sha1',
+                         self.digest[:2], self.digest, 'php.tar.gz'), path)
+        eq_(self.data, open(path).read())
+        eq_(1, self.counted('remote_hits'))
+        # now a local hit
+        os.remove(self.stored())
+        eq_(path, other.get('php.tar.gz', self.digest))
+        eq_(1, self.counted('remote_hits'))
+
+    def test_get_miss(self):
+        eq_(None, self.manager('one').get('php.tar.gz', self.digest))
+        eq_(1, self.counted('remote_misses'))
+        eq_([], os.listdir(os.path.join(self.tmp_dir, 'one', 'objects',
+                                        'sha1')))
+
+    def test_get_wrong_digest_is_a_miss(self):
+        os.makedirs(os.path.dirname(self.stored()))
+        with open(self.stored(), 'wb') as f:
+            f.write('not php')
+        eq_(None, self.manager('one').get('php.tar.gz', self.digest))
+        eq_(1, self.counted('remote_misses'))
+        eq_([], os.listdir(os.path.join(self.tmp_dir, 'one', 'objects',
+                                        'sha1')))
+
+    def test_without_write_back(self):
+        dcm = self.manager('one', FILE_CACHE_WRITE_BACK=False)
+        path = dcm.put('php.tar.gz', self.path, self.digest)
+        eq_(False, os.path.exists(self.stored()))
+        eq_(path, dcm.get('php.tar.gz', self.digest))
+
+    def test_wrong_auth(self):
+        dcm = self.manager('one', FILE_CACHE_AUTH='Basic d3Jvbmc=')
+        path = dcm.put('php.tar.gz', self.path, self.digest)
+        eq_(self.data, open(path).read())
+        eq_(False, os.path.exists(self.stored()))
+        self.manager('two').put('php.tar.gz', self.path, self.digest)
+        eq_(None, self.manager('three', FILE_CACHE_AUTH='').get(
+            'php.tar.gz', self.digest))
+
+    def test_shared_cache_down(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        dcm = self.manager('one', FILE_CACHE_URL='http://127.0.0.1:%d' % port,
+                           FILE_CACHE_TIMEOUT=1)
+        eq_(None, dcm.get('php.tar.gz', self.digest))
+        path = dcm.put('php.tar.gz', self.path, self.digest)
+        eq_(path, dcm.get('php.tar.gz', self.digest))
+
+
+class TestCacheServer(SharedCache):
+    def request(self, method, path, data=None, auth='Basic c2VjcmV0'):
+        req = urllib2.Request('http://127.0.0.1:%d%s' % (
+            self.server.server_address[1], path), data)
+        req.get_method = lambda: method
+        if auth:
+            req.add_header('Authorization', auth)
+        try:
+            res = urllib2.urlopen(req, timeout=5)
+            try:
+                return res.getcode(), res.read()
+            finally:
+                res.close()
+        except urllib2.HTTPError, e:
+            return e.code, None
+
+    def test_put_and_get(self):
+        path = '/sha1/%s' % self.digest
+        eq_((404, None), self.request('GET', path))
+        eq_(201, self.request('PUT', path, self.data)[0])
+        eq_((200, self.data), self.request('GET', path))
+        eq_((200, ''), self.request('HEAD', path))
+
+    def test_put_wrong_digest(self):
+        path = '/sha1/%s' % hashlib.sha1('x').hexdigest()
+        eq_(422, self.request('PUT', path, self.data)[0])
+        eq_(False, os.path.exists(self.stored(hashlib.sha1('x').hexdigest())))
+        eq_([], os.listdir(os.path.dirname(self.stored(
+            hashlib.sha1('x').hexdigest()))))
+
+    def test_wrong_auth(self):
+        path = '/sha1/%s' % self.digest
+        eq_(401, self.request('PUT', path, self.data, auth=None)[0])
+        eq_(401, self.request('GET', path, auth='Basic d3Jvbmc=')[0])
+        eq_(False, os.path.exists(self.stored()))
+
+    def test_bad_path(self):
+        eq_(400, self.request('GET', '/sha1/../../etc/passwd')[0])
+        eq_(400, self.request('PUT', '/rot13/%s' % self.digest,
+                              self.data)[0])
+        eq_(400, self.request('GET', '/sha1/XYZ')[0])
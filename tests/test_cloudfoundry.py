@@ -0,0 +1,314 @@
+import os
+import os.path
+import json
+import hashlib
+import tarfile
+import tempfile
+import shutil
+import threading
+import zipfile
+from StringIO import StringIO
+from nose.tools import eq_
+from nose.tools import raises
+from common.server import FileServer
+from build_pack_utils import utils
+from build_pack_utils import downloads
+from build_pack_utils.cloudfoundry import CloudFoundryInstaller
+
+
+def make_tar(path, names):
+    tar = tarfile.open(path, 'w:gz')
+    try:
+        for name in names:
+            info = tarfile.TarInfo(name)
+            info.size = len(name)
+            tar.addfile(info, StringIO(name))
+    finally:
+        tar.close()
+    return path
+
+
+def sha1_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class LocalArchive(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='cloudfoundry-')
+        for name in ('bp', 'cache', 'tmp', 'build'):
+            os.makedirs(os.path.join(self.tmp_dir, name))
+        self.archive = make_tar(
+            os.path.join(self.tmp_dir, 'bp', 'php.tar.gz'),
+            ['php/bin/php', 'php/etc/php.ini'])
+        self.digest = sha1_file(self.archive)
+        self.url = 'file://%s' % self.archive
+        self.install_dir = os.path.join(self.tmp_dir, 'build', 'php')
+        self.ctx = utils.FormattedDict({
+            'BUILD_DIR': os.path.join(self.tmp_dir, 'build'),
+            'CACHE_DIR': os.path.join(self.tmp_dir, 'cache'),
+            'TMPDIR': os.path.join(self.tmp_dir, 'tmp'),
+            'CACHE_HASH_ALGORITHM': 'sha1'
+        })
+        self.installer = CloudFoundryInstaller(self.ctx)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def cached(self):
+        found = []
+        for root, dirs, files in os.walk(self.ctx['CACHE_DIR']):
+            found.extend(files)
+        return found
+
+
+class TestFetchLocal(LocalArchive):
+    def test_fetch_local(self):
+        eq_((self.archive, self.digest),
+            self.installer._fetch_local(self.url, self.digest))
+        eq_([], os.listdir(self.ctx['TMPDIR']))
+        eq_([], self.cached())
+
+    def test_fetch_local_hash_url(self):
+        with open(self.archive + '.sha1', 'wt') as f:
+            f.write('%s  php.tar.gz\n' % self.digest)
+        eq_(self.archive, self.installer._fetch_local(
+            self.url, self.url + '.sha1')[0])
+
+    @raises(RuntimeError)
+    def test_fetch_local_wrong_digest(self):
+        self.installer._fetch_local(self.url, hashlib.sha1('x').hexdigest())
+
+    @raises(IOError)
+    def test_fetch_local_missing(self):
+        self.installer._fetch_local(self.url + '.missing', self.digest)
+
+    def test_install_extracts_in_place(self):
+        self.ctx['FILE_CACHE_UNPACKED'] = False
+        self.installer.install_binary_direct(self.url, self.digest,
+                                             self.install_dir, strip=True)
+        eq_(True, os.path.exists(os.path.join(self.install_dir, 'bin',
+                                              'php')))
+        eq_([], os.listdir(self.ctx['TMPDIR']))
+        eq_([], self.cached())
+
+    def test_install_without_extracting_links(self):
+        os.makedirs(self.install_dir)
+        self.installer.install_binary_direct(self.url, self.digest,
+                                             self.install_dir, extract=False)
+        eq_(os.stat(self.archive).st_ino,
+            os.stat(os.path.join(self.install_dir, 'php.tar.gz')).st_ino)
+
+
+class TestExtractedTrees(LocalArchive):
+    def test_install_links_the_extracted_tree(self):
+        extracted = []
+        extract = self.installer._unzipUtil.extract
+
+        def counting(*args, **kwargs):
+            extracted.append(args[0])
+            return extract(*args, **kwargs)
+        self.installer._unzipUtil.extract = counting
+        self.installer.install_binary_direct(self.url, self.digest,
+                                             self.install_dir, strip=True)
+        other = os.path.join(self.tmp_dir, 'build', 'other')
+        self.installer.install_binary_direct(self.url, self.digest, other,
+                                             strip=True)
+        eq_(1, len(extracted))
+        tree = self.installer.cache_manager().get_tree(self.digest, True)
+        for installDir in (self.install_dir, other):
+            eq_(os.stat(os.path.join(tree, 'bin', 'php')).st_ino,
+                os.stat(os.path.join(installDir, 'bin', 'php')).st_ino)
+
+    def test_install_copies_the_extracted_tree(self):
+        self.ctx['FILE_CACHE_UNPACKED_LINK'] = False
+        self.installer.install_binary_direct(self.url, self.digest,
+                                             self.install_dir, strip=True)
+        tree = self.installer.cache_manager().get_tree(self.digest, True)
+        assert (os.stat(os.path.join(tree, 'bin', 'php')).st_ino !=
+                os.stat(os.path.join(self.install_dir, 'bin',
+                                     'php')).st_ino)
+
+
+class TestSharedCache(object):
+    def setUp(self):
+        downloads._pool.clear()
+        self.tmp_dir = tempfile.mkdtemp(prefix='cloudfoundry-')
+        self.server = FileServer().start()
+        self.body = 'php' * 100000
+        self.server.files['/php.tar.gz'] = self.body
+        self.digest = hashlib.sha1(self.body).hexdigest()
+
+    def tearDown(self):
+        downloads._pool.clear()
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def installer(self, name):
+        tmpDir = os.path.join(self.tmp_dir, name)
+        os.makedirs(tmpDir)
+        return CloudFoundryInstaller(utils.FormattedDict({
+            'CACHE_DIR': os.path.join(self.tmp_dir, 'cache'),
+            'TMPDIR': tmpDir,
+            'CACHE_HASH_ALGORITHM': 'sha1'
+        }))
+
+    def test_one_stage_downloads(self):
+        results = []
+
+        def stage(name):
+            results.append(self.installer(name).cache_binary(
+                self.server.url + '/php.tar.gz', self.digest))
+        threads = [threading.Thread(target=stage, args=('stage-%d' % i,))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(1, len(self.server.requests))
+        eq_(3, len(results))
+        eq_(1, len(set(results)))
+        eq_(self.body, open(results[0]).read())
+
+
+class TestPipelinedDownloads(object):
+    def setUp(self):
+        downloads._pool.clear()
+        self.tmp_dir = tempfile.mkdtemp(prefix='cloudfoundry-')
+        self.server = FileServer().start()
+        archive = make_tar(os.path.join(self.tmp_dir, 'php.tar.gz'),
+                           ['php/bin/php', 'php/man/php.1'])
+        with open(archive, 'rb') as f:
+            self.server.files['/php.tar.gz'] = f.read()
+        self.digest = sha1_file(archive)
+        self.url = self.server.url + '/php.tar.gz'
+        self.install_dir = os.path.join(self.tmp_dir, 'build', 'php')
+        os.makedirs(os.path.join(self.tmp_dir, 'tmp'))
+        self.installer = CloudFoundryInstaller(utils.FormattedDict({
+            'CACHE_DIR': os.path.join(self.tmp_dir, 'cache'),
+            'TMPDIR': os.path.join(self.tmp_dir, 'tmp'),
+            'CACHE_HASH_ALGORITHM': 'sha1',
+            'DOWNLOAD_PIPELINE': True
+        }))
+        self.extracted = []
+        extract = self.installer._unzipUtil.extract
+
+        def counting(*args, **kwargs):
+            self.extracted.append(args[0])
+            return extract(*args, **kwargs)
+        self.installer._unzipUtil.extract = counting
+
+    def tearDown(self):
+        downloads._pool.clear()
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def installed(self):
+        found = []
+        for root, dirs, files in os.walk(self.install_dir):
+            found.extend([os.path.relpath(os.path.join(root, f),
+                                          self.install_dir) for f in files])
+        return sorted(found)
+
+    def test_extracts_while_downloading(self):
+        self.installer.install_binary_direct(self.url, self.digest,
+                                             self.install_dir, strip=True,
+                                             exclude=['man'])
+        eq_(['bin/php'], self.installed())
+        eq_([], self.extracted)
+        eq_(1, len(self.server.requests))
+        dcm = self.installer.cache_manager()
+        assert dcm.get_tree(self.digest, True, ['man']) is not None
+        assert dcm.get('php.tar.gz', self.digest) is not None
+
+    def test_wrong_digest_extracts_the_download(self):
+        expected = hashlib.sha1('other').hexdigest()
+        self.installer.install_binary_direct(self.url, expected,
+                                             self.install_dir, strip=True)
+        eq_(['bin/php', 'man/php.1'], self.installed())
+        eq_(1, len(self.extracted))
+        eq_(None, self.installer.cache_manager().get_tree(expected, True))
+
+    def test_archive_that_cannot_be_streamed(self):
+        path = os.path.join(self.tmp_dir, 'php.zip')
+        zf = zipfile.ZipFile(path, 'w')
+        try:
+            zf.writestr('php/bin/php', 'php')
+        finally:
+            zf.close()
+        with open(path, 'rb') as f:
+            self.server.files['/php.zip'] = f.read()
+        self.installer.install_binary_direct(self.server.url + '/php.zip',
+                                             sha1_file(path),
+                                             self.install_dir, strip=True)
+        eq_(['bin/php'], self.installed())
+        eq_(1, len(self.extracted))
+        eq_(1, len(self.server.requests))
+
+    def test_can_pipeline(self):
+        toFile = os.path.join(self.tmp_dir, 'tmp', 'php.tar.gz')
+        eq_(True, self.installer._can_pipeline(toFile, self.digest))
+        eq_(False, self.installer._can_pipeline(toFile, self.url + '.sha1'))
+        open(toFile + '.part', 'wb').close()
+        eq_(False, self.installer._can_pipeline(toFile, self.digest))
+
+
+class TestDefaultExcludes(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='cloudfoundry-')
+        for name in ('cache', 'tmp', 'build'):
+            os.makedirs(os.path.join(self.tmp_dir, name))
+        options = os.path.join(os.path.dirname(__file__), '..', 'defaults',
+                               'options.json')
+        self.ctx = utils.FormattedDict(json.load(open(options, 'rt')))
+        self.ctx.update({
+            'DOWNLOAD_URL': 'file://%s' % os.path.join(self.tmp_dir,
+                                                       'binaries'),
+            'BUILD_DIR': os.path.join(self.tmp_dir, 'build'),
+            'CACHE_DIR': os.path.join(self.tmp_dir, 'cache'),
+            'TMPDIR': os.path.join(self.tmp_dir, 'tmp')
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def install(self, installKey, names):
+        url = self.ctx['%s_DOWNLOAD_URL' % installKey][len('file://'):]
+        os.makedirs(os.path.dirname(url))
+        make_tar(url, names)
+        with open(url + '.sha1', 'wt') as out:
+            out.write(sha1_file(url))
+        CloudFoundryInstaller(self.ctx).install_binary(installKey)
+        installDir = os.path.join(self.tmp_dir, 'build',
+                                  installKey.lower())
+        found = []
+        for root, dirs, files in os.walk(installDir):
+            found.extend([os.path.relpath(os.path.join(root, f), installDir)
+                          for f in files])
+        return sorted(found)
+
+    def test_hhvm(self):
+        eq_(['usr/bin/hhvm', 'usr/lib/hhvm/libhhvm.so',
+             'usr/share/hhvm/hdf/static.mime-types.hdf'],
+            self.install('HHVM', [
+                'hhvm/usr/bin/hhvm',
+                'hhvm/usr/lib/hhvm/libhhvm.so',
+                'hhvm/usr/share/doc/hhvm/README.md',
+                'hhvm/usr/share/hhvm/hdf/static.mime-types.hdf',
+                'hhvm/usr/share/man/man1/hhvm.1.gz']))
+
+    def test_php(self):
+        eq_(['bin/php', 'lib/php/extensions/curl.so'],
+            self.install('PHP', [
+                'php/bin/php',
+                'php/lib/php/extensions/curl.so',
+                'php/man/man1/php.1',
+                'php/php/man/man1/phpize.1']))
+
+    def test_httpd(self):
+        eq_(['bin/httpd', 'modules/mod_proxy.so'],
+            self.install('HTTPD', [
+                'httpd/bin/httpd',
+                'httpd/man/httpd.8',
+                'httpd/manual/index.html',
+                'httpd/modules/mod_proxy.so']))
@@ -1,9 +1,13 @@
 import os
 import os.path
+import json
 import tempfile
 import shutil
 from nose.tools import eq_
 from build_pack_utils import utils
+from build_pack_utils import timing
+from build_pack_utils import BaseCacheManager
+from build_pack_utils import DirectoryCacheManager
 from compile_helpers import setup_webdir_if_it_doesnt_exist
 from compile_helpers import convert_php_extensions
 from compile_helpers import is_web_app
@@ -14,6 +18,20 @@ from compile_helpers import find_all_php_extensions
 from compile_helpers import validate_php_version
 from compile_helpers import validate_php_extensions
 from compile_helpers import setup_log_dir
+from compile_helpers import write_timing_report
+from compile_helpers import clean_up_cache
+
+
+class CountingCache(DirectoryCacheManager):
+    evicted = []
+
+    def evict(self):
+        CountingCache.evicted.append(self._baseDir)
+        return DirectoryCacheManager.evict(self)
+
+
+class PlainCache(BaseCacheManager):
+    pass
 
 
 class TestCompileHelpers(object):
@@ -45,6 +63,62 @@ class TestCompileHelpers(object):
         })
         self.assert_exists(self.build_dir, 'logs')
 
+    def test_write_timing_report(self):
+        with timing.Span('test step'):
+            timing.count(bytes_downloaded=10)
+        write_timing_report(utils.FormattedDict({
+            'BUILD_DIR': self.build_dir
+        }))
+        self.assert_exists(self.build_dir, '.bp', 'logs', 'timing.json')
+        self.assert_exists(self.build_dir, '.bp', 'logs', 'trace.json')
+        with open(os.path.join(self.build_dir, '.bp', 'logs',
+                               'timing.json')) as f:
+            report = json.load(f)
+        steps = [s for s in report['steps'] if s['name'] == 'test step']
+        eq_(1, len(steps))
+        eq_(10, steps[0]['bytes_downloaded'])
+        with open(os.path.join(self.build_dir, '.bp', 'logs',
+                               'trace.json')) as f:
+            trace = json.load(f)
+        eq_(1, len([e for e in trace['traceEvents']
+                    if e['name'] == 'test step' and e['ph'] == 'X']))
+
+    def clean_up_cache(self, **kwargs):
+        ctx = utils.FormattedDict({
+            'BUILD_DIR': self.build_dir,
+            'CACHE_DIR': self.cache_dir
+        })
+        ctx.update(kwargs)
+        clean_up_cache(ctx)
+        return os.path.join(self.build_dir, '.bp', 'logs',
+                            'cache-stats.json')
+
+    def test_clean_up_cache(self):
+        os.makedirs(os.path.join(self.cache_dir, 'objects', 'sha1', 'ab',
+                                 'abcd'))
+        with open(os.path.join(self.cache_dir, 'objects', 'sha1', 'ab',
+                               'abcd', 'php.tar.gz'), 'wt') as f:
+            f.write('php')
+        path = self.clean_up_cache(FILE_CACHE_MAX_SIZE='1')
+        with open(path) as f:
+            stats = json.load(f)
+        eq_(0, stats['entries'])
+        eq_(1, stats['max_size'])
+
+    def test_clean_up_custom_cache(self):
+        del CountingCache.evicted[:]
+        path = self.clean_up_cache(
+            FILE_CACHE_METHOD='custom',
+            FILE_CACHE_CLASS='test_compile_helpers.CountingCache')
+        eq_([self.cache_dir], CountingCache.evicted)
+        eq_(True, os.path.exists(path))
+
+    def test_clean_up_cache_without_eviction(self):
+        path = self.clean_up_cache(
+            FILE_CACHE_METHOD='custom',
+            FILE_CACHE_CLASS='test_compile_helpers.PlainCache')
+        eq_(False, os.path.exists(path))
+
     def test_setup_if_webdir_exists(self):
         shutil.copytree('tests/data/app-1', self.build_dir)
         setup_webdir_if_it_doesnt_exist(utils.FormattedDict({
@@ -126,6 +200,22 @@ class TestCompileHelpers(object):
         eq_(4, len(os.listdir(self.build_dir)))
         eq_(4, len(os.listdir(os.path.join(self.build_dir, 'htdocs'))))
 
+    def test_setup_if_htdocs_does_not_exist_skips_library(self):
+        shutil.copytree('tests/data/app-7', self.build_dir)
+        os.makedirs(os.path.join(self.build_dir, 'lib', 'vendor', 'empty'))
+        os.makedirs(os.path.join(self.build_dir, 'library', 'empty'))
+        setup_webdir_if_it_doesnt_exist(utils.FormattedDict({
+            'BUILD_DIR': self.build_dir,
+            'WEBDIR': 'htdocs',
+            'LIBDIR': 'lib'
+        }))
+        self.assert_exists(self.build_dir, 'htdocs', 'library', 'junk.php')
+        self.assert_exists(self.build_dir, 'lib', 'test.php')
+        # the library isn't walked, so its empty directories are left
+        self.assert_exists(self.build_dir, 'lib', 'vendor', 'empty')
+        eq_(False, os.path.exists(os.path.join(self.build_dir, 'library')))
+        eq_(4, len(os.listdir(self.build_dir)))
+
     def test_setup_if_custom_webdir_does_not_exist(self):
         shutil.copytree('tests/data/app-2', self.build_dir)
         setup_webdir_if_it_doesnt_exist(utils.FormattedDict({
@@ -331,6 +421,16 @@ class TestCompileHelpers(object):
         assert 'fpm' not in tmp
         assert 'pear' not in tmp
 
+    def test_find_php_extensions_compressed(self):
+        exts = find_all_php_extensions({'php': {'5.6.6': [
+            'http://localhost/php/5.6.6/php-5.6.6.tar.zst',
+            'http://localhost/php/5.6.6/php-amqp-5.6.6.tar.zst',
+            'http://localhost/php/5.6.6/php-amqp-5.6.6.tar.zst.sha1',
+            'http://localhost/php/5.6.6/php-apc-5.6.6.tar.xz',
+            'http://localhost/php/5.6.6/php-cli-5.6.6.tar.xz',
+            'http://localhost/php/5.6.6/php-redis-5.6.6.tar.gz']}})
+        eq_(['amqp', 'apc', 'redis'], sorted(exts['5.6.6']))
+
     def test_validate_php_version(self):
         ctx = {
             'ALL_PHP_VERSIONS': ['5.4.31', '5.4.30'],
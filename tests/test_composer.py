@@ -104,6 +104,47 @@ class TestComposer(object):
             'ignored', \
             "was %s" % installer._installer.calls()[0].args[1]
 
+    def test_composer_tool_plan(self):
+        ctx = utils.FormattedDict({
+            'DOWNLOAD_URL': 'http://server/bins',
+            'CACHE_HASH_ALGORITHM': 'sha1',
+            'PHP_VM': 'will_default_to_php_strategy',
+            'BUILD_DIR': '/build/dir',
+            'CACHE_DIR': '/cache/dir'
+        })
+        plan = Dingus()
+        ct = self.extension_module.ComposerExtension(ctx)
+        ct._plan(plan)
+        # make sure PHP cli is planned
+        assert plan.modules.calls().once()
+        eq_('PHP', plan.modules.calls()[0].args[0])
+        call = plan.modules.calls()[0]
+        eq_('cli', call.return_value.include_module.calls()[0].args[0])
+        # make sure composer is planned
+        assert plan.binary.calls().once()
+        eq_(('COMPOSER',
+             'http://server/bins/composer/1.0.0-alpha9/composer.phar',
+             'http://server/bins/composer/1.0.0-alpha9/composer.phar.sha1'),
+            plan.binary.calls()[0].args)
+
+    def test_composer_tool_plan_latest(self):
+        ctx = utils.FormattedDict({
+            'DOWNLOAD_URL': 'http://server/bins',
+            'CACHE_HASH_ALGORITHM': 'sha1',
+            'PHP_VM': 'will_default_to_php_strategy',
+            'BUILD_DIR': '/build/dir',
+            'CACHE_DIR': '/cache/dir',
+            'COMPOSER_VERSION': 'latest'
+        })
+        plan = Dingus()
+        ct = self.extension_module.ComposerExtension(ctx)
+        ct._plan(plan)
+        eq_(('COMPOSER', 'https://getcomposer.org/composer.phar', 'ignored'),
+            plan.binary.calls()[0].args)
+        # planning doesn't change the context
+        eq_('http://server/bins/composer/latest/composer.phar',
+            ctx['COMPOSER_DOWNLOAD_URL'])
+
     def test_composer_run_streams_output(self):
         ctx = utils.FormattedDict({
             'PHP_VM': 'hhvm',  # PHP strategy does other stuff
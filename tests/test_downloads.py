@@ -0,0 +1,602 @@
+import os
+import os.path
+import json
+import base64
+import socket
+import hashlib
+import tempfile
+import shutil
+import urllib2
+from StringIO import StringIO
+from mimetools import Message
+from nose.tools import eq_
+from nose.tools import raises
+from common.server import FileServer
+from build_pack_utils import utils
+from build_pack_utils import downloads
+from build_pack_utils.downloads import Downloader
+from build_pack_utils.downloads import CurlDownloader
+from build_pack_utils.downloads import ConnectionPool
+from build_pack_utils.downloads import DownloadError
+from build_pack_utils.downloads import SlowDownloadError
+from build_pack_utils.downloads import PartialFile
+from build_pack_utils.downloads import call_with_retries
+from build_pack_utils.downloads import is_retryable
+
+
+class FakeResponse(object):
+    def __init__(self, body, code=200, headers=None):
+        self._body = StringIO(body)
+        self._code = code
+        self._headers = Message(StringIO(''.join(
+            ['%s: %s\n' % item for item in (headers or {}).iteritems()])))
+
+    def read(self, amt=None):
+        return self._body.read(amt)
+
+    def info(self):
+        return self._headers
+
+    def getcode(self):
+        return self._code
+
+    def close(self):
+        pass
+
+
+class TestRetries(object):
+    def setUp(self):
+        self.ctx = {'DOWNLOAD_RETRIES': 2, 'DOWNLOAD_RETRY_DELAY': 0}
+        self.calls = []
+        self.failures = []
+
+    def attempt(self, *errors):
+        errors = list(errors)
+
+        def run():
+            self.calls.append(True)
+            if errors:
+                raise errors.pop(0)
+            return 'done'
+        return run
+
+    def test_is_retryable(self):
+        eq_(True, is_retryable(DownloadError('dropped')))
+        eq_(True, is_retryable(socket.timeout('timed out')))
+        eq_(True, is_retryable(urllib2.URLError('refused')))
+        eq_(True, is_retryable(
+            urllib2.HTTPError('http://x', 503, 'busy', {}, None)))
+        eq_(False, is_retryable(
+            urllib2.HTTPError('http://x', 404, 'not found', {}, None)))
+        eq_(False, is_retryable(SlowDownloadError('slow')))
+        eq_(False, is_retryable(ValueError('bad')))
+
+    def test_retries_until_it_works(self):
+        eq_('done', call_with_retries(
+            self.ctx, 'http://x',
+            self.attempt(DownloadError('one'), DownloadError('two')),
+            self.failures.append))
+        eq_(3, len(self.calls))
+        eq_(2, len(self.failures))
+
+    @raises(DownloadError)
+    def test_gives_up_after_retries(self):
+        try:
+            call_with_retries(self.ctx, 'http://x',
+                              self.attempt(*[DownloadError('again')] * 5),
+                              self.failures.append)
+        finally:
+            eq_(3, len(self.calls))
+            eq_(3, len(self.failures))
+
+    def test_does_not_retry_http_client_errors(self):
+        error = urllib2.HTTPError('http://x', 404, 'not found', {}, None)
+        try:
+            call_with_retries(self.ctx, 'http://x', self.attempt(error),
+                              self.failures.append)
+            assert False, 'should have raised'
+        except urllib2.HTTPError, e:
+            eq_(404, e.code)
+        eq_(1, len(self.calls))
+        eq_([error], self.failures)
+
+    @raises(ValueError)
+    def test_does_not_retry_other_errors(self):
+        try:
+            call_with_retries(self.ctx, 'http://x',
+                              self.attempt(ValueError('bad')))
+        finally:
+            eq_(1, len(self.calls))
+
+
+class TestDownloader(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='downloads-')
+        self.to_file = os.path.join(self.tmp_dir, 'file.tar.gz')
+        self.url = 'http://server/file.tar.gz'
+        self.body = 'abcdefghij' * 100
+        self.ctx = utils.FormattedDict({
+            'CACHE_HASH_ALGORITHM': 'sha1',
+            'DOWNLOAD_RETRIES': 2,
+            'DOWNLOAD_RETRY_DELAY': 0
+        })
+        self.requests = []
+
+    def tearDown(self):
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+
+    def downloader(self, *responses):
+        responses = list(responses)
+        dwn = Downloader(self.ctx)
+
+        def fake_open(url, headers=None, redirects=5):
+            self.requests.append(dict(headers or {}))
+            res = responses.pop(0)
+            if isinstance(res, Exception):
+                raise res
+            return res
+        dwn._open = fake_open
+        return dwn
+
+    def test_download(self):
+        dwn = self.downloader(FakeResponse(self.body, 200, {
+            'Content-Length': len(self.body)}))
+        eq_(hashlib.sha1(self.body).hexdigest(),
+            dwn.download(self.url, self.to_file))
+        eq_(self.body, open(self.to_file).read())
+        eq_(False, os.path.exists(self.to_file + '.part'))
+
+    def test_download_hash_algorithm(self):
+        self.ctx['CACHE_HASH_ALGORITHM'] = 'sha256'
+        dwn = self.downloader(FakeResponse(self.body))
+        eq_(hashlib.sha256(self.body).hexdigest(),
+            dwn.download(self.url, self.to_file))
+
+    def test_download_in_chunks(self):
+        self.ctx['DOWNLOAD_CHUNK_SIZE'] = 300
+        chunks = []
+        dwn = self.downloader(FakeResponse(self.body))
+        dwn.download(self.url, self.to_file, [chunks.append])
+        eq_([300, 300, 300, 100], [len(chunk) for chunk in chunks])
+        eq_(self.body, ''.join(chunks))
+
+    def test_resume_with_range_and_etag(self):
+        # the first response is cut off after 300 bytes
+        dwn = self.downloader(
+            FakeResponse(self.body[:300], 200, {
+                'Content-Length': len(self.body), 'ETag': '"v1"'}),
+            FakeResponse(self.body[300:], 206, {
+                'Content-Length': len(self.body) - 300, 'ETag': '"v1"'}))
+        eq_(hashlib.sha1(self.body).hexdigest(),
+            dwn.download(self.url, self.to_file))
+        eq_({}, self.requests[0])
+        eq_({'Range': 'bytes=300-', 'If-Range': '"v1"'}, self.requests[1])
+        eq_(self.body, open(self.to_file).read())
+        eq_(False, os.path.exists(self.to_file + '.part'))
+
+    def test_resume_from_an_earlier_download(self):
+        with open(self.to_file, 'wb') as f:
+            f.write(self.body[:500])
+        with open(self.to_file + '.part', 'wt') as f:
+            json.dump({'url': self.url, 'length': 400, 'etag': '"v1"'}, f)
+        dwn = self.downloader(FakeResponse(self.body[400:], 206, {
+            'Content-Length': len(self.body) - 400}))
+        eq_(hashlib.sha1(self.body).hexdigest(),
+            dwn.download(self.url, self.to_file))
+        eq_({'Range': 'bytes=400-', 'If-Range': '"v1"'}, self.requests[0])
+        eq_(self.body, open(self.to_file).read())
+
+    def test_start_over_when_server_does_not_resume(self):
+        dwn = self.downloader(
+            FakeResponse(self.body[:300], 200, {
+                'Content-Length': len(self.body)}),
+            FakeResponse(self.body, 200, {
+                'Content-Length': len(self.body)}))
+        eq_(hashlib.sha1(self.body).hexdigest(),
+            dwn.download(self.url, self.to_file))
+        eq_('bytes=300-', self.requests[1]['Range'])
+        eq_(self.body, open(self.to_file).read())
+
+    def test_keep_partial_file_after_retries(self):
+        dwn = self.downloader(*[
+            FakeResponse(self.body[:300], 200, {
+                'Content-Length': len(self.body), 'ETag': '"v1"'})
+            for i in range(3)])
+        try:
+            dwn.download(self.url, self.to_file)
+            assert False, 'should have raised'
+        except DownloadError:
+            pass
+        with open(self.to_file + '.part') as f:
+            meta = json.load(f)
+        eq_(self.url, meta['url'])
+        eq_('"v1"', meta['etag'])
+        eq_(os.path.getsize(self.to_file), meta['length'])
+
+    def test_discard_partial_file_on_client_error(self):
+        dwn = self.downloader(
+            urllib2.HTTPError(self.url, 404, 'not found', {}, None))
+        try:
+            dwn.download(self.url, self.to_file)
+            assert False, 'should have raised'
+        except urllib2.HTTPError:
+            pass
+        eq_(1, len(self.requests))
+        eq_([], os.listdir(self.tmp_dir))
+
+
+class TestCurlDownloader(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='downloads-')
+        self.from_file = os.path.join(self.tmp_dir, 'from.tar.gz')
+        self.to_file = os.path.join(self.tmp_dir, 'to.tar.gz')
+        self.body = 'abcdefghij' * 10000
+        with open(self.from_file, 'wb') as f:
+            f.write(self.body)
+        self.ctx = utils.FormattedDict({
+            'CACHE_HASH_ALGORITHM': 'sha1',
+            'DOWNLOAD_RETRIES': 0
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_download(self):
+        chunks = []
+        eq_(hashlib.sha1(self.body).hexdigest(),
+            CurlDownloader(self.ctx).download('file://%s' % self.from_file,
+                                              self.to_file, [chunks.append]))
+        eq_(self.body, open(self.to_file).read())
+        eq_(self.body, ''.join(chunks))
+
+    def test_download_missing(self):
+        try:
+            CurlDownloader(self.ctx).download(
+                'file://%s' % os.path.join(self.tmp_dir, 'missing'),
+                self.to_file)
+            assert False, 'should have raised'
+        except RuntimeError:
+            pass
+        eq_(False, os.path.exists(self.to_file))
+
+    def test_resume(self):
+        with open(self.to_file, 'wb') as f:
+            f.write(self.body[:5000])
+        url = 'file://%s' % self.from_file
+        with open(self.to_file + '.part', 'wt') as f:
+            json.dump({'url': url, 'length': 4000}, f)
+        eq_(hashlib.sha1(self.body).hexdigest(),
+            CurlDownloader(self.ctx).download(url, self.to_file))
+        eq_(self.body, open(self.to_file).read())
+        eq_(False, os.path.exists(self.to_file + '.part'))
+
+
+class TestPartialFile(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='downloads-')
+        self.path = os.path.join(self.tmp_dir, 'file')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_load_ignores_other_urls(self):
+        part = PartialFile(self.path, 'http://server/a', 'sha1')
+        part.write_from(StringIO('12345'))
+        part.etag = '"a"'
+        part.save()
+        other = PartialFile(self.path, 'http://server/b', 'sha1').load()
+        eq_(0, other.length)
+        eq_(0, os.path.getsize(self.path))
+        eq_({}, other.range_headers())
+
+    def test_load_truncates_to_saved_length(self):
+        part = PartialFile(self.path, 'http://server/a', 'sha1')
+        part.write_from(StringIO('12345'))
+        part.save()
+        with open(self.path, 'ab') as f:
+            f.write('unverified')
+        part = PartialFile(self.path, 'http://server/a', 'sha1').load()
+        eq_(5, part.length)
+        eq_('12345', open(self.path).read())
+        part.write_from(StringIO('67890'))
+        eq_(hashlib.sha1('1234567890').hexdigest(), part.finish())
+
+
+class FakePopen(object):
+    def __init__(self, output):
+        self.output = output
+        self.cmds = []
+
+    def __call__(self, cmd, stdout=None, stderr=None):
+        self.cmds.append(cmd)
+        if cmd[1] == '--version':
+            self.returncode = 0
+            return self
+        with open(cmd[cmd.index('-K') + 1]) as f:
+            self.config = f.read()
+        return self
+
+    def communicate(self):
+        return self.output, ''
+
+    def poll(self):
+        return 0
+
+
+class TestCurlDownloadMany(object):
+    def setUp(self):
+        downloads._curl_parallel = None
+        self.tmp_dir = tempfile.mkdtemp(prefix='downloads-')
+        self.server = FileServer().start()
+        self.server.files['/php.tar.gz'] = 'php' * 1000
+        self.server.files['/httpd.tar.gz'] = 'httpd' * 1000
+        self.ctx = utils.FormattedDict({
+            'TMPDIR': self.tmp_dir,
+            'DOWNLOAD_RETRIES': 0
+        })
+        self.popen = downloads.Popen
+
+    def tearDown(self):
+        downloads.Popen = self.popen
+        downloads._curl_parallel = None
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def download_many(self, *names):
+        return CurlDownloader(self.ctx).download_many(
+            [(self.server.url + '/' + name, self.path(name))
+             for name in names])
+
+    def test_download_many(self):
+        eq_({self.path('php.tar.gz'): 200,
+             self.path('httpd.tar.gz'): 200,
+             self.path('missing.tar.gz'): 404},
+            self.download_many('php.tar.gz', 'httpd.tar.gz',
+                               'missing.tar.gz'))
+        eq_('php' * 1000, open(self.path('php.tar.gz')).read())
+        eq_('httpd' * 1000, open(self.path('httpd.tar.gz')).read())
+        eq_(False, os.path.exists(self.path('missing.tar.gz')))
+        # the curl config file is removed
+        eq_(['httpd.tar.gz', 'php.tar.gz'], sorted(os.listdir(self.tmp_dir)))
+
+    def test_download_many_without_parallel(self):
+        downloads._curl_parallel = False
+        self.test_download_many()
+
+    def test_download_many_reuses_connections(self):
+        downloads._curl_parallel = False
+        self.download_many('php.tar.gz', 'httpd.tar.gz')
+        eq_(1, len(self.server.connections))
+
+    def test_download_many_quotes_names(self):
+        self.server.files['/my%20"php".tar.gz'] = 'quoted'
+        name = 'my "php".tar.gz'
+        eq_({self.path(name): 200},
+            CurlDownloader(self.ctx).download_many(
+                [(self.server.url + '/my%20"php".tar.gz', self.path(name))]))
+        eq_('quoted', open(self.path(name)).read())
+
+    def test_download_nothing(self):
+        eq_({}, CurlDownloader(self.ctx).download_many([]))
+
+    def test_status_parsing(self):
+        downloads._curl_parallel = True
+        for name in ('a b.tar.gz', 'c.tar.gz', 'd.tar.gz'):
+            with open(self.path(name), 'wt') as f:
+                f.write(name)
+        # a transfer that never got a response reports 000, one that
+        #  curl gave up on may not be reported at all
+        downloads.Popen = FakePopen('200 %s\n000 %s\n' % (
+            self.path('a b.tar.gz'), self.path('c.tar.gz')))
+        eq_({self.path('a b.tar.gz'): 200,
+             self.path('c.tar.gz'): 0,
+             self.path('d.tar.gz'): 0},
+            CurlDownloader(self.ctx).download_many(
+                [('http://x/%s' % name, self.path(name))
+                 for name in ('a b.tar.gz', 'c.tar.gz', 'd.tar.gz')]))
+        eq_(['a b.tar.gz'], os.listdir(self.tmp_dir))
+        cmd = downloads.Popen.cmds[-1]
+        eq_(['--parallel', '--parallel-max', '8'],
+            cmd[cmd.index('--parallel'):cmd.index('--parallel') + 3])
+        assert downloads.Popen.config.startswith(
+            'url = "http://x/a b.tar.gz"\n'
+            'output = "%s"\n' % self.path('a b.tar.gz'))
+
+    def test_supports_parallel(self):
+        downloads.Popen = FakePopen('curl 7.65.3 (x86_64-pc-linux-gnu)')
+        eq_(False, CurlDownloader(self.ctx)._supports_parallel())
+        downloads._curl_parallel = None
+        downloads.Popen = FakePopen('curl 7.66.0 (x86_64-pc-linux-gnu)')
+        eq_(True, CurlDownloader(self.ctx)._supports_parallel())
+        downloads._curl_parallel = None
+        downloads.Popen = FakePopen('')
+        eq_(False, CurlDownloader(self.ctx)._supports_parallel())
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(object):
+    def setUp(self):
+        self.pool = ConnectionPool()
+        self.key = ('http', 'server', 80, None)
+
+    def test_reuse(self):
+        eq_(None, self.pool.get(self.key))
+        first, second = FakeConnection(), FakeConnection()
+        self.pool.put(self.key, first, 2)
+        self.pool.put(self.key, second, 2)
+        eq_(second, self.pool.get(self.key))
+        eq_(first, self.pool.get(self.key))
+        eq_(None, self.pool.get(self.key))
+        eq_(False, first.closed or second.closed)
+
+    def test_other_keys(self):
+        conn = FakeConnection()
+        self.pool.put(self.key, conn, 2)
+        eq_(None, self.pool.get(('https', 'server', 443, None)))
+        eq_(None, self.pool.get(('http', 'server', 80, 'http://proxy')))
+        eq_(conn, self.pool.get(self.key))
+
+    def test_full_pool_closes_connections(self):
+        conns = [FakeConnection() for i in range(3)]
+        for conn in conns:
+            self.pool.put(self.key, conn, 2)
+        eq_([False, False, True], [conn.closed for conn in conns])
+
+    def test_clear(self):
+        conn = FakeConnection()
+        self.pool.put(self.key, conn, 2)
+        self.pool.clear()
+        eq_(True, conn.closed)
+        eq_(None, self.pool.get(self.key))
+
+    def test_resolve_is_cached(self):
+        lookups = []
+        getaddrinfo = socket.getaddrinfo
+
+        def counting(*args):
+            lookups.append(args[:2])
+            return getaddrinfo(*args)
+        socket.getaddrinfo = counting
+        try:
+            eq_(self.pool.resolve('127.0.0.1', 80),
+                self.pool.resolve('127.0.0.1', 80))
+            self.pool.resolve('127.0.0.1', 8080)
+        finally:
+            socket.getaddrinfo = getaddrinfo
+        eq_([('127.0.0.1', 80), ('127.0.0.1', 8080)], lookups)
+
+
+class TestPooledDownloads(object):
+    def setUp(self):
+        downloads._pool.clear()
+        self.server = FileServer().start()
+        self.server.files['/php.tar.gz'] = 'php' * 1000
+        self.server.files['/httpd.tar.gz'] = 'httpd' * 1000
+        self.ctx = utils.FormattedDict({
+            'CACHE_HASH_ALGORITHM': 'sha1',
+            'DOWNLOAD_RETRIES': 0
+        })
+
+    def tearDown(self):
+        downloads._pool.clear()
+        self.server.stop()
+        urllib2.install_opener(None)
+
+    def read(self, dwn, path):
+        res = dwn._open(self.server.url + path)
+        try:
+            return res.read()
+        finally:
+            res.close()
+
+    def test_connection_is_reused(self):
+        dwn = Downloader(self.ctx)
+        eq_('php' * 1000, self.read(dwn, '/php.tar.gz'))
+        eq_('httpd' * 1000, self.read(Downloader(self.ctx), '/httpd.tar.gz'))
+        eq_(1, len(self.server.connections))
+        eq_(2, len(self.server.requests))
+
+    def test_unread_response_is_not_reused(self):
+        dwn = Downloader(self.ctx)
+        dwn._open(self.server.url + '/php.tar.gz').close()
+        self.read(dwn, '/php.tar.gz')
+        eq_(2, len(self.server.connections))
+
+    def test_keep_alive_disabled(self):
+        self.ctx['DOWNLOAD_KEEP_ALIVE'] = False
+        dwn = Downloader(self.ctx)
+        self.read(dwn, '/php.tar.gz')
+        self.read(dwn, '/php.tar.gz')
+        eq_(2, len(self.server.connections))
+        eq_(None, downloads._pool.get(
+            ('http', '127.0.0.1', self.server.server_address[1], None)))
+
+    def test_stale_connection(self):
+        dwn = Downloader(self.ctx)
+        self.read(dwn, '/php.tar.gz')
+        self.server.drop_connections()
+        eq_('httpd' * 1000, self.read(dwn, '/httpd.tar.gz'))
+        eq_(2, len(self.server.connections))
+
+    def test_all_pooled_connections_stale(self):
+        dwn = Downloader(self.ctx)
+        # two idle connections in the pool, like after parallel installs
+        first = dwn._open(self.server.url + '/php.tar.gz')
+        second = dwn._open(self.server.url + '/httpd.tar.gz')
+        for res in (first, second):
+            res.read()
+            res.close()
+        eq_(2, len(self.server.connections))
+        self.server.drop_connections()
+        eq_('php' * 1000, self.read(dwn, '/php.tar.gz'))
+        eq_(3, len(self.server.connections))
+
+    def test_redirect(self):
+        self.server.redirects['/old/php.tar.gz'] = '/php.tar.gz'
+        self.server.redirects['/latest.tar.gz'] = (self.server.url +
+                                                   '/old/php.tar.gz')
+        eq_('php' * 1000, self.read(Downloader(self.ctx), '/latest.tar.gz'))
+        eq_(['/latest.tar.gz', '/old/php.tar.gz', '/php.tar.gz'],
+            [path for method, path, headers in self.server.requests])
+        eq_(1, len(self.server.connections))
+
+    @raises(urllib2.HTTPError)
+    def test_not_found(self):
+        dwn = Downloader(self.ctx)
+        try:
+            dwn._open(self.server.url + '/missing.tar.gz')
+        finally:
+            # the error body was read, so the connection is kept
+            self.read(dwn, '/php.tar.gz')
+            eq_(1, len(self.server.connections))
+
+    def test_download(self):
+        toFile = os.path.join(tempfile.mkdtemp(prefix='downloads-'), 'php')
+        try:
+            eq_(hashlib.sha1('php' * 1000).hexdigest(),
+                Downloader(self.ctx).download(self.server.url +
+                                              '/php.tar.gz', toFile))
+        finally:
+            shutil.rmtree(os.path.dirname(toFile))
+
+    def test_http_proxy(self):
+        # the test server stands in for the proxy
+        self.ctx['HTTP_PROXY'] = 'http://user:secret@%s:%d' % (
+            self.server.server_address)
+        self.server.files['http://php.invalid/php.tar.gz'] = 'proxied'
+        res = Downloader(self.ctx)._open('http://php.invalid/php.tar.gz')
+        eq_('proxied', res.read())
+        res.close()
+        method, path, headers = self.server.requests[0]
+        eq_('http://php.invalid/php.tar.gz', path)
+        eq_('Basic %s' % base64.b64encode('user:secret'),
+            headers['proxy-authorization'])
+
+    def test_https_proxy_tunnel(self):
+        self.ctx['HTTPS_PROXY'] = 'user:secret@proxy.invalid:3128'
+        dwn = Downloader(self.ctx)
+        conn = dwn._new_connection('https', 'php.invalid', 443,
+                                   dwn._proxies['https'])
+        eq_(('proxy.invalid', 3128), (conn.host, conn.port))
+        eq_(('php.invalid', 443), (conn._tunnel_host, conn._tunnel_port))
+        eq_({'Proxy-Authorization':
+             'Basic %s' % base64.b64encode('user:secret')},
+            conn._tunnel_headers)
+
+    def test_no_proxy(self):
+        dwn = Downloader(self.ctx)
+        conn = dwn._new_connection('https', 'php.invalid', 443, None)
+        eq_(('php.invalid', 443), (conn.host, conn.port))
+        eq_(None, conn._tunnel_host)
+        eq_(60, conn.read_timeout)
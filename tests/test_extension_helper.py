@@ -95,6 +95,36 @@ class TestPHPExtensionHelper(object):
         ext.compile(None)
         eq_(0, len(MyExtn._compile.calls()))
 
+    def test_plan_runs(self):
+        ctx = utils.FormattedDict({
+            'BUILD_DIR': self.build_dir,
+            'PHP_VERSION': '5.4.32'
+        })
+
+        class MyExtn(PHPExtensionHelper):
+            _plan = Dingus()
+
+            def _should_compile(self):
+                return True
+        ext = MyExtn(ctx)
+        eq_(0, ext.plan(None))
+        eq_(1, len(MyExtn._plan.calls()))
+
+    def test_plan_doesnt_run(self):
+        ctx = utils.FormattedDict({
+            'BUILD_DIR': self.build_dir,
+            'PHP_VERSION': '5.4.32'
+        })
+
+        class MyExtn(PHPExtensionHelper):
+            _plan = Dingus()
+
+            def _should_compile(self):
+                return False
+        ext = MyExtn(ctx)
+        eq_(0, ext.plan(None))
+        eq_(0, len(MyExtn._plan.calls()))
+
     def test_configure_runs(self):
         ctx = utils.FormattedDict({
             'BUILD_DIR': self.build_dir,
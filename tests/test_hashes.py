@@ -0,0 +1,100 @@
+import os
+import os.path
+import hashlib
+import tempfile
+import shutil
+from nose.tools import eq_
+from build_pack_utils import hashes
+from build_pack_utils.hashes import HashUtil
+from build_pack_utils.hashes import ShaHashUtil
+
+
+class HashedFiles(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='hashes-')
+        self.files = {}
+        for i in range(5):
+            self.file('file-%d.tar.gz' % i, 'file %d' % i)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def file(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.files[path] = hashlib.sha1(data).hexdigest()
+        return path
+
+    def ctx(self, **kwargs):
+        ctx = {'CACHE_HASH_ALGORITHM': 'sha1'}
+        ctx.update(kwargs)
+        return ctx
+
+
+class TestHashUtil(HashedFiles):
+    def test_calculate_hash(self):
+        util = HashUtil(self.ctx())
+        for path, digest in self.files.iteritems():
+            eq_(digest, util.calculate_hash(path))
+        eq_('', util.calculate_hash(''))
+
+    def test_calculate_hash_large_file(self):
+        data = 'php' * hashes.HASH_BUFFER_SIZE
+        path = self.file('large.tar.gz', data)
+        eq_(hashlib.sha256(data).hexdigest(), HashUtil(self.ctx(
+            CACHE_HASH_ALGORITHM='sha256')).calculate_hash(path))
+
+    def test_calculate_hashes(self):
+        eq_(self.files, HashUtil(self.ctx(HASH_CONCURRENCY=3))
+            .calculate_hashes(self.files.keys()))
+
+    def test_calculate_hashes_missing_file(self):
+        missing = os.path.join(self.tmp_dir, 'missing.tar.gz')
+        eq_(self.files, HashUtil(self.ctx()).calculate_hashes(
+            self.files.keys() + [missing]))
+
+    def test_does_hash_match(self):
+        util = HashUtil(self.ctx())
+        path, digest = self.files.items()[0]
+        eq_(True, util.does_hash_match('%s  file.tar.gz' % digest, path))
+        eq_(False, util.does_hash_match(hashlib.sha1('x').hexdigest(), path))
+
+
+class TestShaHashUtil(HashedFiles):
+    def setUp(self):
+        HashedFiles.setUp(self)
+        self.commands = []
+        self.popen = hashes.Popen
+
+        def recording(cmd, *args, **kwargs):
+            self.commands.append(cmd)
+            return self.popen(cmd, *args, **kwargs)
+        hashes.Popen = recording
+
+    def tearDown(self):
+        hashes.Popen = self.popen
+        HashedFiles.tearDown(self)
+
+    def test_calculate_hash(self):
+        path, digest = self.files.items()[0]
+        eq_(digest, ShaHashUtil(self.ctx()).calculate_hash(path))
+        eq_([['shasum', '-b', '-a', '1', path]], self.commands)
+
+    def test_spread_over_workers(self):
+        eq_(self.files, ShaHashUtil(self.ctx(HASH_CONCURRENCY=2))
+            .calculate_hashes(self.files.keys()))
+        eq_([3, 2], sorted([len(cmd) - 4 for cmd in self.commands],
+                           reverse=True))
+
+    def test_batch_size(self):
+        util = ShaHashUtil(self.ctx(HASH_CONCURRENCY=1))
+        util.BATCH_SIZE = 2
+        eq_(self.files, util.calculate_hashes(self.files.keys()))
+        eq_([2, 2, 1], [len(cmd) - 4 for cmd in self.commands])
+
+    def test_missing_file(self):
+        missing = os.path.join(self.tmp_dir, 'missing.tar.gz')
+        eq_(self.files, ShaHashUtil(self.ctx(HASH_CONCURRENCY=1))
+            .calculate_hashes(self.files.keys() + [missing, '']))
+        eq_(1, len(self.commands))
@@ -0,0 +1,147 @@
+import tempfile
+import shutil
+from nose.tools import eq_
+from nose.tools import raises
+from build_pack_utils import utils
+from build_pack_utils import mirrors
+from build_pack_utils.mirrors import MirrorList
+from build_pack_utils.cloudfoundry import CloudFoundryInstaller
+
+
+class TestMirrorList(object):
+    def setUp(self):
+        mirrors._rankings.clear()
+        self.ctx = utils.FormattedDict({
+            'DOWNLOAD_URL': 'http://base/php',
+            'DOWNLOAD_MIRRORS': [
+                'http://slow/php',
+                {'url': 'http://fast/php/', 'weight': 1},
+                {'url': 'http://heavy/php', 'weight': 4},
+                'http://down/php'
+            ]
+        })
+        self.latencies = {
+            'http://slow/php': 0.5,
+            'http://fast/php': 0.1,
+            'http://heavy/php': 0.8,
+            'http://down/php': None
+        }
+
+    def tearDown(self):
+        mirrors._rankings.clear()
+
+    def mirror_list(self):
+        mirrorList = MirrorList(self.ctx)
+        mirrorList._probe = lambda mirror: self.latencies[mirror[0]]
+        return mirrorList
+
+    def test_ranked_fastest(self):
+        # latency divided by weight, unreachable last, DOWNLOAD_URL after
+        eq_(['http://fast/php', 'http://heavy/php', 'http://slow/php',
+             'http://down/php', 'http://base/php'],
+            self.mirror_list().ranked())
+
+    def test_ranked_probe_fails(self):
+        mirrorList = self.mirror_list()
+
+        def probe(mirror):
+            if mirror[0] == 'http://fast/php':
+                raise IOError('refused')
+            return self.latencies[mirror[0]]
+        mirrorList._probe = probe
+        # unreachable mirrors keep their order, after the others
+        eq_(['http://heavy/php', 'http://slow/php', 'http://fast/php',
+             'http://down/php', 'http://base/php'], mirrorList.ranked())
+
+    def test_ranked_ordered(self):
+        self.ctx['DOWNLOAD_MIRROR_SELECTION'] = 'ordered'
+        eq_(['http://slow/php', 'http://fast/php', 'http://heavy/php',
+             'http://down/php', 'http://base/php'],
+            self.mirror_list().ranked())
+
+    def test_download_url_is_not_ranked(self):
+        self.ctx['DOWNLOAD_MIRRORS'] = ['http://base/php', 'http://slow/php']
+        self.latencies['http://base/php'] = 0.0
+        eq_(['http://slow/php', 'http://base/php'],
+            self.mirror_list().ranked())
+
+    def test_ranked_once(self):
+        self.mirror_list().ranked()
+        mirrorList = self.mirror_list()
+        mirrorList._probe = None
+        eq_('http://fast/php', mirrorList.ranked()[0])
+
+    def test_alternatives(self):
+        self.ctx['DOWNLOAD_MIRROR_SELECTION'] = 'ordered'
+        self.ctx['DOWNLOAD_MIRRORS'] = ['http://slow/php']
+        eq_([('http://slow/php/php/5.5/php.tar.gz',
+              'http://slow/php/php/5.5/php.tar.gz.sha1'),
+             ('http://base/php/php/5.5/php.tar.gz',
+              'http://base/php/php/5.5/php.tar.gz.sha1')],
+            self.mirror_list().alternatives(
+                'http://base/php/php/5.5/php.tar.gz',
+                'http://base/php/php/5.5/php.tar.gz.sha1'))
+
+    def test_alternatives_other_urls(self):
+        eq_([('http://other/php.tar.gz', 'abc')],
+            self.mirror_list().alternatives('http://other/php.tar.gz',
+                                            'abc'))
+
+    def test_alternatives_without_mirrors(self):
+        del self.ctx['DOWNLOAD_MIRRORS']
+        eq_([('http://base/php/php.tar.gz', 'abc')],
+            self.mirror_list().alternatives('http://base/php/php.tar.gz',
+                                            'abc'))
+
+
+class TestMirrorFailover(object):
+    def setUp(self):
+        mirrors._rankings.clear()
+        self.cache_dir = tempfile.mkdtemp(prefix='cache-')
+        self.ctx = utils.FormattedDict({
+            'CACHE_DIR': self.cache_dir,
+            'CACHE_HASH_ALGORITHM': 'sha1',
+            'DOWNLOAD_URL': 'http://base/php',
+            'DOWNLOAD_MIRRORS': ['http://one/php', 'http://two/php'],
+            'DOWNLOAD_MIRROR_SELECTION': 'ordered'
+        })
+        self.installer = CloudFoundryInstaller(self.ctx)
+        self.fetched = []
+
+    def tearDown(self):
+        mirrors._rankings.clear()
+        shutil.rmtree(self.cache_dir)
+
+    def fetch(self, *failing):
+        def fetch(url, hsh, fileName, verify=False, strip=None, exclude=()):
+            self.fetched.append(url)
+            if url.split('/')[2] in failing:
+                raise IOError('failed')
+            return ('/cache/%s' % fileName, 'digest')
+        self.installer._fetch = fetch
+
+    def test_next_mirror_on_failure(self):
+        self.fetch('one')
+        eq_(('/cache/php.tar.gz', 'digest'),
+            self.installer._fetch_any('http://base/php/php.tar.gz',
+                                      'http://base/php/php.tar.gz.sha1',
+                                      'php.tar.gz'))
+        eq_(['http://one/php/php.tar.gz', 'http://two/php/php.tar.gz'],
+            self.fetched)
+
+    def test_download_url_last(self):
+        self.fetch('one', 'two')
+        self.installer._fetch_any('http://base/php/php.tar.gz',
+                                  'http://base/php/php.tar.gz.sha1',
+                                  'php.tar.gz')
+        eq_('http://base/php/php.tar.gz', self.fetched[-1])
+
+    @raises(IOError)
+    def test_all_mirrors_fail(self):
+        self.fetch('one', 'two', 'base')
+        try:
+            self.installer._fetch_any('http://base/php/php.tar.gz',
+                                      'http://base/php/php.tar.gz.sha1',
+                                      'php.tar.gz')
+        finally:
+            eq_(3, len(self.fetched))
@@ -0,0 +1,142 @@
+import time
+import threading
+from nose.tools import eq_
+from nose.tools import raises
+from build_pack_utils.scheduler import StepScheduler
+from build_pack_utils.scheduler import Step
+from build_pack_utils.scheduler import overlaps
+
+
+class TestOverlaps(object):
+    def test_overlaps(self):
+        eq_(True, overlaps(['php'], ['php']))
+        eq_(True, overlaps(['php'], ['php/etc']))
+        eq_(True, overlaps(['php/etc/php.ini'], ['php/etc']))
+        eq_(True, overlaps(['httpd', 'php/etc'], ['php']))
+        eq_(False, overlaps(['php'], ['php5']))
+        eq_(False, overlaps(['php/etc'], ['php/lib']))
+        eq_(False, overlaps([], ['php']))
+
+
+class TestStep(object):
+    def step(self, inputs=(), outputs=()):
+        return Step('step', None, inputs, outputs)
+
+    def test_read_after_write(self):
+        eq_(True, self.step(['php/etc']).depends_on(
+            self.step(outputs=['php'])))
+
+    def test_write_after_write(self):
+        eq_(True, self.step(outputs=['php/etc']).depends_on(
+            self.step(outputs=['php/etc'])))
+
+    def test_write_after_read(self):
+        eq_(True, self.step(outputs=['htdocs']).depends_on(
+            self.step(['htdocs'])))
+
+    def test_read_after_read(self):
+        eq_(False, self.step(['htdocs']).depends_on(self.step(['htdocs'])))
+
+    def test_independent(self):
+        eq_(False, self.step(['php'], ['php']).depends_on(
+            self.step(['httpd'], ['httpd'])))
+
+    def test_none_depends_on_everything(self):
+        eq_(True, self.step(None, None).depends_on(
+            self.step(['httpd'], ['httpd'])))
+        eq_(True, self.step(['php'], ['php']).depends_on(
+            self.step(['httpd'], None)))
+
+
+class TestStepScheduler(object):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def record(self, name, delay=0):
+        def run():
+            with self.lock:
+                self.events.append(('start', name))
+            time.sleep(delay)
+            with self.lock:
+                self.events.append(('end', name))
+        return run
+
+    def index(self, event, name):
+        return self.events.index((event, name))
+
+    def test_waits_for_the_steps_it_depends_on(self):
+        finished = (StepScheduler(4)
+                    .add('download', self.record('download', 0.05),
+                         outputs=['php'])
+                    .add('configure', self.record('configure'),
+                         inputs=['php/etc'], outputs=['php/etc/php.ini'])
+                    .add('rewrite', self.record('rewrite'),
+                         outputs=['php'])
+                    .run())
+        eq_(['download', 'configure', 'rewrite'], finished)
+        assert self.index('end', 'download') < self.index('start', 'configure')
+        assert self.index('end', 'configure') < self.index('start', 'rewrite')
+
+    def test_runs_independent_steps_together(self):
+        started = threading.Event()
+
+        def httpd():
+            # only finishes once php has started
+            started.wait(5)
+            eq_(True, started.is_set())
+
+        finished = (StepScheduler(2)
+                    .add('httpd', httpd, ['httpd'], ['httpd'])
+                    .add('php', started.set, ['php'], ['php'])
+                    .run())
+        eq_(['php', 'httpd'], finished)
+
+    def test_one_worker_runs_in_order(self):
+        finished = (StepScheduler(1)
+                    .add('httpd', self.record('httpd', 0.05),
+                         ['httpd'], ['httpd'])
+                    .add('php', self.record('php'), ['php'], ['php'])
+                    .run())
+        eq_(['httpd', 'php'], finished)
+        eq_([('start', 'httpd'), ('end', 'httpd'),
+             ('start', 'php'), ('end', 'php')], self.events)
+
+    def test_none_waits_for_earlier_steps(self):
+        finished = (StepScheduler(4)
+                    .add('httpd', self.record('httpd', 0.05),
+                         ['httpd'], ['httpd'])
+                    .add('php', self.record('php', 0.05), ['php'], ['php'])
+                    .add('extension', self.record('extension'), None, None)
+                    .add('later', self.record('later'), ['htdocs'], [])
+                    .run())
+        eq_('later', finished[-1])
+        start = self.index('start', 'extension')
+        assert self.index('end', 'httpd') < start
+        assert self.index('end', 'php') < start
+        assert self.index('end', 'extension') < self.index('start', 'later')
+
+    @raises(ValueError)
+    def test_error_stops_new_steps(self):
+        def fail():
+            raise ValueError('broken')
+        try:
+            (StepScheduler(4)
+                .add('fail', fail, outputs=['php'])
+                .add('after', self.record('after'), inputs=['php'])
+                .run())
+        finally:
+            eq_([], self.events)
+
+    @raises(ValueError)
+    def test_error_waits_for_running_steps(self):
+        def fail():
+            time.sleep(0.01)
+            raise ValueError('broken')
+        try:
+            (StepScheduler(4)
+                .add('fail', fail, ['php'], ['php'])
+                .add('slow', self.record('slow', 0.1), ['httpd'], ['httpd'])
+                .run())
+        finally:
+            eq_([('start', 'slow'), ('end', 'slow')], self.events)
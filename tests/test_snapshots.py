@@ -0,0 +1,208 @@
+import os
+import os.path
+import tempfile
+import shutil
+from nose.tools import eq_
+from build_pack_utils import utils
+from build_pack_utils.snapshots import StepSnapshots
+from build_pack_utils.snapshots import hash_path
+from build_pack_utils.snapshots import _hash_value
+
+
+class FakeInstaller(object):
+    def __init__(self, digests):
+        self.digests = digests
+
+    def digest(self, hashUrl):
+        return self.digests[hashUrl]
+
+
+class TestHashPath(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='snapshots-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, path, data):
+        fullPath = os.path.join(self.tmp_dir, path)
+        utils.safe_makedirs(os.path.dirname(fullPath))
+        with open(fullPath, 'wt') as f:
+            f.write(data)
+
+    def test_hash_path(self):
+        eq_(None, hash_path(os.path.join(self.tmp_dir, 'missing')))
+        self.write('php/etc/php.ini', 'memory_limit=128M')
+        first = hash_path(os.path.join(self.tmp_dir, 'php'))
+        # compiled files don't count
+        self.write('php/lib/module.pyc', 'compiled')
+        eq_(first, hash_path(os.path.join(self.tmp_dir, 'php')))
+        self.write('php/etc/php.ini', 'memory_limit=256M')
+        assert first != hash_path(os.path.join(self.tmp_dir, 'php'))
+
+    def test_hash_path_names(self):
+        self.write('a/php.ini', 'same')
+        self.write('b/php-fpm.conf', 'same')
+        assert (hash_path(os.path.join(self.tmp_dir, 'a')) !=
+                hash_path(os.path.join(self.tmp_dir, 'b')))
+
+
+class TestStepSnapshots(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='snapshots-')
+        self.build_dir = os.path.join(self.tmp_dir, 'build')
+        self.bp_dir = os.path.join(self.tmp_dir, 'bp')
+        os.makedirs(os.path.join(self.build_dir, 'htdocs'))
+        os.makedirs(os.path.join(self.bp_dir, 'lib'))
+        with open(os.path.join(self.build_dir, 'htdocs', 'index.php'),
+                  'wt') as f:
+            f.write('<?php phpinfo(); ?>')
+        self.ctx = utils.FormattedDict({
+            'BUILD_DIR': self.build_dir,
+            'BP_DIR': self.bp_dir,
+            'CACHE_DIR': os.path.join(self.tmp_dir, 'cache'),
+            'INCREMENTAL_RESTAGE': True,
+            'STACK': 'cflinuxfs2',
+            'PHP_VERSION': '5.5.12',
+            'PHP_INI': '{BUILD_DIR}/php/etc/php.ini'
+        })
+        self.installer = FakeInstaller({'http://x/php.tar.gz.sha1': 'abc'})
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def snapshots(self):
+        return StepSnapshots(self.ctx, self.installer)
+
+    def step(self):
+        self.calls.append(self.ctx['PHP_VERSION'])
+        path = os.path.join(self.build_dir, 'php', 'etc', 'php.ini')
+        utils.safe_makedirs(os.path.dirname(path))
+        with open(path, 'wt') as f:
+            f.write('; php %s' % self.ctx['PHP_VERSION'])
+        self.ctx['PHP_EXTENSIONS'] = ['bz2', 'zlib']
+        utils.record_artifact('http://x/php.tar.gz.sha1', 'abc')
+
+    def run(self):
+        self.snapshots().run('php', self.step, ['htdocs'], ['php', 'ctx'])
+
+    def read_ini(self):
+        with open(os.path.join(self.build_dir, 'php', 'etc', 'php.ini')) as f:
+            return f.read()
+
+    def record(self, **kwargs):
+        record = {
+            'bp': self.snapshots()._bp_hash(),
+            'files': {'htdocs': hash_path(os.path.join(self.build_dir,
+                                                       'htdocs'))},
+            'reads': {'PHP_INI': _hash_value(self.ctx.value('PHP_INI'))},
+            'artifacts': {'http://x/php.tar.gz.sha1': 'abc'}
+        }
+        record.update(kwargs)
+        return record
+
+    def test_enabled(self):
+        eq_(True, self.snapshots().enabled())
+        self.ctx['INCREMENTAL_RESTAGE'] = False
+        eq_(False, self.snapshots().enabled())
+        self.ctx['INCREMENTAL_RESTAGE'] = True
+        del self.ctx['CACHE_DIR']
+        eq_(False, self.snapshots().enabled())
+
+    def test_matches(self):
+        record = self.record()
+        eq_(True, self.snapshots()._matches(record, record['files']))
+
+    def test_matches_build_pack_changed(self):
+        record = self.record()
+        snapshots = self.snapshots()
+        snapshots._bp_hash()
+        with open(os.path.join(self.bp_dir, 'lib', 'new.py'), 'wt') as f:
+            f.write('changed')
+        eq_(False, self.snapshots()._matches(record, record['files']))
+        # the build pack is hashed once per stage
+        eq_(True, snapshots._matches(record, record['files']))
+
+    def test_matches_files_changed(self):
+        record = self.record()
+        eq_(False, self.snapshots()._matches(record, {'htdocs': 'other'}))
+
+    def test_matches_read_changed(self):
+        record = self.record()
+        # the formatted value is what counts
+        self.ctx['BUILD_DIR'] = '/elsewhere'
+        eq_(False, self.snapshots()._matches(record, record['files']))
+
+    def test_matches_read_removed(self):
+        record = self.record()
+        del self.ctx['PHP_INI']
+        eq_(False, self.snapshots()._matches(record, record['files']))
+
+    def test_matches_artifact_changed(self):
+        record = self.record()
+        self.installer.digests['http://x/php.tar.gz.sha1'] = 'def'
+        eq_(False, self.snapshots()._matches(record, record['files']))
+        del self.installer.digests['http://x/php.tar.gz.sha1']
+        eq_(False, self.snapshots()._matches(record, record['files']))
+
+    def test_restore(self):
+        snapDir = os.path.join(self.tmp_dir, 'snap')
+        os.makedirs(os.path.join(snapDir, 'files', 'php', 'etc'))
+        with open(os.path.join(snapDir, 'files', 'php', 'etc', 'php.ini'),
+                  'wt') as f:
+            f.write('; saved')
+        with open(os.path.join(snapDir, 'record.json'), 'wt') as f:
+            f.write('{}')
+        os.utime(os.path.join(snapDir, 'record.json'), (0, 0))
+        self.snapshots()._restore(snapDir, self.record(
+            outputs=['php'], writes={'PHP_EXTENSIONS': ['bz2']}))
+        eq_('; saved', self.read_ini())
+        eq_(['bz2'], self.ctx['PHP_EXTENSIONS'])
+        assert os.path.getmtime(os.path.join(snapDir, 'record.json')) > 0
+
+    def test_run_and_restore(self):
+        self.run()
+        eq_(['5.5.12'], self.calls)
+        shutil.rmtree(os.path.join(self.build_dir, 'php'))
+        del self.ctx['PHP_EXTENSIONS']
+        self.run()
+        eq_(['5.5.12'], self.calls)
+        eq_('; php 5.5.12', self.read_ini())
+        eq_(['bz2', 'zlib'], self.ctx['PHP_EXTENSIONS'])
+
+    def test_run_again_when_a_read_changes(self):
+        self.run()
+        self.ctx['PHP_VERSION'] = '5.6.0'
+        self.run()
+        eq_(['5.5.12', '5.6.0'], self.calls)
+        eq_('; php 5.6.0', self.read_ini())
+        # both snapshots are kept, the first still restores
+        self.ctx['PHP_VERSION'] = '5.5.12'
+        self.run()
+        eq_(['5.5.12', '5.6.0'], self.calls)
+        eq_('; php 5.5.12', self.read_ini())
+
+    def test_later_changes_do_not_change_the_snapshot(self):
+        self.run()
+        with open(os.path.join(self.build_dir, 'php', 'etc', 'php.ini'),
+                  'at') as f:
+            f.write('extension=newrelic.so')
+        shutil.rmtree(os.path.join(self.build_dir, 'php'))
+        self.run()
+        eq_('; php 5.5.12', self.read_ini())
+
+    def test_run_again_when_an_input_changes(self):
+        self.run()
+        with open(os.path.join(self.build_dir, 'htdocs', 'index.php'),
+                  'wt') as f:
+            f.write('<?php echo "changed"; ?>')
+        self.run()
+        eq_(['5.5.12', '5.5.12'], self.calls)
+
+    def test_keeps_recent_snapshots(self):
+        for version in ('5.4.0', '5.5.0', '5.6.0'):
+            self.ctx['PHP_VERSION'] = version
+            self.run()
+        eq_(StepSnapshots.KEEP, len(os.listdir(
+            os.path.join(self.ctx['CACHE_DIR'], 'snapshots', 'php'))))
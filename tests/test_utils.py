@@ -0,0 +1,175 @@
+import os
+import os.path
+import time
+import shutil
+import tempfile
+import threading
+from nose.tools import eq_
+from build_pack_utils import utils
+
+
+class TestRunInParallel(object):
+    def test_results_in_order(self):
+        def work(item):
+            # later items finish first
+            time.sleep((5 - item) * 0.01)
+            return item * 2
+        eq_([(i, i * 2, None) for i in range(5)],
+            utils.run_in_parallel(work, range(5)))
+
+    def test_collects_errors(self):
+        done = []
+
+        def work(item):
+            if item % 2:
+                raise ValueError('odd %d' % item)
+            done.append(item)
+            return item
+        results = utils.run_in_parallel(work, range(5), workers=2)
+        eq_([0, 1, 2, 3, 4], [item for item, res, exc_info in results])
+        eq_([0, 2, 4], sorted(done))
+        for item, res, exc_info in results:
+            if item % 2:
+                eq_(None, res)
+                eq_(ValueError, exc_info[0])
+                eq_('odd %d' % item, str(exc_info[1]))
+                assert exc_info[2] is not None
+            else:
+                eq_((item, None), (res, exc_info))
+
+    def test_bounded_workers(self):
+        lock = threading.Lock()
+        running = [0]
+        most = [0]
+
+        def work(item):
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+        eq_(8, len(utils.run_in_parallel(work, range(8), workers=3)))
+        assert most[0] <= 3
+
+    def test_no_items(self):
+        eq_([], utils.run_in_parallel(lambda item: item, []))
+
+    def test_records_context(self):
+        ctx = utils.FormattedDict({'PHP_VERSION': '5.5.12'})
+
+        def work(item):
+            ctx['RESULT_%d' % item] = ctx['PHP_VERSION']
+        with utils.ContextRecorder(ctx) as recorder:
+            utils.run_in_parallel(work, range(2))
+        eq_({'PHP_VERSION': '5.5.12'}, recorder.reads)
+        eq_({'RESULT_0': '5.5.12', 'RESULT_1': '5.5.12'}, recorder.writes)
+
+
+class TestContextRecorder(object):
+    def setUp(self):
+        self.ctx = utils.FormattedDict({
+            'BUILD_DIR': '/tmp/build',
+            'PHP_INI': '{BUILD_DIR}/php/etc/php.ini'
+        })
+
+    def test_reads_and_writes(self):
+        with utils.ContextRecorder(self.ctx) as recorder:
+            self.ctx['PHP_INI']
+            self.ctx.get('MISSING', 'default')
+            self.ctx['PHP_VERSION'] = '5.5.12'
+            self.ctx['PHP_VERSION']
+        eq_({'PHP_INI': '/tmp/build/php/etc/php.ini', 'MISSING': None},
+            recorder.reads)
+        eq_({'PHP_VERSION': '5.5.12'}, recorder.writes)
+
+    def test_closed(self):
+        with utils.ContextRecorder(self.ctx) as recorder:
+            pass
+        self.ctx['PHP_INI']
+        eq_({}, recorder.reads)
+
+    def test_other_threads_are_not_recorded(self):
+        with utils.ContextRecorder(self.ctx) as recorder:
+            thread = threading.Thread(target=lambda: self.ctx['PHP_INI'])
+            thread.start()
+            thread.join()
+        eq_({}, recorder.reads)
+
+    def test_artifacts(self):
+        with utils.ContextRecorder(self.ctx) as recorder:
+            utils.record_artifact('http://x/php.tar.gz.sha1', 'abc')
+        eq_({'http://x/php.tar.gz.sha1': 'abc'}, recorder.artifacts)
+
+
+class TestFormattedDictValue(object):
+    def test_value(self):
+        ctx = utils.FormattedDict({
+            'BUILD_DIR': '/tmp/build',
+            'PHP_INI': '{BUILD_DIR}/php/etc/php.ini',
+            'MODULE_URL': '{DOWNLOAD_URL}/{MODULE_NAME}.tar.gz'
+        })
+        eq_('/tmp/build/php/etc/php.ini', ctx.value('PHP_INI'))
+        eq_('{DOWNLOAD_URL}/{MODULE_NAME}.tar.gz', ctx.value('MODULE_URL'))
+        eq_(None, ctx.value('MISSING'))
+
+
+class TestLinkTree(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='utils-')
+        self.src = os.path.join(self.tmp_dir, 'src')
+        self.dst = os.path.join(self.tmp_dir, 'dst')
+        os.makedirs(os.path.join(self.src, 'bin'))
+        os.makedirs(os.path.join(self.src, 'lib', 'empty'))
+        self.write(self.src, 'bin/php', 'php')
+        os.symlink('php', os.path.join(self.src, 'bin', 'php5'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, root, path, data):
+        fullPath = os.path.join(root, path)
+        utils.safe_makedirs(os.path.dirname(fullPath))
+        with open(fullPath, 'wt') as f:
+            f.write(data)
+        return fullPath
+
+    def inode(self, *args):
+        return os.stat(os.path.join(*args)).st_ino
+
+    def test_link_tree(self):
+        utils.link_tree(self.src, self.dst)
+        eq_(self.inode(self.src, 'bin', 'php'),
+            self.inode(self.dst, 'bin', 'php'))
+        eq_('php', os.readlink(os.path.join(self.dst, 'bin', 'php5')))
+        eq_(True, os.path.isdir(os.path.join(self.dst, 'lib', 'empty')))
+
+    def test_link_tree_into_existing(self):
+        self.write(self.dst, 'bin/php', 'old')
+        self.write(self.dst, 'etc/php.ini', 'ini')
+        utils.link_tree(self.src, self.dst)
+        eq_('php', open(os.path.join(self.dst, 'bin', 'php')).read())
+        eq_('ini', open(os.path.join(self.dst, 'etc', 'php.ini')).read())
+
+    def test_copy_tree(self):
+        utils.link_tree(self.src, self.dst, link=False)
+        assert (self.inode(self.src, 'bin', 'php') !=
+                self.inode(self.dst, 'bin', 'php'))
+        eq_('php', open(os.path.join(self.dst, 'bin', 'php')).read())
+
+    def test_break_hardlink(self):
+        utils.link_tree(self.src, self.dst)
+        path = os.path.join(self.dst, 'bin', 'php')
+        utils.break_hardlink(path)
+        assert self.inode(self.src, 'bin', 'php') != self.inode(path)
+        eq_('php', open(path).read())
+        eq_(1, os.stat(path).st_nlink)
+
+    def test_rewrite_does_not_change_the_source(self):
+        path = self.write(self.src, 'etc/php.ini', 'dir=@{HOME}')
+        utils.link_tree(self.src, self.dst)
+        utils.rewrite_cfgs(os.path.join(self.dst, 'etc'),
+                           {'HOME': '/home/vcap'}, delim='@')
+        eq_('dir=/home/vcap',
+            open(os.path.join(self.dst, 'etc', 'php.ini')).read())
+        eq_('dir=@{HOME}', open(path).read())
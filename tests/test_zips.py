@@ -0,0 +1,317 @@
+import os
+import os.path
+import tarfile
+import tempfile
+import shutil
+import subprocess
+from zipfile import ZipFile
+from zipfile import ZipInfo
+from StringIO import StringIO
+from nose.tools import eq_
+from nose.tools import raises
+from build_pack_utils import utils
+from build_pack_utils import zips
+from build_pack_utils.zips import UnzipUtil
+from build_pack_utils.zips import is_excluded
+from build_pack_utils.zips import _tar_exclude_args
+
+
+def make_tar(path, names, mode='w:gz'):
+    tar = tarfile.open(path, mode)
+    try:
+        for name in names:
+            info = tarfile.TarInfo(name)
+            info.size = len(name)
+            tar.addfile(info, StringIO(name))
+    finally:
+        tar.close()
+    return path
+
+
+def list_files(path):
+    found = []
+    for root, dirs, files in os.walk(path):
+        found.extend([os.path.relpath(os.path.join(root, f), path)
+                      for f in files])
+    return sorted(found)
+
+
+class FakePopen(object):
+    """Records the commands it's given instead of running them"""
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, cmd, stdin=None, **kwargs):
+        self.calls.append((cmd, getattr(stdin, 'name', stdin)))
+        return self
+
+    @property
+    def stdout(self):
+        return open(os.devnull, 'rb')
+
+    def communicate(self):
+        return '', ''
+
+    def wait(self):
+        return 0
+
+
+class TestExclude(object):
+    def test_is_excluded(self):
+        eq_(True, is_excluded('man/man1/php.1', ['man']))
+        eq_(True, is_excluded('man/man1/php.1', ['man/*']))
+        eq_(True, is_excluded('/man/', ['man']))
+        eq_(True, is_excluded('lib/libphp.a', ['lib/*.a']))
+        eq_(False, is_excluded('lib/php/libphp.a', ['lib/*.a']))
+        eq_(False, is_excluded('lib/libphp.so', ['lib/*.a']))
+        eq_(False, is_excluded('manual.txt', ['man']))
+        eq_(False, is_excluded('share/man/php.1', ['man']))
+        eq_(False, is_excluded('man', ['man/*']))
+        eq_(False, is_excluded('bin/php', []))
+
+    def test_tar_exclude_args(self):
+        eq_([], _tar_exclude_args([], False))
+        eq_(['--wildcards', '--anchored', '--no-wildcards-match-slash',
+             '--exclude=man', '--exclude=lib/*.a'],
+            _tar_exclude_args(['/man/', 'lib/*.a'], False))
+
+    def test_tar_exclude_args_strip(self):
+        eq_(['--wildcards', '--anchored', '--no-wildcards-match-slash',
+             '--exclude=*/man', '--exclude=*/lib/*.a'],
+            _tar_exclude_args(['man', 'lib/*.a'], True))
+
+
+class TestDecompressor(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='zips-')
+        self.into_dir = os.path.join(self.tmp_dir, 'into')
+        self.commands = dict(zips._commands)
+        self.lzma = zips.lzma
+
+    def tearDown(self):
+        zips._commands.clear()
+        zips._commands.update(self.commands)
+        zips.lzma = self.lzma
+        zips.Popen = subprocess.Popen
+        shutil.rmtree(self.tmp_dir)
+
+    def installed(self, *names):
+        for cmds in zips.DECOMPRESSORS.values():
+            for cmd in cmds:
+                zips._commands[cmd[0]] = (cmd[0] in names and
+                                          '/usr/bin/%s' % cmd[0] or None)
+
+    def unzip(self, **kwargs):
+        ctx = {'TMPDIR': self.tmp_dir}
+        ctx.update(kwargs)
+        return UnzipUtil(utils.FormattedDict(ctx))
+
+    def test_auto_prefers_parallel(self):
+        self.installed('pigz', 'gunzip', 'pbzip2', 'bunzip2')
+        eq_(['pigz', '-d', '-c'], self.unzip()._decompressor('gz'))
+        eq_(['pbzip2', '-d', '-c'], self.unzip()._decompressor('bz2'))
+        self.installed('gunzip')
+        eq_(['gunzip', '-c'], self.unzip()._decompressor('gz'))
+
+    def test_auto_nothing_installed(self):
+        self.installed()
+        eq_(None, self.unzip()._decompressor('gz'))
+        eq_(None, self.unzip()._decompressor('zst'))
+
+    def test_named(self):
+        self.installed('pigz', 'gunzip')
+        eq_(['gunzip', '-c'], self.unzip(
+            TAR_DECOMPRESSOR='gunzip')._decompressor('gz'))
+
+    def test_named_not_installed(self):
+        self.installed('lbzip2', 'bunzip2', 'gunzip')
+        unzip = self.unzip(TAR_DECOMPRESSOR='pbzip2')
+        eq_(['lbzip2', '-d', '-c'], unzip._decompressor('bz2'))
+        eq_(['gunzip', '-c'], unzip._decompressor('gz'))
+
+    def test_python(self):
+        self.installed('gunzip', 'xz')
+        unzip = self.unzip(TAR_DECOMPRESSOR='python')
+        eq_(None, unzip._decompressor('gz'))
+        zips.lzma = None
+        eq_(['xz', '-d', '-c', '-T0'], unzip._decompressor('xz'))
+
+    def test_extract_falls_back_to_tarfile(self):
+        self.installed()
+        path = make_tar(os.path.join(self.tmp_dir, 'php.tar.gz'),
+                        ['php/bin/php', 'php/man/php.1'])
+        self.unzip().extract(path, self.into_dir, strip=True,
+                             exclude=['man'])
+        eq_(['bin/php'], list_files(self.into_dir))
+
+    @raises(RuntimeError)
+    def test_extract_without_decompressor(self):
+        self.installed()
+        zips.lzma = None
+        path = os.path.join(self.tmp_dir, 'php.tar.xz')
+        with open(path, 'wb') as f:
+            f.write('not really xz')
+        self.unzip().extract(path, self.into_dir)
+
+
+    def test_tar_command_lines(self):
+        path = os.path.join(self.tmp_dir, 'php.tar')
+        open(path, 'wb').close()
+        tar = ['tar', 'xf', '-', '--strip-components', '1']
+        for compression, cmds in zips.DECOMPRESSORS.iteritems():
+            for cmd in cmds:
+                self.installed(cmd[0])
+                zips.Popen = FakePopen()
+                self.unzip()._tar_helper(path, self.into_dir, compression,
+                                         True)
+                # the archive goes on stdin, never on the command line
+                eq_([(list(cmd), path), (tar, zips.Popen.stdout.name)],
+                    zips.Popen.calls)
+        zips.Popen = FakePopen()
+        self.unzip()._tar_helper(path, self.into_dir, None, False)
+        eq_([(['tar', 'xf', path], None)], zips.Popen.calls)
+
+    def test_extract_each_compression(self):
+        zips._commands.clear()
+        for compress, extension in ((['gzip'], '.tar.gz'),
+                                    (['bzip2'], '.tar.bz2'),
+                                    (['xz'], '.tar.xz'),
+                                    (['zstd', '-q', '--rm'], '.tar.zst'),
+                                    (None, '.tar')):
+            if compress is not None and not zips._which(compress[0]):
+                continue
+            path = make_tar(os.path.join(self.tmp_dir, 'php.tar'),
+                            ['php/bin/php'], 'w')
+            if compress is not None:
+                subprocess.check_call(compress + [path])
+            intoDir = os.path.join(self.into_dir, extension.lstrip('.'))
+            self.unzip().extract(path[:-4] + extension, intoDir, strip=True)
+            eq_(['bin/php'], list_files(intoDir))
+            eq_(['into', 'php' + extension], sorted(os.listdir(self.tmp_dir)))
+            os.remove(path[:-4] + extension)
+
+class TestUnzipUtil(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='zips-')
+        self.into_dir = os.path.join(self.tmp_dir, 'into')
+        self.unzip = UnzipUtil(utils.FormattedDict({
+            'TMPDIR': self.tmp_dir
+        }))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def targets(self, names, strip=False, exclude=()):
+        return [(m.filename, path[len(self.into_dir) + 1:], isDir)
+                for m, path, isDir in self.unzip._zip_targets(
+                    [ZipInfo(n) for n in names], self.into_dir, strip,
+                    exclude)]
+
+    def test_zip_targets(self):
+        eq_([('php/', 'php', True),
+             ('php/bin/php', 'php/bin/php', False)],
+            self.targets(['php/', 'php/bin/php']))
+
+    def test_zip_targets_strip(self):
+        eq_([('php/bin/php', 'bin/php', False)],
+            self.targets(['php/', 'php/bin/php'], strip=True))
+
+    def test_zip_targets_exclude(self):
+        eq_([('php/bin/php', 'bin/php', False)],
+            self.targets(['php/bin/php', 'php/man/php.1'], strip=True,
+                         exclude=['man']))
+
+    def test_zip_targets_rejects_path_traversal(self):
+        eq_([('ok.txt', 'ok.txt', False)],
+            self.targets(['../evil.txt', 'a/../../evil.txt',
+                          '/etc/evil.txt', 'ok.txt']))
+
+    def test_zip_targets_strip_rejects_path_traversal(self):
+        eq_([('php/bin/php', 'bin/php', False)],
+            self.targets(['php/../../evil.txt', 'php/bin/php'],
+                         strip=True))
+
+    def test_extract_zip_strip(self):
+        path = os.path.join(self.tmp_dir, 'php.zip')
+        zf = ZipFile(path, 'w')
+        try:
+            zf.writestr('php/bin/php', 'php')
+            zf.writestr('php/etc/php.ini', 'ini')
+        finally:
+            zf.close()
+        self.unzip.extract(path, self.into_dir, strip=True)
+        eq_(['bin/php', 'etc/php.ini'], list_files(self.into_dir))
+        eq_('php', open(os.path.join(self.into_dir, 'bin', 'php')).read())
+
+
+    def test_extract_tar_with_exclude(self):
+        path = make_tar(os.path.join(self.tmp_dir, 'php.tar.gz'),
+                        ['php/bin/php', 'php/man/php.1',
+                         'php/lib/libphp.a', 'php/lib/libphp.so'])
+        self.unzip.extract(path, self.into_dir, strip=True,
+                           exclude=['man', 'lib/*.a'])
+        eq_(['bin/php', 'lib/libphp.so'], list_files(self.into_dir))
+
+    def test_extract_tar_with_exclude_no_strip(self):
+        path = make_tar(os.path.join(self.tmp_dir, 'php.tar.gz'),
+                        ['bin/php', 'man/php.1'])
+        self.unzip.extract(path, self.into_dir, exclude=['man'])
+        eq_(['bin'], os.listdir(self.into_dir))
+
+    def test_extract_tar_with_exclude_in_python(self):
+        path = make_tar(os.path.join(self.tmp_dir, 'php.tar.gz'),
+                        ['php/bin/php', 'php/man/php.1'])
+        UnzipUtil(utils.FormattedDict({
+            'TAR_DECOMPRESSOR': 'python'
+        })).extract(path, self.into_dir, strip=True, exclude=['man'])
+        eq_(['bin/php'], list_files(self.into_dir))
+
+    def test_extract_missing_archive(self):
+        self.unzip.extract(os.path.join(self.tmp_dir, 'missing.tar.gz'),
+                           self.into_dir)
+        eq_(False, os.path.exists(os.path.join(self.into_dir, 'bin')))
+
+class TestTarStream(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='zips-')
+        self.into_dir = os.path.join(self.tmp_dir, 'into')
+        self.unzip = UnzipUtil(utils.FormattedDict({
+            'TMPDIR': self.tmp_dir
+        }))
+        path = make_tar(os.path.join(self.tmp_dir, 'php.tar.gz'),
+                        ['php/bin/php', 'php/man/php.1'])
+        with open(path, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stream(self):
+        stream = self.unzip.stream('php.tar.gz', self.into_dir, strip=True,
+                                   exclude=['man'])
+        for i in range(0, len(self.data), 10):
+            stream.write(self.data[i:i + 10])
+        eq_(True, stream.close())
+        eq_(len(self.data), stream.length)
+        eq_(['bin/php'], list_files(self.into_dir))
+
+    def test_stream_failed(self):
+        stream = self.unzip.stream('php.tar.gz', self.into_dir)
+        stream.write('not a tar file' * 100000)
+        stream.write(self.data)
+        eq_(False, stream.close())
+        eq_(True, stream.failed)
+
+    def test_abort(self):
+        stream = self.unzip.stream('php.tar.gz', self.into_dir)
+        stream.write(self.data[:10])
+        stream.abort()
+        eq_(True, stream.failed)
+        stream.write(self.data[10:])
+        eq_(10, stream.length)
+
+    def test_cannot_stream(self):
+        eq_(None, self.unzip.stream('php.zip', self.into_dir))
+        eq_(None, UnzipUtil(utils.FormattedDict({
+            'TAR_DECOMPRESSOR': 'python'
+        })).stream('php.tar.gz', self.into_dir))